@@ -0,0 +1,354 @@
+"""
+Offline benchmarks for the agent's hot paths. Kubernetes and the Cykubed API are mocked,
+so these can run anywhere the tests can:
+
+    PYTHONPATH=src python benchmarks/bench.py            # compare against the stored baseline
+    PYTHONPATH=src python benchmarks/bench.py --save     # record a new baseline
+    PYTHONPATH=src python benchmarks/bench.py -k render  # only run matching benchmarks
+
+Each benchmark is timed as the median of several repeats, reported per operation, along with
+the peak memory allocated by a single operation. A benchmark fails if it is slower (or allocates
+more) than its baseline by more than the threshold (25% by default, or the "threshold" value for
+that benchmark in the baseline file). Timings depend on the machine, so only compare against a
+baseline recorded on the same hardware.
+"""
+import argparse
+import asyncio
+import contextlib
+import inspect
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable
+from unittest import mock
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+DEFAULT_THRESHOLD = 0.25
+
+os.environ.setdefault('HOSTNAME', 'agent-0')
+
+import respx
+import yaml
+from httpx import Response
+from kubernetes_asyncio.watch import Watch
+from loguru import logger
+
+from common.enums import PlatformEnum, AppFramework, TestFramework
+from common.schemas import Project, NewTestRun, TestRunBuildState
+from informers import decode_event
+from jobs import common_context
+from k8utils import render_yaml_template
+from logs import LogQueue, rest_logsink
+from records import PodRecord
+from settings import settings
+from ws import handle_websocket_message
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), '..', 'tests', 'fixtures')
+
+BENCHMARKS: dict[str, tuple[Callable, int]] = {}
+
+
+def benchmark(name: str, number: int):
+    """
+    Register a benchmark. The decorated function is passed an AsyncExitStack for any patches,
+    and returns the (sync or async) operation to time
+    """
+    def wrapper(f):
+        BENCHMARKS[name] = (f, number)
+        return f
+    return wrapper
+
+
+def create_testrun() -> NewTestRun:
+    project = Project(id=10,
+                      organisation_id=5,
+                      name='project',
+                      repos='project',
+                      default_branch='master',
+                      agent_id=1,
+                      platform=PlatformEnum.GITHUB,
+                      app_framework=AppFramework.generic,
+                      test_framework=TestFramework.cypress,
+                      build_cpu='4.0',
+                      build_memory=6.0,
+                      build_storage=10,
+                      build_ephemeral_storage=4,
+                      runner_cpu='2',
+                      runner_memory=4.0,
+                      runner_ephemeral_storage=2,
+                      url='git@github.org/dummy.git',
+                      build_deadline=3600,
+                      build_cmd='ng build --output=dist')
+    return NewTestRun(url='git@github.org/dummy.git',
+                      id=20,
+                      sha='deadbeef0101',
+                      local_id=1,
+                      project=project,
+                      image='europe-docker.pkg.dev/cykubed/public/runner/cypress-node-20:1.0.0',
+                      status='started',
+                      branch='master',
+                      spot_percentage=80,
+                      buildstate=TestRunBuildState(testrun_id=20,
+                                                   specs=[f'cypress/e2e/spec{i}.cy.ts' for i in range(50)]))
+
+
+@benchmark('render_build_job', number=200)
+def bench_render_build_job(stack: contextlib.AsyncExitStack):
+    context = common_context(create_testrun(), job_name='5-builder-project-1', pvc_name='5-project-1-rw')
+    return lambda: render_yaml_template('build', context)
+
+
+@benchmark('render_runner_job', number=200)
+def bench_render_runner_job(stack: contextlib.AsyncExitStack):
+    context = common_context(create_testrun())
+    context.update(name='5-runner-project-1-0', parallelism=4,
+                   build_snapshot_name='5-build-deadbeef0101', pvc_name='5-project-1-ro')
+    return lambda: render_yaml_template('runner', context)
+
+
+@benchmark('parse_new_testrun', number=1000)
+def bench_parse_new_testrun(stack: contextlib.AsyncExitStack):
+    payload = create_testrun().json()
+    return lambda: NewTestRun.parse_raw(payload)
+
+
+@benchmark('parse_build_state', number=2000)
+def bench_parse_build_state(stack: contextlib.AsyncExitStack):
+    payload = create_testrun().buildstate.json()
+    return lambda: TestRunBuildState.parse_raw(payload)
+
+
+@benchmark('rest_logsink', number=2000)
+def bench_rest_logsink(stack: contextlib.AsyncExitStack):
+    """
+    A testrun log message from the logger call to the queue, and back off again
+    """
+    queue = LogQueue(1000, 'drop_oldest')
+    stack.enter_context(mock.patch('logs.msgqueue', queue))
+    handler_id = logger.add(rest_logsink, format="{message}", level="INFO")
+    stack.callback(logger.remove, handler_id)
+
+    def op():
+        logger.info('Cloning repository', trid=20)
+        queue.get_nowait()
+    return op
+
+
+@benchmark('msgqueue', number=20000)
+def bench_msgqueue(stack: contextlib.AsyncExitStack):
+    queue = LogQueue(1000, 'drop_oldest')
+    msg = json.dumps(dict(testrun_id=20, msg='x' * 100))
+
+    def op():
+        queue.put_nowait(msg)
+        queue.get_nowait()
+    return op
+
+
+@benchmark('full_cycle', number=20)
+def bench_full_cycle(stack: contextlib.AsyncExitStack):
+    """
+    start -> build_completed -> cache_prepared -> run_completed, with K8 and the API mocked out
+    """
+    # restored along with the mocks, so the other benchmarks see the settings as they were
+    stack.enter_context(mock.patch.object(settings, 'PLATFORM', 'gke'))
+    stack.enter_context(mock.patch.object(settings, 'READ_ONLY_MANY', True))
+    for target in ('k8utils.get_batch_api', 'k8utils.get_core_api', 'k8utils.get_custom_api'):
+        stack.enter_context(mock.patch(target, return_value=mock.AsyncMock()))
+    stack.enter_context(mock.patch('k8utils.create_from_dict', mock.AsyncMock()))
+    stack.enter_context(mock.patch('jobs.get_cache_key', mock.AsyncMock(return_value='absd234weefw')))
+    stack.enter_context(mock.patch('jobs.wait_for_snapshot_ready', mock.AsyncMock()))
+    stack.enter_context(mock.patch('logs.msgqueue', LogQueue(100000, 'drop_oldest')))
+    router = stack.enter_context(respx.mock(base_url=settings.MAIN_API_URL, assert_all_called=False))
+    router.get(path__startswith='/agent/cached-item/').mock(return_value=Response(404))
+    router.route().mock(return_value=Response(200))
+
+    async def op():
+        testrun = create_testrun()
+        await handle_websocket_message(dict(command='start', payload=testrun.json()))
+        state = testrun.buildstate
+        state.rw_build_pvc = '5-project-1-rw'
+        state.build_job = '5-builder-project-1'
+        await handle_websocket_message(dict(command='build_completed', payload=testrun.json()))
+        state.ro_build_pvc = '5-project-1-ro'
+        state.build_snapshot_name = '5-build-deadbeef0101'
+        await handle_websocket_message(dict(command='cache_prepared', payload=testrun.json()))
+        await handle_websocket_message(dict(command='run_completed', payload=testrun.json()))
+    return op
+
+
+def create_pod_event() -> str:
+    """
+    A watch event for a running runner pod, as the API server would send it
+    """
+    with open(os.path.join(FIXTURES_DIR, 'rendered-templates', 'runner.yaml')) as f:
+        job = yaml.safe_load(f)
+    template = job['spec']['template']
+    metadata = dict(template['metadata'],
+                    name='5-runner-project-1-0-x7b2k',
+                    namespace='cykubed',
+                    uid='0b1f3c2e-54a6-4b6b-9d1e-4a0f1b0c9e21',
+                    resourceVersion='123456',
+                    creationTimestamp='2023-06-10T10:00:00Z',
+                    annotations={'autopilot.gke.io/selector-toleration': json.dumps(dict(
+                        inputTolerations=[], outputTolerations=[dict(key='cloud.google.com/gke-spot',
+                                                                     operator='Equal', value='true',
+                                                                     effect='NoSchedule')]))},
+                    ownerReferences=[dict(apiVersion='batch/v1', kind='Job', name=job['metadata']['name'],
+                                          uid='5d0a9a43-2c2e-4d55-8a57-2f0c8b1e7a10',
+                                          controller=True, blockOwnerDeletion=True)],
+                    managedFields=[dict(manager='kube-controller-manager', operation='Update',
+                                        apiVersion='v1', time='2023-06-10T10:00:00Z', fieldsType='FieldsV1',
+                                        fieldsV1={f'f:{k}': {} for k in job['spec']['template']['spec']})
+                                   for i in range(3)])
+    container_status = dict(name='cykubed-runner', ready=True, restartCount=0, started=True,
+                            image='europe-docker.pkg.dev/cykubed/public/runner/cypress-node-20:1.0.0',
+                            imageID='europe-docker.pkg.dev/cykubed/public/runner@sha256:' + 'a' * 64,
+                            containerID='containerd://' + 'b' * 64,
+                            state=dict(running=dict(startedAt='2023-06-10T10:00:05Z')))
+    status = dict(phase='Running', startTime='2023-06-10T10:00:00Z', hostIP='10.0.0.5', podIP='10.4.0.12',
+                  qosClass='Guaranteed',
+                  conditions=[dict(type=t, status='True', lastTransitionTime='2023-06-10T10:00:05Z')
+                              for t in ('Initialized', 'Ready', 'ContainersReady', 'PodScheduled')],
+                  containerStatuses=[container_status])
+    pod = dict(apiVersion='v1', kind='Pod', metadata=metadata,
+               spec=dict(template['spec'], nodeName='gke-cykubed-spot-pool-1-abcd'), status=status)
+    return json.dumps(dict(type='MODIFIED', object=pod))
+
+
+@benchmark('watch_event_model', number=500)
+def bench_watch_event_model(stack: contextlib.AsyncExitStack):
+    """
+    How the watchers used to decode events: into a full V1Pod
+    """
+    line = create_pod_event()
+    w = Watch()
+    stack.push_async_callback(w.close)
+    return lambda: w.unmarshal_event(line, 'V1Pod')['object'].status.phase
+
+
+@benchmark('watch_event_record', number=500)
+def bench_watch_event_record(stack: contextlib.AsyncExitStack):
+    """
+    How the watchers decode events now: see ResumableWatch.watch
+    """
+    line = create_pod_event().encode()
+    return lambda: PodRecord.from_dict(decode_event(line)['object']).phase
+
+
+async def time_op(op: Callable, number: int, repeat: int) -> list[float]:
+    """
+    :return: the time per operation for each repeat, in seconds
+    """
+    is_async = inspect.iscoroutinefunction(op)
+    # warm up (and prime any caches)
+    for i in range(min(number, 10)):
+        await op() if is_async else op()
+    timings = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        if is_async:
+            for i in range(number):
+                await op()
+        else:
+            for i in range(number):
+                op()
+        timings.append((time.perf_counter() - start) / number)
+    return timings
+
+
+async def peak_memory(op: Callable) -> int:
+    """
+    :return: the peak memory allocated by a single operation, in bytes
+    """
+    tracemalloc.start()
+    try:
+        await op() if inspect.iscoroutinefunction(op) else op()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+async def run_benchmark(name: str, repeat: int) -> dict:
+    setup, number = BENCHMARKS[name]
+    async with contextlib.AsyncExitStack() as stack:
+        op = setup(stack)
+        timings = await time_op(op, number, repeat)
+        peak = await peak_memory(op)
+    return dict(median_us=round(statistics.median(timings) * 1e6, 2),
+                min_us=round(min(timings) * 1e6, 2),
+                peak_kb=round(peak / 1024, 1),
+                number=number,
+                repeat=repeat)
+
+
+def load_baseline() -> dict:
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+
+def compare(name: str, result: dict, baseline: dict, default_threshold: float) -> bool:
+    """
+    Print the result against its baseline
+    :return: False if it has regressed beyond the threshold
+    """
+    line = f'{name:<24}{result["median_us"]:>12.2f}us{result["peak_kb"]:>10.1f}KB'
+    expected = baseline.get(name)
+    if not expected:
+        print(f'{line}   (no baseline)')
+        return True
+    threshold = expected.get('threshold', default_threshold)
+    change = result['median_us'] / expected['median_us'] - 1
+    ok = change <= threshold
+    line += f'   {change:+8.1%} vs {expected["median_us"]:.2f}us'
+    if expected.get('peak_kb'):
+        # (nothing to compare against if the baseline allocated nothing)
+        mem_change = result['peak_kb'] / expected['peak_kb'] - 1
+        ok = ok and mem_change <= threshold
+        line += f'   {mem_change:+8.1%} vs {expected["peak_kb"]:.1f}KB'
+    print(f'{line}{"" if ok else "   REGRESSION"}')
+    return ok
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark the agent')
+    parser.add_argument('-k', dest='pattern', help='Only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Allowed slowdown before a benchmark fails, as a fraction of the baseline')
+    parser.add_argument('--save', action='store_true', help='Save the results as the new baseline')
+    args = parser.parse_args()
+
+    # benchmark the code, not the console
+    logger.remove()
+
+    baseline = load_baseline()
+    results = {}
+    ok = True
+    for name in BENCHMARKS:
+        if args.pattern and args.pattern not in name:
+            continue
+        results[name] = await run_benchmark(name, args.repeat)
+        ok = compare(name, results[name], baseline, args.threshold) and ok
+
+    if args.save:
+        for name, result in results.items():
+            # keep any hand-tuned thresholds
+            if 'threshold' in baseline.get(name, {}):
+                result['threshold'] = baseline[name]['threshold']
+            baseline[name] = result
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Saved baseline to {BASELINE_FILE}')
+    elif not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -3,6 +3,7 @@ from loguru import logger
 
 from common.enums import TestRunStatus
 from common.k8common import close
+from httpclient import create_transport
 from settings import settings
 
 
@@ -27,8 +28,8 @@ class App(object):
         except:
             pass
 
-        transport = httpx.AsyncHTTPTransport(retries=settings.MAX_HTTP_RETRIES)
-        self.httpclient = httpx.AsyncClient(transport=transport,
+        self.transport = create_transport()
+        self.httpclient = httpx.AsyncClient(transport=self.transport,
                                    base_url=settings.MAIN_API_URL,
                                    headers={'Authorization': f'Bearer {settings.API_TOKEN}'})
 
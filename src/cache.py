@@ -1,35 +1,146 @@
-from kubernetes_asyncio.client import V1PersistentVolumeClaimList, V1JobList
+import asyncio
+from typing import Callable, Awaitable
+
+import aiohttp
+from kubernetes_asyncio.client import ApiException
 from loguru import logger
+from tenacity import AsyncRetrying, stop_after_attempt, wait_random_exponential, retry_if_exception
 
 from app import app
 from common.k8common import get_core_api, get_custom_api, get_batch_api
 from common.schemas import CacheItem
-from k8utils import async_delete_snapshot, async_delete_job
+from k8utils import gather_bounded
 from settings import settings
 
+# don't delete the Helm-managed jobs (i.e. the pre-delete hook job that's running this cleanup)
+CLEANUP_JOB_SELECTOR = '!helm.sh/chart'
+DELETE_ATTEMPTS = 3
+
+SNAPSHOT_API_ARGS = dict(group="snapshot.storage.k8s.io",
+                         version="v1beta1",
+                         plural="volumesnapshots")
+
+
+def is_retryable(ex: BaseException) -> bool:
+    if isinstance(ex, ApiException):
+        return ex.status == 429 or ex.status >= 500
+    return isinstance(ex, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+async def list_names(list_func, label_selector: str = None, **kwargs) -> list[str]:
+    """
+    List the names of objects that aren't already being deleted
+    """
+    resp = await list_func(namespace=settings.NAMESPACE,
+                           label_selector=label_selector,
+                           _preload_content=False,
+                           **kwargs)
+    if resp.status != 200:
+        raise ApiException(status=resp.status, reason=await resp.text())
+    data = await resp.json()
+    return [item['metadata']['name'] for item in data['items']
+            if not item['metadata'].get('deletionTimestamp')]
+
+
+async def delete_with_retry(delete_func: Callable[[str], Awaitable], name: str):
+    async for attempt in AsyncRetrying(stop=stop_after_attempt(DELETE_ATTEMPTS),
+                                       wait=wait_random_exponential(multiplier=0.5, max=10),
+                                       retry=retry_if_exception(is_retryable),
+                                       reraise=True):
+        with attempt:
+            try:
+                await delete_func(name)
+            except ApiException as ex:
+                if ex.status != 404:
+                    raise
+
+
+async def delete_each(kind: str, names: list[str], delete_func: Callable[[str], Awaitable]) -> list[str]:
+    """
+    Delete the objects one at a time (but concurrently), with retries
+    :return: the names of any objects we failed to delete
+    """
+    done = 0
+    failed = []
+    step = max(1, len(names) // 10)
+
+    async def delete(name: str):
+        nonlocal done
+        try:
+            await delete_with_retry(delete_func, name)
+        except Exception as ex:
+            logger.error(f'Failed to delete {kind} {name}: {ex}')
+            failed.append(name)
+        done += 1
+        if done % step == 0 or done == len(names):
+            logger.info(f'Deleted {done}/{len(names)} {kind}')
+
+    await gather_bounded([delete(name) for name in names], settings.MAX_CONCURRENT_DELETES)
+    return failed
+
+
+async def delete_all(kind: str,
+                     list_func,
+                     delete_collection_func,
+                     delete_func: Callable[[str], Awaitable],
+                     label_selector: str = None,
+                     **kwargs) -> list[str]:
+    """
+    Delete all objects of one kind in our namespace with a single collection delete, falling back
+    to individual deletes if that isn't allowed. Finally check that nothing was missed.
+    :return: the names of any objects that couldn't be deleted
+    """
+    try:
+        await delete_collection_func(namespace=settings.NAMESPACE,
+                                     label_selector=label_selector,
+                                     propagation_policy='Background',
+                                     **kwargs)
+        logger.info(f'Deleted all {kind}')
+    except ApiException as ex:
+        if ex.status not in (403, 404, 405):
+            raise
+        # e.g the Role doesn't include deletecollection
+        logger.info(f'Cannot bulk delete {kind} ({ex.status} {ex.reason}): delete them individually')
+        names = await list_names(list_func, label_selector, **kwargs)
+        await delete_each(kind, names, delete_func)
+
+    # verify
+    remaining = await list_names(list_func, label_selector, **kwargs)
+    if remaining:
+        logger.warning(f'{len(remaining)} {kind} remain after delete: retry individually')
+        remaining = await delete_each(kind, remaining, delete_func)
+        if remaining:
+            logger.error(f'Failed to delete {len(remaining)} {kind}: {", ".join(remaining[:10])}')
+    return remaining
+
 
 async def delete_all_jobs():
-    resp: V1JobList = await get_batch_api().list_namespaced_job(settings.NAMESPACE)
-    for job in resp.items:
-        logger.info(f'Deleting job {job.metadata.name}')
-        await async_delete_job(job.metadata.name)
+    api = get_batch_api()
+    await delete_all('jobs',
+                     api.list_namespaced_job,
+                     api.delete_collection_namespaced_job,
+                     lambda name: api.delete_namespaced_job(name, settings.NAMESPACE,
+                                                            propagation_policy='Background'),
+                     label_selector=CLEANUP_JOB_SELECTOR)
 
 
 async def delete_all_pvcs():
-    v1 = get_core_api()
-    result: V1PersistentVolumeClaimList = await v1.list_namespaced_persistent_volume_claim(settings.NAMESPACE)
-    for item in result.items:
-        await v1.delete_namespaced_persistent_volume_claim(item.metadata.name, settings.NAMESPACE)
+    api = get_core_api()
+    await delete_all('PVCs',
+                     api.list_namespaced_persistent_volume_claim,
+                     api.delete_collection_namespaced_persistent_volume_claim,
+                     lambda name: api.delete_namespaced_persistent_volume_claim(name, settings.NAMESPACE))
 
 
 async def delete_all_volume_snapshots():
-    snapshot_resp = await get_custom_api().list_namespaced_custom_object(group="snapshot.storage.k8s.io",
-                                                                         version="v1beta1",
-                                                                         namespace=settings.NAMESPACE,
-                                                                         plural="volumesnapshots")
-    for item in snapshot_resp['items']:
-        name = item['metadata']['name']
-        await async_delete_snapshot(name)
+    api = get_custom_api()
+    await delete_all('volume snapshots',
+                     api.list_namespaced_custom_object,
+                     api.delete_collection_namespaced_custom_object,
+                     lambda name: api.delete_namespaced_custom_object(namespace=settings.NAMESPACE,
+                                                                      name=name,
+                                                                      **SNAPSHOT_API_ARGS),
+                     **SNAPSHOT_API_ARGS)
 
 
 async def get_cached_item(key: str) -> CacheItem | None:
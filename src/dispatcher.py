@@ -0,0 +1,127 @@
+import asyncio
+import json
+import time
+from collections import deque, defaultdict
+from typing import Awaitable, Callable
+
+from loguru import logger
+
+from metrics import Histogram
+
+COMMAND_SECONDS = Histogram('cykubed_command_seconds', 'Time to handle a websocket command', ('command',))
+COMMAND_WAIT_SECONDS = Histogram('cykubed_command_wait_seconds',
+                                 'Time a websocket command was queued before being handled', ('command',))
+
+# commands whose payload is a serialised NewTestRun: these must be handled in order per testrun
+TESTRUN_COMMANDS = {'start', 'cancel', 'build_completed', 'cache_prepared', 'run_completed'}
+
+
+def get_testrun_id(data: dict) -> int | None:
+    """
+    The testrun a command is for, if it's for a single testrun
+    """
+    if data.get('command') in TESTRUN_COMMANDS:
+        try:
+            return json.loads(data["payload"])["id"]
+        except (KeyError, TypeError, ValueError):
+            pass
+    return None
+
+
+def get_ordering_key(data: dict) -> str:
+    """
+    Commands for the same testrun are handled strictly in order: everything else is
+    ordered per command type
+    """
+    testrun_id = get_testrun_id(data)
+    if testrun_id is not None:
+        return f'testrun:{testrun_id}'
+    return f'command:{data.get("command")}'
+
+
+class CommandStats(object):
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_wait = 0.0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, wait: float, duration: float, failed: bool):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total_wait += wait
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    def as_dict(self) -> dict:
+        return dict(count=self.count,
+                    errors=self.errors,
+                    avg_wait_ms=round(1000 * self.total_wait / self.count, 1) if self.count else 0,
+                    avg_ms=round(1000 * self.total_time / self.count, 1) if self.count else 0,
+                    max_ms=round(1000 * self.max_time, 1))
+
+
+class CommandDispatcher(object):
+    """
+    Handles websocket commands concurrently across testruns, while preserving the order of
+    commands within a testrun. Each ordering key gets its own lane, which is drained by a
+    worker task that exits once the lane is empty. Total concurrency is capped by a semaphore.
+    """
+    def __init__(self, handler: Callable[[dict], Awaitable], max_concurrency: int):
+        self.handler = handler
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.lanes: dict[str, deque] = {}
+        self.workers: dict[str, asyncio.Task] = {}
+        self.active = 0
+        self.stats_by_command: dict[str, CommandStats] = defaultdict(CommandStats)
+
+    def submit(self, data: dict):
+        key = get_ordering_key(data)
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = deque()
+            self.workers[key] = asyncio.create_task(self._drain(key, lane))
+        lane.append((data, time.monotonic()))
+
+    async def _drain(self, key: str, lane: deque):
+        try:
+            while lane:
+                data, queued_at = lane.popleft()
+                async with self.semaphore:
+                    self.active += 1
+                    started = time.monotonic()
+                    failed = False
+                    try:
+                        await self.handler(data)
+                    except Exception as ex:
+                        failed = True
+                        logger.exception(f'Unexpected error handling {data.get("command")} command: {ex}')
+                    finally:
+                        self.active -= 1
+                        cmd = data.get('command')
+                        duration = time.monotonic() - started
+                        self.stats_by_command[cmd].record(started - queued_at, duration, failed)
+                        COMMAND_WAIT_SECONDS.observe(started - queued_at, command=cmd)
+                        COMMAND_SECONDS.observe(duration, command=cmd)
+        finally:
+            del self.lanes[key]
+            del self.workers[key]
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    async def join(self):
+        """
+        Wait for all queued commands to be handled
+        """
+        while self.workers:
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return dict(queued=self.queue_depth,
+                    active=self.active,
+                    lanes=len(self.lanes),
+                    commands={cmd: st.as_dict() for cmd, st in self.stats_by_command.items()})
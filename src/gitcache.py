@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit, urlunsplit
+
+from cachetools import TTLCache
+from loguru import logger
+
+from common.exceptions import BuildFailedException
+from common.utils import get_lock_hash
+from settings import settings
+
+# the files that determine the node cache key
+LOCK_FILES = ('package-lock.json', 'yarn.lock', 'pnpm-lock.yaml')
+
+
+class GitCommandError(Exception):
+    pass
+
+
+def strip_credentials(url: str) -> str:
+    """
+    Remove any credentials from the URL, so mirrors don't depend on (short-lived) clone tokens
+    """
+    parts = urlsplit(url)
+    if parts.scheme and '@' in parts.netloc:
+        return urlunsplit(parts._replace(netloc=parts.netloc.rsplit('@', 1)[1]))
+    return url
+
+
+def get_dir_size(path: str) -> int:
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+async def git(*args, cwd: str = None) -> bytes:
+    proc = await asyncio.create_subprocess_exec('git', *args, cwd=cwd,
+                                                stdout=asyncio.subprocess.PIPE,
+                                                stderr=asyncio.subprocess.PIPE,
+                                                env=dict(os.environ, GIT_TERMINAL_PROMPT='0'))
+    stdout, stderr = await proc.communicate()
+    if proc.returncode:
+        raise GitCommandError(f'git {args[0]} failed: {stderr.decode(errors="replace").strip()}')
+    return stdout
+
+
+class MirrorCache(object):
+    """
+    Bounded on-disk cache of shallow, blobless bare mirrors, keyed by repository URL.
+    Lock files are read for a specific sha straight from the object store (fetching the blob
+    on demand), so we never need a working tree. Least recently used mirrors are evicted
+    when the total size exceeds the budget.
+    """
+    def __init__(self, root: str, max_size_mb: int):
+        self.root = root
+        self.max_size = max_size_mb * 1024 * 1024
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    def get_mirror_path(self, url: str) -> str:
+        key = hashlib.sha1(strip_credentials(url).encode()).hexdigest()
+        return os.path.join(self.root, key)
+
+    async def get_lock_hash(self, url: str, branch: str, sha: str) -> str:
+        path = self.get_mirror_path(url)
+        lock = self.locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            try:
+                k = await self._get_lock_hash(path, url, branch, sha)
+            except GitCommandError as ex:
+                # the mirror may be corrupt: start again from scratch
+                logger.warning(f'Failed to read lock file from mirror ({ex}): recreate it')
+                await asyncio.to_thread(shutil.rmtree, path, True)
+                try:
+                    k = await self._get_lock_hash(path, url, branch, sha)
+                except GitCommandError as ex:
+                    await asyncio.to_thread(shutil.rmtree, path, True)
+                    raise BuildFailedException(f'Failed to fetch {strip_credentials(url)}: {ex}')
+            os.utime(path)
+        await self.evict()
+        return k
+
+    async def _get_lock_hash(self, path: str, url: str, branch: str, sha: str) -> str:
+        if not os.path.exists(path):
+            os.makedirs(path)
+            await git('init', '--bare', '--quiet', cwd=path)
+            await git('remote', 'add', 'origin', url, cwd=path)
+            await git('config', 'remote.origin.promisor', 'true', cwd=path)
+            await git('config', 'remote.origin.partialclonefilter', 'blob:none', cwd=path)
+        else:
+            # clone tokens change between runs
+            await git('remote', 'set-url', 'origin', url, cwd=path)
+
+        if not await self.has_commit(path, sha):
+            await self.fetch(path, branch, sha)
+
+        names = (await git('ls-tree', '--name-only', sha, cwd=path)).decode().splitlines()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in names:
+                if name in LOCK_FILES:
+                    contents = await git('show', f'{sha}:{name}', cwd=path)
+                    with open(os.path.join(tmpdir, name), 'wb') as f:
+                        f.write(contents)
+            return get_lock_hash(tmpdir)
+
+    @staticmethod
+    async def has_commit(path: str, sha: str) -> bool:
+        try:
+            await git('cat-file', '-e', f'{sha}^{{commit}}', cwd=path)
+            return True
+        except GitCommandError:
+            return False
+
+    @staticmethod
+    async def fetch(path: str, branch: str, sha: str):
+        """
+        Incremental fetch: we only ever need the single commit (and its trees)
+        """
+        try:
+            await git('fetch', '--quiet', '--depth', '1', '--filter=blob:none', 'origin', sha, cwd=path)
+        except GitCommandError:
+            # not all servers allow fetching by sha: fall back to the branch head
+            await git('fetch', '--quiet', '--depth', '1', '--filter=blob:none', 'origin',
+                      f'+refs/heads/{branch}:refs/heads/{branch}', cwd=path)
+
+    async def evict(self):
+        """
+        Remove the least recently used mirrors until we're within budget
+        """
+        if not os.path.exists(self.root):
+            return
+        mirrors = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            lock = self.locks.get(path)
+            if lock and lock.locked():
+                continue
+            mirrors.append((os.stat(path).st_mtime, path, await asyncio.to_thread(get_dir_size, path)))
+        total = sum(m[2] for m in mirrors)
+        for mtime, path, size in sorted(mirrors):
+            if total <= self.max_size:
+                break
+            # it may have been taken while we were measuring the mirrors. Checking and acquiring the lock
+            # can't be interleaved with anything else, and we keep the lock (anyone waiting on it has a reference)
+            lock = self.locks.setdefault(path, asyncio.Lock())
+            if lock.locked():
+                continue
+            async with lock:
+                logger.info(f'Evicting git mirror {path} ({size // 1024}KB)')
+                await asyncio.to_thread(shutil.rmtree, path, True)
+            total -= size
+
+
+class CacheKeyIndex(object):
+    """
+    In-memory index of (repository, sha) to cache key. The lock file for a commit never changes,
+    so the TTL simply bounds memory. Concurrent requests for the same commit share a single
+    computation.
+    """
+    def __init__(self, maxsize: int, ttl: int):
+        self.keys = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.inflight: dict[tuple, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    async def get(self, url: str, sha: str, compute: Callable[[], Awaitable[str]]) -> str:
+        key = (strip_credentials(url), sha)
+        k = self.keys.get(key)
+        if k is not None:
+            self.hits += 1
+            return k
+        task = self.inflight.get(key)
+        if task:
+            self.shared += 1
+        else:
+            self.misses += 1
+            task = self.inflight[key] = asyncio.create_task(compute())
+            task.add_done_callback(lambda t: self._computed(key, t))
+        # a cancelled waiter mustn't cancel the computation for everyone else
+        return await asyncio.shield(task)
+
+    def _computed(self, key: tuple, task: asyncio.Task):
+        del self.inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self.keys[key] = task.result()
+
+    def stats(self) -> dict:
+        return dict(size=len(self.keys),
+                    hits=self.hits,
+                    misses=self.misses,
+                    shared=self.shared,
+                    inflight=len(self.inflight))
+
+
+mirror_cache = MirrorCache(settings.GIT_MIRROR_DIR, settings.GIT_MIRROR_CACHE_SIZE)
+cache_key_index = CacheKeyIndex(settings.CACHE_KEY_INDEX_SIZE, settings.CACHE_KEY_INDEX_TTL)
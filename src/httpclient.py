@@ -0,0 +1,203 @@
+import asyncio
+import importlib.util
+import random
+import re
+import time
+from collections import defaultdict
+
+import httpx
+from loguru import logger
+
+from settings import settings
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+RETRY_STATUSES = {429, 502, 503, 504}
+# the request can't have reached the server, so it's safe to retry whatever the method
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+NETWORK_ERRORS = (httpx.NetworkError, httpx.TimeoutException, httpx.RemoteProtocolError)
+
+ID_SEGMENT = re.compile(r'/[^/]*\d[^/]*')
+
+
+class CircuitOpenError(httpx.TransportError):
+    pass
+
+
+def endpoint(request: httpx.Request) -> str:
+    """
+    Group requests by method and path, with any path segments that look like IDs or keys replaced
+    """
+    return f'{request.method} {ID_SEGMENT.sub("/{id}", request.url.path)}'
+
+
+class CircuitBreaker(object):
+    """
+    Opens after a number of consecutive failures, so we fail fast rather than pile more requests
+    onto a server that's struggling. After a while a single request is let through: if it succeeds
+    the circuit closes again
+    """
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def release(self):
+        # the probe was abandoned (e.g cancelled) without telling us anything
+        self.probing = False
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info('Server API has recovered')
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            if self.opened_at is None:
+                logger.warning(f'Server API is failing: stop calling it for {self.reset_timeout}s')
+                self.opened += 1
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency: float, error: bool):
+        self.requests += 1
+        self.errors += int(error)
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> dict:
+        return dict(requests=self.requests,
+                    errors=self.errors,
+                    retries=self.retries,
+                    mean_latency=round(self.total_latency / self.requests, 4) if self.requests else 0,
+                    max_latency=round(self.max_latency, 4))
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """
+    Wraps the real transport with retries (with jittered exponential backoff), a circuit breaker
+    and per-endpoint stats.
+
+    Connection failures are retried for any request, but failed responses (429 and gateway
+    errors) only for idempotent methods. Retries stop as soon as the circuit opens, so a
+    blip in the server doesn't turn into a retry storm from every testrun at once.
+    """
+    def __init__(self, transport: httpx.AsyncBaseTransport, retries: int,
+                 backoff: float, max_backoff: float, breaker: CircuitBreaker):
+        self.transport = transport
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+        self.endpoints: dict[str, EndpointStats] = defaultdict(EndpointStats)
+        self.rejected = 0
+
+    def delay(self, attempt: int, response: httpx.Response = None) -> float:
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(self.max_backoff, int(retry_after))
+        # "full jitter", so retries from different requests are spread out
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def retrying(self, attempt: int) -> bool:
+        # give up as soon as the circuit opens, rather than wait to be rejected
+        return attempt < self.retries and self.breaker.state == 'closed'
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self.endpoints[endpoint(request)]
+        idempotent = request.method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.rejected += 1
+                raise CircuitOpenError(f'Server API is unavailable: not sending {request.method} {request.url.path}',
+                                       request=request)
+            start = time.monotonic()
+            try:
+                response = await self.transport.handle_async_request(request)
+            except httpx.TransportError as ex:
+                stats.record(time.monotonic() - start, True)
+                self.breaker.failure()
+                retryable = isinstance(ex, CONNECT_ERRORS) or (idempotent and isinstance(ex, NETWORK_ERRORS))
+                if not retryable or not self.retrying(attempt):
+                    raise
+                wait = self.delay(attempt)
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                failed = response.status_code in RETRY_STATUSES or response.status_code >= 500
+                stats.record(time.monotonic() - start, failed)
+                if not failed:
+                    self.breaker.success()
+                    return response
+                self.breaker.failure()
+                if not idempotent or response.status_code not in RETRY_STATUSES or not self.retrying(attempt):
+                    return response
+                wait = self.delay(attempt, response)
+                await response.aclose()
+
+            attempt += 1
+            stats.retries += 1
+            logger.debug(f'Retry {request.method} {request.url.path} in {wait:.1f}s (attempt {attempt})')
+            await asyncio.sleep(wait)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    def stats(self) -> dict:
+        return dict(circuit=self.breaker.state,
+                    circuit_opened=self.breaker.opened,
+                    rejected=self.rejected,
+                    endpoints={k: v.as_dict() for k, v in sorted(self.endpoints.items())})
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec('h2') is not None
+
+
+def create_transport() -> ResilientTransport:
+    http2 = settings.HTTP2 and http2_available()
+    if settings.HTTP2 and not http2:
+        logger.debug('h2 is not installed: using HTTP/1.1')
+    limits = httpx.Limits(max_connections=settings.HTTP_MAX_CONNECTIONS,
+                          max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                          keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY)
+    return ResilientTransport(httpx.AsyncHTTPTransport(http2=http2, limits=limits),
+                              retries=settings.MAX_HTTP_RETRIES,
+                              backoff=settings.HTTP_BACKOFF,
+                              max_backoff=settings.MAX_HTTP_BACKOFF,
+                              breaker=CircuitBreaker(settings.HTTP_CIRCUIT_THRESHOLD,
+                                                     settings.HTTP_CIRCUIT_RESET))
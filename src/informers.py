@@ -0,0 +1,310 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Callable
+
+import aiohttp
+from kubernetes_asyncio.client import ApiException
+from loguru import logger
+
+from app import app
+from common.exceptions import BuildFailedException
+from common.k8common import get_core_api, get_custom_api, get_batch_api
+from common.utils import utcnow
+from metrics import Histogram, k8_call, SLOW_BUCKETS
+from records import parse_time
+from settings import settings
+
+# the labels we look objects up by
+INDEX_LABELS = ('testrun_id', 'project_id', 'branch', 'sha', 'cykubed_pool')
+
+SNAPSHOT_READY_SECONDS = Histogram('cykubed_snapshot_ready_seconds',
+                                   'Time from creating a volume snapshot until it is ready to use',
+                                   buckets=SLOW_BUCKETS)
+
+
+def get_name(obj: dict) -> str:
+    return obj['metadata']['name']
+
+
+def get_labels(obj: dict) -> dict:
+    return obj['metadata'].get('labels') or {}
+
+
+def decode_event(line: bytes | str) -> dict:
+    """
+    Decode one line of a watch stream. Unlike kubernetes_asyncio's Watch (which decodes, re-encodes
+    and decodes each event again), this parses the JSON exactly once
+    :return: the event, with the object as a plain dict
+    """
+    event = json.loads(line)
+    if 'type' not in event or 'object' not in event:
+        if 'code' in event:
+            raise ApiException(status=event['code'], reason=f"{event.get('reason')}: {event.get('message')}")
+        raise ValueError(f'Malformed watch event: {event}')
+    if event['type'] == 'ERROR':
+        # e.g our resource version is too old
+        obj = event['object']
+        raise ApiException(status=obj['code'], reason=f"{obj.get('reason')}: {obj.get('message')}")
+    return event
+
+
+class ResumableWatch(object):
+    """
+    A list followed by a watch that resumes from the last seen resourceVersion, asking for bookmarks
+    so the version stays current even when nothing we're watching changes. A full relist only
+    happens at startup and when the server tells us our version is too old (410 Gone).
+    Objects are plain dicts decoded from the raw JSON: we never deserialize into models.
+    Subclasses handle the listed objects and the events.
+    """
+    def __init__(self, kind: str, get_list_func: Callable[[], Callable], **list_kwargs):
+        self.kind = kind
+        # the API clients only exist once K8 has been initialised, so fetch the list function lazily
+        self.get_list_func = get_list_func
+        self.list_kwargs = list_kwargs
+        self.resource_version = None
+        self.synced = False
+        self.relists = 0
+        self.events = 0
+        self.task = None
+
+    async def list_objects(self) -> tuple[list[dict], str]:
+        """
+        :return: the objects and the resource version of the list
+        """
+        resp = await k8_call(f'list_{self.kind}',
+                             self.get_list_func()(namespace=settings.NAMESPACE,
+                                                  _preload_content=False,
+                                                  **self.list_kwargs))
+        if resp.status != 200:
+            raise ApiException(status=resp.status, reason=await resp.text())
+        data = await resp.json()
+        return data['items'], data['metadata']['resourceVersion']
+
+    async def relist(self):
+        items, resource_version = await self.list_objects()
+        self.relists += 1
+        await self.on_list(items)
+        self.resource_version = resource_version
+        self.synced = True
+
+    async def on_list(self, items: list[dict]):
+        """
+        Called with the full list of objects at startup, and after a relist
+        """
+        for obj in items:
+            await self.on_event('ADDED', obj)
+
+    async def on_event(self, event_type: str, obj: dict):
+        pass
+
+    async def watch(self):
+        resp = await self.get_list_func()(namespace=settings.NAMESPACE,
+                                          watch=True,
+                                          resource_version=self.resource_version,
+                                          allow_watch_bookmarks=True,
+                                          timeout_seconds=settings.WATCH_TIMEOUT,
+                                          _preload_content=False,
+                                          **self.list_kwargs)
+        try:
+            if resp.status != 200:
+                raise ApiException(status=resp.status, reason=await resp.text())
+            # the server ends the stream after the timeout
+            while line := await resp.content.readline():
+                event = decode_event(line)
+                obj = event['object']
+                if event['type'] != 'BOOKMARK':
+                    self.events += 1
+                    await self.on_event(event['type'], obj)
+                self.resource_version = obj['metadata'].get('resourceVersion') or self.resource_version
+        finally:
+            resp.release()
+
+    async def run(self):
+        while app.is_running():
+            try:
+                if not self.resource_version:
+                    await self.relist()
+                await self.watch()
+            except ApiException as ex:
+                if ex.status == 410:
+                    logger.debug(f'{self.kind} resource version is too old: relist')
+                    self.resource_version = None
+                else:
+                    logger.exception(f'Unexpected K8 error while watching {self.kind}')
+                    # callers fall back to the API until we're back in sync
+                    self.synced = False
+                    self.resource_version = None
+                    await asyncio.sleep(5)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                # we lost the connection: carry on from where we were
+                logger.info(f'Disconnected while watching {self.kind}: {ex}')
+                await asyncio.sleep(5)
+            except Exception:
+                logger.exception(f'Unexpected error while watching {self.kind}')
+                self.synced = False
+                self.resource_version = None
+                await asyncio.sleep(5)
+
+    def start(self):
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def stats(self) -> dict:
+        return dict(synced=self.synced,
+                    relists=self.relists,
+                    events=self.events)
+
+
+class Informer(ResumableWatch):
+    """
+    Keeps a local copy of every object of one kind in our namespace, indexed by name and by the
+    labels we select on. Until it's synced, callers should fall back to the API.
+    """
+
+    def __init__(self, kind: str, get_list_func: Callable[[], Callable], **list_kwargs):
+        super().__init__(kind, get_list_func, **list_kwargs)
+        self.objects: dict[str, dict] = {}
+        self.index: dict[tuple[str, str], set[str]] = defaultdict(set)
+        self.handlers: list[Callable[[str, dict], None]] = []
+
+    def add_handler(self, handler: Callable[[str, dict], None]):
+        """
+        Register a callback for every change, called with the event type and the object
+        """
+        self.handlers.append(handler)
+
+    def get(self, name: str) -> dict | None:
+        return self.objects.get(name)
+
+    def find(self, **labels) -> list[dict]:
+        """
+        Return all objects with the specified (indexed) label values
+        """
+        names = None
+        for label, value in labels.items():
+            matches = self.index.get((label, str(value)), set())
+            names = matches if names is None else names & matches
+        return [self.objects[name] for name in names or ()]
+
+    def _unindex(self, obj: dict):
+        name = get_name(obj)
+        for label, value in get_labels(obj).items():
+            if label in INDEX_LABELS:
+                names = self.index.get((label, value))
+                if names:
+                    names.discard(name)
+                    if not names:
+                        del self.index[(label, value)]
+
+    def apply(self, event_type: str, obj: dict):
+        name = get_name(obj)
+        existing = self.objects.get(name)
+        if existing:
+            self._unindex(existing)
+        if event_type == 'DELETED':
+            self.objects.pop(name, None)
+        else:
+            # managed fields are by far the largest part of the metadata, and we never look at them
+            obj['metadata'].pop('managedFields', None)
+            self.objects[name] = obj
+            for label, value in get_labels(obj).items():
+                if label in INDEX_LABELS:
+                    self.index[(label, value)].add(name)
+        for handler in self.handlers:
+            try:
+                handler(event_type, obj)
+            except Exception:
+                logger.exception(f'Unexpected error in {self.kind} informer handler')
+
+    async def on_list(self, items: list[dict]):
+        current = {get_name(obj): obj for obj in items}
+        for name in set(self.objects.keys()) - set(current.keys()):
+            self.apply('DELETED', self.objects[name])
+        for obj in current.values():
+            self.apply('MODIFIED' if get_name(obj) in self.objects else 'ADDED', obj)
+
+    async def on_event(self, event_type: str, obj: dict):
+        self.apply(event_type, obj)
+
+    def stats(self) -> dict:
+        return dict(objects=len(self.objects), **super().stats())
+
+
+def is_snapshot_ready(obj: dict) -> bool:
+    status = obj.get('status')
+    return bool(status and status.get('readyToUse') is True)
+
+
+class SnapshotWaiter(object):
+    """
+    Waits for volume snapshots to be ready to use. Rather than opening a watch per snapshot,
+    all waiters share the snapshot informer's watch, which resolves the futures by name.
+    """
+    def __init__(self, informer: Informer):
+        self.informer = informer
+        self.waiters: dict[str, list[asyncio.Future]] = defaultdict(list)
+        self.errors: dict[str, str] = {}
+        informer.add_handler(self.on_event)
+
+    def on_event(self, event_type: str, obj: dict):
+        name = get_name(obj)
+        futures = self.waiters.get(name)
+        if not futures:
+            return
+        if event_type == 'DELETED':
+            for fut in futures:
+                if not fut.done():
+                    fut.set_exception(BuildFailedException(f'Snapshot {name} was deleted while waiting for it'))
+        elif is_snapshot_ready(obj):
+            logger.debug(f'Snapshot {name} is ready to use')
+            created = parse_time(obj['metadata'].get('creationTimestamp'))
+            if created:
+                SNAPSHOT_READY_SECONDS.observe((utcnow() - created).total_seconds())
+            for fut in futures:
+                if not fut.done():
+                    fut.set_result(obj)
+        else:
+            # errors may be transient (the CSI driver will retry), so just remember the latest
+            error = (obj.get('status') or {}).get('error')
+            if error and error.get('message'):
+                logger.debug(f'  snapshot {name} error: {error["message"]}')
+                self.errors[name] = error['message']
+
+    async def wait(self, name: str, timeout: int, testrun_id: int = None) -> dict:
+        obj = self.informer.get(name)
+        if obj and is_snapshot_ready(obj):
+            return obj
+        self.informer.start()
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters[name].append(fut)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            msg = f'Timed out after {timeout}s waiting for snapshot {name} to be ready'
+            if name in self.errors:
+                msg += f': {self.errors[name]}'
+            raise BuildFailedException(msg=msg, testrun_id=testrun_id)
+        finally:
+            self.waiters[name].remove(fut)
+            if not self.waiters[name]:
+                del self.waiters[name]
+                self.errors.pop(name, None)
+
+
+snapshot_informer = Informer('volumesnapshots', lambda: get_custom_api().list_namespaced_custom_object,
+                             group="snapshot.storage.k8s.io",
+                             version="v1beta1",
+                             plural="volumesnapshots")
+pvc_informer = Informer('persistentvolumeclaims', lambda: get_core_api().list_namespaced_persistent_volume_claim)
+job_informer = Informer('jobs', lambda: get_batch_api().list_namespaced_job)
+
+INFORMERS = [snapshot_informer, pvc_informer, job_informer]
+
+
+snapshot_waiter = SnapshotWaiter(snapshot_informer)
+
+
+def start_informers() -> list[asyncio.Task]:
+    return [informer.start() for informer in INFORMERS]
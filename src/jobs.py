@@ -2,6 +2,7 @@ import asyncio
 import datetime
 import tempfile
 
+from kubernetes_asyncio.client import ApiException
 from loguru import logger
 
 from app import app
@@ -12,10 +13,20 @@ from common.exceptions import BuildFailedException
 from common.k8common import get_batch_api
 from common.schemas import TestRunBuildState, get_build_snapshot_name
 from common.utils import utcnow, get_lock_hash
+from gitcache import mirror_cache, cache_key_index
+from informers import job_informer
 from k8utils import async_get_snapshot, async_delete_pvc, async_delete_job, create_k8_objects, create_k8_snapshot, \
-    wait_for_snapshot_ready, render_template, async_delete_snapshot
+    wait_for_snapshot_ready, render_template, async_delete_snapshot, gather_bounded
+from metrics import Histogram, k8_call, SLOW_BUCKETS
+from nodecache import node_cache
+from pvcpool import pvc_pool
 from settings import settings
 from state import notify_build_completed, save_build_state
+from taskgraph import TaskGraph
+from tracing import tracer
+
+CACHE_KEY_SECONDS = Histogram('cykubed_cache_key_seconds', 'Time to calculate the node cache key for a commit',
+                              ('source',), buckets=SLOW_BUCKETS)
 
 
 def get_spot_config(spot_percentage: int) -> str:
@@ -69,6 +80,28 @@ async def get_cached_snapshot(key: str):
 
 
 async def get_cache_key(testrun: schemas.NewTestRun) -> str:
+    """
+    The cache key only depends on the commit, so reruns and concurrent runs on the same sha
+    can reuse (or share) a previous calculation
+    """
+    return await cache_key_index.get(testrun.url, testrun.sha, lambda: calculate_cache_key(testrun))
+
+
+async def calculate_cache_key(testrun: schemas.NewTestRun) -> str:
+    """
+    Read the yarn.lock or package-lock.json file from our local mirror of the repository
+    """
+    if settings.GIT_MIRROR_CACHE_SIZE:
+        logger.info('Fetching lock file to determine cache key', trid=testrun.id)
+        with CACHE_KEY_SECONDS.time(source='mirror'):
+            k = await mirror_cache.get_lock_hash(testrun.url, testrun.branch, testrun.sha)
+        logger.debug(f'Cache key is {k}')
+        return k
+    with CACHE_KEY_SECONDS.time(source='clone'):
+        return await get_cache_key_from_sparse_clone(testrun)
+
+
+async def get_cache_key_from_sparse_clone(testrun: schemas.NewTestRun) -> str:
     """
     Perform a sparse checkout to get a yarn.lock or package-lock.json file
     """
@@ -100,6 +133,7 @@ def create_rw_pvc_name(testrun: schemas.NewTestRun):
     return create_pvc_name(testrun, 'rw')
 
 
+@tracer.traced('start')
 async def handle_new_run(testrun: schemas.NewTestRun):
     """
     If there is already a built distribution PVC then go straight to creating the runners.
@@ -122,13 +156,14 @@ async def handle_new_run(testrun: schemas.NewTestRun):
                                      snapshot_name=state.build_snapshot_name,
                                      pvc_name=state.ro_build_pvc)
             await create_k8_objects('pvc', context)
-            await save_build_state(state)
+            await save_build_state(state, flush=True)
 
         await notify_build_completed(state)
     else:
         await create_build_job(testrun)
 
 
+@tracer.traced('create_build_job')
 async def create_build_job(testrun: schemas.NewTestRun):
     """
     Create the build Job. We first perform a shallow clone to determine if we've already cached the node modules
@@ -138,82 +173,134 @@ async def create_build_job(testrun: schemas.NewTestRun):
     logger.info(f'Create build job for testrun {testrun.local_id}', trid=testrun.id)
     # First check to see if there is a node cache for this build
     # Perform a sparse checkout to check for the lock file
-    cache_key = await get_cache_key(testrun)
+    with tracer.span('cache_key'):
+        cache_key = await get_cache_key(testrun)
     node_snapshot_name = f'{testrun.project.organisation_id}-node-{cache_key}'
-    cached_node_item = await get_cached_snapshot(node_snapshot_name)
+    with tracer.span('node_cache_lookup'):
+        cached_node_item = await get_cached_snapshot(node_snapshot_name)
+    node_cache.record_lookup(node_snapshot_name, cached_node_item is not None)
 
-    # we need a RW PVC for the build
+    # we need a RW PVC for the build: use a warm one (already restored from the node snapshot) if there is one
     state = testrun.buildstate
-    state.rw_build_pvc = create_rw_pvc_name(testrun)
+    warm_pvc = None
+    if cached_node_item:
+        warm_pvc = await pvc_pool.acquire(testrun, cached_node_item.name, testrun.project.build_storage)
+    state.rw_build_pvc = warm_pvc or create_rw_pvc_name(testrun)
     state.cache_key = cache_key
     await save_build_state(state)
 
     context = common_context(testrun,
                              pvc_name=state.rw_build_pvc)
-    if context['preprovision']:
-        logger.debug('Create pre-provision job')
-        state.preprovision_job = await create_k8_objects('pre-provision', context)
+    preprovision = context['preprovision']
 
     # base it on the node cache if we have one
     if cached_node_item:
         state.node_snapshot_name = context['snapshot_name'] = cached_node_item.name
 
-    await create_k8_objects('pvc', context)
-    # and create the build job
-    context['job_name'] = f'{testrun.project.organisation_id}-builder-{testrun.project.name}-{testrun.local_id}'
+    build_context = dict(context,
+                         job_name=f'{testrun.project.organisation_id}-builder-{testrun.project.name}-{testrun.local_id}')
     if testrun.spot_percentage > 0:
         # all or nothing for the build
-        context['spot'] = get_spot_config(100)
-    state.build_job = await create_k8_objects('build', context)
-    await save_build_state(state)
+        build_context['spot'] = get_spot_config(100)
+
+    # the pre-provision job is independent of the rest. The build job waits for its PVC though: otherwise
+    # the build pod may be found unschedulable and put into the scheduler's backoff
+    graph = TaskGraph('create build job')
+    if warm_pvc:
+        async def claimed_pvc():
+            # it's ours now, so it mustn't be left behind if the build can't be created
+            return warm_pvc
+        graph.add('rw_pvc', claimed_pvc, rollback=async_delete_pvc)
+    else:
+        graph.add('rw_pvc', lambda: create_k8_objects('pvc', context), rollback=async_delete_pvc)
+    graph.add('build_job', lambda: create_k8_objects('build', build_context), after=['rw_pvc'],
+              rollback=async_delete_job)
+    if cached_node_item and node_cache.enabled:
+        graph.add('touch_node_snapshot', lambda: node_cache.touch(cached_node_item.name))
+    if preprovision:
+        logger.debug('Create pre-provision job')
+        graph.add('preprovision_job', lambda: create_k8_objects('pre-provision', context), rollback=async_delete_job)
+    results = await graph.run()
+    state.build_job = results['build_job']
+    if preprovision:
+        state.preprovision_job = results['preprovision_job']
+    await save_build_state(state, flush=True)
     await app.update_status(testrun.id, 'building')
 
 
+@tracer.traced('build_completed')
 async def handle_build_completed(testrun: schemas.NewTestRun):
     """
     Build is completed: create PVCs and snapshots
     """
     logger.info(f'Build completed', trid=testrun.id)
 
-    # create a snapshot from the build PVC
     st = testrun.buildstate
-    if st.preprovision_job:
-        logger.debug('Delete pre-provision job')
-        await async_delete_job(st.preprovision_job)
-
     context = common_context(testrun)
 
-    if not st.build_snapshot_name:
+    async def create_build_snapshot():
+        # create a snapshot from the build PVC
         st.build_snapshot_name = get_build_snapshot_name(testrun)
-        context.update(snapshot_name=st.build_snapshot_name,
-                       pvc_name=st.rw_build_pvc)
-
         logger.info(f'Create build snapshot', trid=testrun.id)
-        await create_k8_snapshot('pvc-snapshot', context)
+        await create_k8_snapshot('pvc-snapshot', dict(context,
+                                                      snapshot_name=st.build_snapshot_name,
+                                                      pvc_name=st.rw_build_pvc))
         # this could take some time: save the state
-        await save_build_state(st)
-        await wait_for_snapshot_ready(st.build_snapshot_name)
+        await save_build_state(st, flush=True)
+        with tracer.span('build_snapshot_wait'):
+            await wait_for_snapshot_ready(st.build_snapshot_name, testrun.id)
         logger.info(f'Build snapshot created', trid=testrun.id)
-        logger.debug(f'Build snapshot created for {testrun.id}')
 
-    if not st.ro_build_pvc and use_read_only_pvc(testrun):
-        # create a RO PVC from this snapshot and a runner that uses it
+    async def create_ro_pvc():
+        # create a RO PVC from this snapshot for the runners to use
         st.ro_build_pvc = create_ro_pvc_name(testrun)
-        context.update(dict(pvc_name=st.ro_build_pvc,
-                            read_only=True))
-        await create_k8_objects('pvc', context)
-
-    logger.info(f'Build snapshot ready', trid=testrun.id)
-
-    # and create the runner job - this will save the state
-    await create_runner_job(testrun)
-
+        return await create_k8_objects('pvc', dict(context,
+                                                   snapshot_name=st.build_snapshot_name,
+                                                   pvc_name=st.ro_build_pvc,
+                                                   read_only=True))
+
+    async def delete_ro_pvc(name: str):
+        st.ro_build_pvc = None
+        await async_delete_pvc(name)
+
+    async def delete_job(attr: str):
+        name = getattr(st, attr)
+        setattr(st, attr, None)
+        if name:
+            await async_delete_job(name)
+
+    async def create_prepare_cache_job():
+        try:
+            await prepare_cache_wait(testrun)
+        except Exception:
+            # the node cache is just an optimisation: don't fail (and roll back) the run for it
+            logger.exception('Failed to create the prepare cache job', trid=testrun.id)
+
+    # the runner (which needs the RO PVC, if there is one) and the prepare cache job can be created
+    # at the same time, once the build snapshot is ready
+    graph = TaskGraph('build completed')
+    snapshot = []
+    if st.preprovision_job:
+        logger.debug('Delete pre-provision job')
+        graph.add('delete_preprovision_job', lambda: async_delete_job(st.preprovision_job))
+    if not st.build_snapshot_name:
+        graph.add('build_snapshot', create_build_snapshot)
+        snapshot = ['build_snapshot']
+    runner_after = snapshot
+    if not st.ro_build_pvc and use_read_only_pvc(testrun):
+        graph.add('ro_pvc', create_ro_pvc, after=snapshot, rollback=delete_ro_pvc)
+        runner_after = ['ro_pvc']
+    graph.add('runner_job', lambda: create_runner_job(testrun), after=runner_after,
+              rollback=lambda _: delete_job('run_job'))
     if not st.node_snapshot_name and st.rw_build_pvc:
-        await prepare_cache_wait(testrun)
+        graph.add('prepare_cache_job', create_prepare_cache_job, after=snapshot,
+                  rollback=lambda _: delete_job('prepare_cache_job'))
+    await graph.run()
 
-    await save_build_state(testrun.buildstate)
+    await save_build_state(st, flush=True)
 
 
+@tracer.traced('prepare_cache')
 async def prepare_cache_wait(testrun: schemas.NewTestRun):
     """
     Prepare the cache volume with the prepare job (which simply moved the cacheable folders into root and
@@ -233,6 +320,7 @@ async def prepare_cache_wait(testrun: schemas.NewTestRun):
     testrun.buildstate.prepare_cache_job = name
 
 
+@tracer.traced('cache_prepared')
 async def handle_cache_prepared(testrun: schemas.NewTestRun):
     """
     Create a snapshot from the RW PVC
@@ -247,16 +335,18 @@ async def handle_cache_prepared(testrun: schemas.NewTestRun):
                              pvc_name=state.rw_build_pvc)
     await create_k8_snapshot('pvc-snapshot', context)
 
-    await save_build_state(state)
+    await save_build_state(state, flush=True)
 
     # wait for the snashot
-    await wait_for_snapshot_ready(name)
+    with tracer.span('node_snapshot_wait'):
+        await wait_for_snapshot_ready(name, testrun_id)
 
     # NOW we can delete the RW PVC
     logger.info(f'Node cache snapshot created: delete build PVC', trid=testrun_id)
     await async_delete_pvc(state.rw_build_pvc)
 
 
+@tracer.traced('create_runner_job')
 async def create_runner_job(testrun: schemas.NewTestRun):
     # next create the runner job: limit the parallism as there's no point having more runners than specs
     context = common_context(testrun)
@@ -279,13 +369,16 @@ async def handle_run_completed(testrun: schemas.NewTestRun):
     logger.info(f'Run {testrun.id} completed')
 
     if settings.DELETE_JOBS_AFTER_RUN:
-        await delete_pvcs(testrun.buildstate)
-        await delete_jobs(testrun.buildstate)
+        with tracer.span('cleanup', testrun.id):
+            await delete_pvcs(testrun.buildstate)
+            await delete_jobs(testrun.buildstate)
+
+    await tracer.send_summary(testrun.id)
 
 
-async def delete_testrun_job(job, trid: int = None):
-    logger.info(f"Deleting existing job {job.metadata.name}", trid=trid)
-    await async_delete_job(job.metadata.name)
+async def delete_testrun_job(name: str, trid: int = None):
+    logger.info(f"Deleting existing job {name}", trid=trid)
+    await async_delete_job(name)
     # just in case the test run failed and didn't clean up, do it here
     # FIXME notify the server that this testrun was cancelled
     r = await app.httpclient.post(f'/agent/testrun/{trid}/cancelled')
@@ -293,26 +386,34 @@ async def delete_testrun_job(job, trid: int = None):
         logger.error(f'Failed to notify server of cancellation of run {trid}: {r.status_code}, {r.text}')
 
 
+async def find_job_names(**labels) -> list[str]:
+    """
+    Find jobs by label, from the local index if we have one
+    """
+    if job_informer.synced:
+        return [job['metadata']['name'] for job in job_informer.find(**labels)]
+    selector = ','.join(f'{k}={v}' for k, v in labels.items())
+    jobs = await k8_call('list_jobs', get_batch_api().list_namespaced_job(settings.NAMESPACE, label_selector=selector))
+    return [job.metadata.name for job in jobs.items]
+
+
 async def delete_jobs_for_branch(testrun: schemas.NewTestRun):
     if settings.K8:
         # delete any job already running
-        api = get_batch_api()
-        jobs = await api.list_namespaced_job(settings.NAMESPACE,
-                                             label_selector=f'project_id={testrun.project.id},branch={testrun.branch}')
-        if jobs.items:
-            logger.info(f'Found {len(jobs.items)} existing Jobs - deleting them')
+        names = await find_job_names(project_id=testrun.project.id, branch=testrun.branch)
+        if names:
+            logger.info(f'Found {len(names)} existing Jobs - deleting them')
             # delete it (there should just be one, but iterate anyway)
-            for job in jobs.items:
-                await delete_testrun_job(job, testrun.id)
+            for name in names:
+                await delete_testrun_job(name, testrun.id)
 
 
 async def delete_jobs_for_project(project_id):
-    api = get_batch_api()
-    jobs = await api.list_namespaced_job(settings.NAMESPACE, label_selector=f'project_id={project_id}')
-    if jobs.items:
-        logger.info(f'Found {len(jobs.items)} existing Jobs - deleting them')
-        for job in jobs.items:
-            await delete_testrun_job(job)
+    names = await find_job_names(project_id=project_id)
+    if names:
+        logger.info(f'Found {len(names)} existing Jobs - deleting them')
+        for name in names:
+            await delete_testrun_job(name)
 
 
 async def delete_pvcs(state: TestRunBuildState, cancelling=False):
@@ -339,14 +440,39 @@ async def recreate_runner_job(tr: schemas.NewTestRun):
     await async_delete_job(tr.buildstate.run_job)
     # and create a new one
     await create_runner_job(tr)
-    await save_build_state(tr.buildstate)
+    await save_build_state(tr.buildstate, flush=True)
+
+
+def describe_error(ex: Exception) -> str:
+    """
+    A short reason for a failed K8 call: an ApiException's str is a dump of the whole response
+    """
+    api_ex = ex if isinstance(ex, ApiException) else ex.__context__
+    if isinstance(api_ex, ApiException):
+        return f'{api_ex.status} {api_ex.reason}'
+    return getattr(ex, 'msg', None) or str(ex) or type(ex).__name__
 
 
 async def handle_delete_build_states(buildstates: list[TestRunBuildState]):
-    for buildstate in buildstates:
-        await delete_jobs(buildstate)
-        await delete_pvcs(buildstate, True)
-        if buildstate.build_snapshot_name:
-            await async_delete_snapshot(buildstate.build_snapshot_name)
-        if buildstate.node_snapshot_name:
-            await async_delete_snapshot(buildstate.node_snapshot_name)
+    """
+    Delete all the K8 objects for these build states, concurrently. Jobs go first so nothing is still
+    using the volumes. Failures don't stop the other deletes: they're reported together at the end
+    """
+    # (kind, name, delete)
+    jobs = []
+    volumes = []
+    for state in buildstates:
+        jobs += [('job', name, async_delete_job)
+                 for name in (state.preprovision_job, state.build_job, state.run_job) if name]
+        volumes += [('PVC', name, async_delete_pvc) for name in (state.rw_build_pvc, state.ro_build_pvc) if name]
+        volumes += [('snapshot', name, async_delete_snapshot)
+                    for name in (state.build_snapshot_name, state.node_snapshot_name) if name]
+    logger.info(f'Deleting {len(jobs)} jobs and {len(volumes)} volumes for {len(buildstates)} testruns')
+    errors = []
+    for deletes in (jobs, volumes):
+        results = await gather_bounded([delete(name) for _, name, delete in deletes],
+                                       settings.MAX_CONCURRENT_DELETES, return_exceptions=True)
+        errors += [f'{kind} {name}: {describe_error(ex)}'
+                   for (kind, name, _), ex in zip(deletes, results) if isinstance(ex, Exception)]
+    if errors:
+        raise BuildFailedException(f'Failed to delete {len(errors)} objects:\n' + '\n'.join(errors))
@@ -1,4 +1,6 @@
+import asyncio
 import os
+from typing import Awaitable, Iterable
 
 import chevron
 import yaml
@@ -10,15 +12,26 @@ from yaml import YAMLError
 
 from common.exceptions import BuildFailedException, InvalidTemplateException
 from common.k8common import get_batch_api, get_custom_api, get_core_api, get_client
+from informers import pvc_informer, snapshot_informer, snapshot_waiter
+from metrics import Histogram, k8_call
 from settings import settings
+from templates import CompiledTemplate, NotCompilable
 
 template_cache=dict()
+compiled_template_cache=dict()
+
+TEMPLATE_RENDER_SECONDS = Histogram('cykubed_template_render_seconds', 'Time to render a job template',
+                                    ('template',))
 
 
 async def async_get_pvc(pvc_name: str) -> bool:
     # check if the PVC exists
+    pvc = pvc_informer.get(pvc_name) if pvc_informer.synced else None
+    if pvc:
+        return pvc
     try:
-        return await get_core_api().read_namespaced_persistent_volume_claim(pvc_name, settings.NAMESPACE)
+        return await k8_call('read_pvc',
+                             get_core_api().read_namespaced_persistent_volume_claim(pvc_name, settings.NAMESPACE))
     except ApiException as ex:
         if ex.status == 404:
             return False
@@ -29,11 +42,12 @@ async def async_get_pvc(pvc_name: str) -> bool:
 async def async_delete_snapshot(name: str):
     try:
         logger.debug(f'Delete snapshot {name}')
-        await get_custom_api().delete_namespaced_custom_object(group="snapshot.storage.k8s.io",
-                                                    version="v1beta1",
-                                                    namespace=settings.NAMESPACE,
-                                                    plural="volumesnapshots",
-                                                    name=name)
+        await k8_call('delete_snapshot',
+                      get_custom_api().delete_namespaced_custom_object(group="snapshot.storage.k8s.io",
+                                                                       version="v1beta1",
+                                                                       namespace=settings.NAMESPACE,
+                                                                       plural="volumesnapshots",
+                                                                       name=name))
     except ApiException as ex:
         if ex.status == 404:
             # already deleted - ignore
@@ -44,20 +58,38 @@ async def async_delete_snapshot(name: str):
 
 
 async def async_create_snapshot(yamlobjects):
-    await get_custom_api().create_namespaced_custom_object(group="snapshot.storage.k8s.io",
-                                                     version="v1",
-                                                     namespace=settings.NAMESPACE,
-                                                     plural="volumesnapshots",
-                                                     body=yamlobjects)
+    await k8_call('create_snapshot',
+                  get_custom_api().create_namespaced_custom_object(group="snapshot.storage.k8s.io",
+                                                                   version="v1",
+                                                                   namespace=settings.NAMESPACE,
+                                                                   plural="volumesnapshots",
+                                                                   body=yamlobjects))
+
+
+async def async_annotate_snapshot(name: str, annotations: dict):
+    # a dict body would otherwise be sent as a JSON patch, which this isn't
+    await k8_call('patch_snapshot',
+                  get_custom_api().patch_namespaced_custom_object(group="snapshot.storage.k8s.io",
+                                                                  version="v1beta1",
+                                                                  namespace=settings.NAMESPACE,
+                                                                  plural="volumesnapshots",
+                                                                  name=name,
+                                                                  body=dict(metadata=dict(annotations=annotations)),
+                                                                  _content_type='application/merge-patch+json'))
 
 
 async def async_get_snapshot(name: str):
+    # we may not have seen a snapshot we've only just created, so only trust positive lookups
+    snapshot = snapshot_informer.get(name) if snapshot_informer.synced else None
+    if snapshot:
+        return snapshot
     try:
-        return await get_custom_api().get_namespaced_custom_object(group="snapshot.storage.k8s.io",
-                                            version="v1beta1",
-                                            namespace=settings.NAMESPACE,
-                                            plural="volumesnapshots",
-                                            name=name)
+        return await k8_call('read_snapshot',
+                             get_custom_api().get_namespaced_custom_object(group="snapshot.storage.k8s.io",
+                                                                           version="v1beta1",
+                                                                           namespace=settings.NAMESPACE,
+                                                                           plural="volumesnapshots",
+                                                                           name=name))
     except ApiException as ex:
         if ex.status == 404:
             return False
@@ -68,7 +100,8 @@ async def async_get_snapshot(name: str):
 async def async_get_job_status(name: str) -> V1JobStatus:
     api = get_batch_api()
     try:
-        job = await api.read_namespaced_job_status(name=name, namespace=settings.NAMESPACE)
+        job = await k8_call('read_job_status',
+                            api.read_namespaced_job_status(name=name, namespace=settings.NAMESPACE))
         return job.status
     except ApiException as ex:
         if ex.status != 404:
@@ -83,7 +116,8 @@ async def async_get_job_status(name: str) -> V1JobStatus:
 
 async def async_delete_pvc(name: str):
     try:
-        await get_core_api().delete_namespaced_persistent_volume_claim(name, settings.NAMESPACE)
+        await k8_call('delete_pvc',
+                      get_core_api().delete_namespaced_persistent_volume_claim(name, settings.NAMESPACE))
     except ApiException as ex:
         if ex.status != 404:
             logger.exception('Failed to delete PVC')
@@ -91,8 +125,9 @@ async def async_delete_pvc(name: str):
 
 async def async_delete_job(name: str):
     try:
-        await get_batch_api().delete_namespaced_job(name, settings.NAMESPACE,
-                                                    propagation_policy='Background')
+        await k8_call('delete_job',
+                      get_batch_api().delete_namespaced_job(name, settings.NAMESPACE,
+                                                            propagation_policy='Background'))
     except ApiException as ex:
         if ex.status == 404:
             return
@@ -100,6 +135,19 @@ async def async_delete_job(name: str):
             logger.error(f'Failed to delete job {name}')
 
 
+async def gather_bounded(aws: Iterable[Awaitable], limit: int, return_exceptions=False) -> list:
+    """
+    Like asyncio.gather, but with at most limit awaitables running at once
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[run(aw) for aw in aws], return_exceptions=return_exceptions)
+
+
 #
 # async def test_wait():
 #     await init()
@@ -112,9 +160,10 @@ async def async_delete_job(name: str):
 
 
 async def create_from_dict(data: dict):
-    await k8utils.create_from_dict(get_client(),
-                                   data,
-                                   namespace=settings.NAMESPACE)
+    await k8_call(f'create_{data["kind"].lower()}',
+                  k8utils.create_from_dict(get_client(),
+                                           data,
+                                           namespace=settings.NAMESPACE))
 
 
 async def create_k8_objects(jobtype, context) -> str:
@@ -143,7 +192,11 @@ def render_template(jobtype, context) -> str:
 
 
 def render_yaml_template(jobtype, context) -> list:
-    return list(yaml.safe_load_all(render_template(jobtype, context)))
+    with TEMPLATE_RENDER_SECONDS.time(template=jobtype):
+        try:
+            return get_compiled_template(jobtype).render(context)
+        except NotCompilable:
+            return list(yaml.safe_load_all(render_template(jobtype, context)))
 
 
 async def create_k8_snapshot(jobtype, context):
@@ -191,6 +244,29 @@ def get_job_template(name: str) -> str:
     return t
 
 
+def get_compiled_template(name: str) -> CompiledTemplate:
+    t = compiled_template_cache.get(name)
+    if not t:
+        t = compiled_template_cache[name] = CompiledTemplate(name, get_job_template(name))
+    return t
+
+
+def load_templates():
+    """
+    Compile all the job templates up front, so a broken template fails at startup rather than
+    in the middle of a run
+    """
+    for name in os.listdir(TEMPLATES_DIR):
+        if name.endswith('.mustache'):
+            jobtype = name[:-len('.mustache')]
+            try:
+                get_compiled_template(jobtype).validate()
+            except YAMLError as ex:
+                raise InvalidTemplateException(f'Invalid YAML in {jobtype} template: {ex}')
+            except ChevronError as ex:
+                raise InvalidTemplateException(f'Invalid {jobtype} template: {ex}')
+
+
 def get_template_path(name: str) -> str:
     return os.path.join(TEMPLATES_DIR, f'{name}.mustache')
 
@@ -201,30 +277,20 @@ TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'k8config', 'templates')
 async def wait_for_pvc_ready(pvc_name: str):
     v1 = get_core_api()
     logger.info(f'Wait for PVC {pvc_name} to be bound')
-    async with watch.Watch().stream(v1.list_namespaced_persistent_volume_claim,
+    async with watch.Watch(return_type='object').stream(v1.list_namespaced_persistent_volume_claim,
                                     field_selector=f"metadata.name={pvc_name}",
                                     namespace=settings.NAMESPACE, timeout_seconds=300) as stream:
         async for event in stream:
             pvcobj = event['object']
-            if pvcobj.status.phase == 'Bound':
+            if (pvcobj.get('status') or {}).get('phase') == 'Bound':
                 logger.debug(f'PVC {pvc_name} is bound')
                 return
 
 
-async def wait_for_snapshot_ready(name: str):
-    v1 = get_custom_api()
+async def wait_for_snapshot_ready(name: str, testrun_id: int = None,
+                                  timeout: int = settings.SNAPSHOT_READY_TIMEOUT):
+    """
+    Wait for a snapshot to be ready to use, raising a BuildFailedException if it takes too long
+    """
     logger.info(f'Wait for snapshot {name} to be ready to use')
-    async with watch.Watch().stream(v1.list_namespaced_custom_object,
-                                    group="snapshot.storage.k8s.io",
-                                    version="v1beta1",
-                                    plural="volumesnapshots",
-                                    field_selector=f"metadata.name={name}",
-                                    namespace=settings.NAMESPACE, timeout_seconds=300) as stream:
-        async for event in stream:
-            pvcobj = event['object']
-            status = pvcobj.get('status')
-            logger.debug(f'  snapshot status: {status}')
-            if status and status.get('readyToUse') is True:
-                logger.debug(f'Snapshot {name} is ready to use')
-                return
-    logger.debug('Return from wait')
+    await snapshot_waiter.wait(name, timeout, testrun_id)
@@ -0,0 +1,189 @@
+import asyncio
+import time
+from typing import Awaitable, Callable
+
+from kubernetes_asyncio.client import ApiException, CoordinationV1Api, V1Lease, V1LeaseSpec, V1ObjectMeta
+from loguru import logger
+
+from app import app
+from common.k8common import get_client
+from common.utils import utcnow
+from metrics import Counter, Gauge, k8_call
+from settings import settings
+
+LEASE_RENEWALS = Counter('cykubed_leader_lease_renewals_total', 'Attempts to acquire or renew the leader lease',
+                         ('result',))
+LEADER_TRANSITIONS = Counter('cykubed_leader_transitions_total', 'Times this replica became the leader')
+
+
+def get_coordination_api() -> CoordinationV1Api:
+    return CoordinationV1Api(get_client())
+
+
+class LeaderElector(object):
+    """
+    Leader election using a coordination.k8s.io Lease, following the same rules as client-go:
+    the leader renews the lease every retry period, and another replica takes over once the lease
+    hasn't been renewed for its full duration. Expiry is judged by when *we* last saw the lease
+    change, so clock skew between nodes doesn't matter. Updates are conditional on the
+    resourceVersion, so only one replica can win a race.
+
+    The leader runs the lead function until it loses the lease (i.e it couldn't renew it within
+    the renew deadline). A leader that shuts down releases the lease, so another replica can take
+    over straight away rather than waiting for it to expire.
+    """
+    def __init__(self, name: str, identity: str,
+                 lease_duration: int, renew_deadline: float, retry_period: float,
+                 get_api: Callable[[], CoordinationV1Api] = get_coordination_api):
+        self.name = name
+        self.identity = identity
+        self.lease_duration = lease_duration
+        self.renew_deadline = renew_deadline
+        self.retry_period = retry_period
+        self.get_api = get_api
+        self.is_leader = False
+        self.holder = None
+        self.last_renewed = 0.0
+        # the last version of the lease we saw, and when we saw it change
+        self.observed_version = None
+        self.observed_at = 0.0
+        # consecutive times the lead function has failed soon after starting
+        self.failures = 0
+
+    async def try_acquire_or_renew(self) -> bool:
+        api = self.get_api()
+        now = utcnow()
+        try:
+            lease = await k8_call('read_lease', api.read_namespaced_lease(self.name, settings.NAMESPACE))
+        except ApiException as ex:
+            if ex.status != 404:
+                raise
+            lease = V1Lease(metadata=V1ObjectMeta(name=self.name, namespace=settings.NAMESPACE),
+                            spec=V1LeaseSpec(holder_identity=self.identity,
+                                             lease_duration_seconds=self.lease_duration,
+                                             acquire_time=now,
+                                             renew_time=now,
+                                             lease_transitions=0))
+            try:
+                await k8_call('create_lease', api.create_namespaced_lease(settings.NAMESPACE, lease))
+            except ApiException as ex:
+                if ex.status == 409:
+                    # someone else created it first
+                    return False
+                raise
+            self.holder = self.identity
+            return True
+
+        spec = lease.spec
+        if lease.metadata.resource_version != self.observed_version:
+            self.observed_version = lease.metadata.resource_version
+            self.observed_at = time.monotonic()
+        self.holder = spec.holder_identity
+
+        held_by_other = spec.holder_identity and spec.holder_identity != self.identity
+        if held_by_other and time.monotonic() - self.observed_at < (spec.lease_duration_seconds or self.lease_duration):
+            return False
+
+        if spec.holder_identity != self.identity:
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.holder_identity = self.identity
+        spec.lease_duration_seconds = self.lease_duration
+        spec.renew_time = now
+        try:
+            # this will fail with a conflict if anyone else has updated it since we read it
+            lease = await k8_call('replace_lease', api.replace_namespaced_lease(self.name, settings.NAMESPACE, lease))
+        except ApiException as ex:
+            if ex.status == 409:
+                return False
+            raise
+        self.observed_version = lease.metadata.resource_version
+        self.observed_at = time.monotonic()
+        self.holder = self.identity
+        return True
+
+    async def release(self):
+        """
+        Give up the lease (if we still hold it), so another replica can take over immediately
+        """
+        api = self.get_api()
+        try:
+            lease = await k8_call('read_lease', api.read_namespaced_lease(self.name, settings.NAMESPACE))
+            if lease.spec.holder_identity != self.identity:
+                return
+            lease.spec.holder_identity = None
+            lease.spec.lease_duration_seconds = 1
+            await k8_call('replace_lease', api.replace_namespaced_lease(self.name, settings.NAMESPACE, lease))
+            logger.info('Released the leader lease')
+        except ApiException as ex:
+            logger.warning(f'Failed to release the leader lease: {ex.status} {ex.reason}')
+
+    async def renew(self) -> bool:
+        try:
+            renewed = await self.try_acquire_or_renew()
+        except Exception as ex:
+            logger.warning(f'Failed to acquire or renew the leader lease: {ex}')
+            renewed = False
+        LEASE_RENEWALS.inc(result='success' if renewed else 'failure')
+        if renewed:
+            self.last_renewed = time.monotonic()
+        return renewed
+
+    def get_backoff(self) -> float:
+        # a lease duration (so another replica can take over) doubling with each consecutive failure
+        return min(self.lease_duration * 2 ** (self.failures - 1), self.lease_duration * 16)
+
+    async def run(self, lead: Callable[[], Awaitable]):
+        task = None
+        started = 0.0
+        try:
+            while app.is_running():
+                renewed = await self.renew()
+                if renewed and not self.is_leader:
+                    logger.info(f'{self.identity} is now the leader')
+                    self.is_leader = True
+                    LEADER_TRANSITIONS.inc()
+                    task = asyncio.create_task(lead())
+                    started = time.monotonic()
+                elif self.is_leader and not renewed and time.monotonic() - self.last_renewed > self.renew_deadline:
+                    logger.warning(f'{self.identity} lost the leader lease')
+                    self.is_leader = False
+                    task.cancel()
+                    task = None
+                elif task and task.done():
+                    # the leader's work should run until we lose the lease: give it up
+                    ex = None if task.cancelled() else task.exception()
+                    logger.opt(exception=ex).error('Leader tasks exited unexpectedly: releasing the lease')
+                    self.is_leader = False
+                    task = None
+                    await self.release()
+                    if time.monotonic() - started > self.lease_duration * 2:
+                        # it ran for a while, so this isn't a repeat of the same failure
+                        self.failures = 0
+                    self.failures += 1
+                    # don't restart it straight away
+                    backoff = self.get_backoff()
+                    logger.info(f'Waiting {backoff}s before trying to lead again')
+                    await asyncio.sleep(backoff)
+                # renew well within the lease, and keep trying at the retry period to catch an expiry
+                await asyncio.sleep(self.retry_period)
+        finally:
+            if task:
+                task.cancel()
+            if self.is_leader:
+                self.is_leader = False
+                await self.release()
+
+    def stats(self) -> dict:
+        return dict(identity=self.identity,
+                    leader=self.is_leader,
+                    holder=self.holder,
+                    since_renewed=round(time.monotonic() - self.last_renewed, 1) if self.last_renewed else None)
+
+
+elector = LeaderElector(settings.LEADER_LEASE_NAME, app.hostname,
+                        settings.LEADER_LEASE_DURATION,
+                        settings.LEADER_RENEW_DEADLINE,
+                        settings.LEADER_RETRY_PERIOD)
+
+Gauge('cykubed_leader', 'Whether this replica is the leader', func=lambda: int(elector.is_leader))
@@ -1,7 +1,14 @@
 from __future__ import annotations
 
 import asyncio
+import gzip
+import json
 import logging
+import os
+import time
+from asyncio import QueueEmpty
+from collections import deque, defaultdict
+from typing import AsyncIterable
 
 import loguru
 from loguru import logger
@@ -10,8 +17,305 @@ from app import app
 from common import schemas
 from common.enums import AgentEventType
 from common.schemas import AppLogMessage
+from metrics import Counter, Gauge
+from settings import settings
 
-msgqueue = asyncio.Queue()
+OVERFLOW_POLICIES = ('spill', 'drop_oldest', 'sample')
+
+
+class LogQueue(object):
+    """
+    Bounded queue of serialised log messages. When full, messages overflow according to the policy:
+
+    - spill: append them to a local file, which is replayed in order once the queue drains.
+      While there is anything in the spill file all new messages go there too, to preserve ordering.
+      Spilled messages are written in batches of spill_write_size bytes through a file kept open,
+      as spilling happens just when we're busiest. The file only survives a restart if it's on a
+      volume that does
+    - drop_oldest: drop the oldest message in the queue
+    - sample: only keep one in every LOG_SAMPLE_RATE messages per testrun (dropping the oldest)
+    """
+    def __init__(self, maxsize: int, policy: str, spill_path: str = None,
+                 spill_max_bytes: int = 0, sample_rate: int = 10, spill_write_size: int = 64 * 1024):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Invalid log overflow policy {policy}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_path = spill_path
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_write_size = spill_write_size
+        self.sample_rate = sample_rate
+        self.items = deque()
+        self.not_empty = asyncio.Event()
+        self.dropped = 0
+        self.spilled = 0
+        self.spill_offset = 0
+        self.spill_size = 0
+        # spilled lines not yet written, and the file they're appended to
+        self.spill_buffer: list[bytes] = []
+        self.spill_buffered = 0
+        self.spill_file = None
+        self.sample_counts = defaultdict(int)
+        if policy == 'spill' and os.path.exists(spill_path):
+            # replay anything left over from before a restart
+            with open(spill_path, 'rb') as f:
+                self.spilled = sum(1 for _ in f)
+                self.spill_size = f.tell()
+            if self.spilled:
+                self.not_empty.set()
+
+    def qsize(self) -> int:
+        return len(self.items) + self.spilled
+
+    def put_nowait(self, item: str):
+        if self.spilled or len(self.items) >= self.maxsize:
+            self.overflow(item)
+        else:
+            self.items.append(item)
+            self.not_empty.set()
+
+    def requeue(self, items: list[str]):
+        """
+        Put back messages that couldn't be sent, so they go first next time
+        """
+        if items:
+            self.items.extendleft(reversed(items))
+            self.not_empty.set()
+
+    def overflow(self, item: str):
+        if self.policy == 'spill':
+            line = (json.dumps(item) + '\n').encode()
+            if self.spill_size + len(line) > self.spill_max_bytes:
+                self.dropped += 1
+                return
+            self.spill_buffer.append(line)
+            self.spill_buffered += len(line)
+            self.spill_size += len(line)
+            self.spilled += 1
+            if self.spill_buffered >= self.spill_write_size:
+                self.write_spill()
+            self.not_empty.set()
+            return
+
+        if self.policy == 'sample':
+            try:
+                trid = json.loads(item).get('testrun_id')
+            except (ValueError, AttributeError):
+                trid = None
+            self.sample_counts[trid] += 1
+            if (self.sample_counts[trid] - 1) % self.sample_rate:
+                self.dropped += 1
+                return
+
+        self.items.popleft()
+        self.dropped += 1
+        self.items.append(item)
+
+    def write_spill(self):
+        """
+        Append the buffered spilled messages to the file
+        """
+        if not self.spill_buffer:
+            return
+        if not self.spill_file:
+            self.spill_file = open(self.spill_path, 'ab')
+        self.spill_file.write(b''.join(self.spill_buffer))
+        self.spill_file.flush()
+        self.spill_buffer = []
+        self.spill_buffered = 0
+
+    def load_spill(self):
+        """
+        Move the next chunk of spilled messages back into memory
+        """
+        self.write_spill()
+        with open(self.spill_path, 'rb') as f:
+            f.seek(self.spill_offset)
+            while self.spilled and len(self.items) < self.maxsize:
+                line = f.readline()
+                if not line:
+                    # the file has gone or been truncated under us
+                    self.spilled = 0
+                    break
+                self.items.append(json.loads(line))
+                self.spilled -= 1
+            self.spill_offset = f.tell()
+        if not self.spilled:
+            os.truncate(self.spill_path, 0)
+            self.spill_offset = self.spill_size = 0
+
+    def get_nowait(self) -> str:
+        if not self.items and self.spilled:
+            self.load_spill()
+        if not self.items:
+            self.not_empty.clear()
+            raise QueueEmpty()
+        if len(self.items) < self.maxsize:
+            self.sample_counts.clear()
+        return self.items.popleft()
+
+    async def get(self) -> str:
+        while True:
+            try:
+                return self.get_nowait()
+            except QueueEmpty:
+                await self.not_empty.wait()
+
+    def close(self):
+        """
+        Write out anything still buffered, so it's replayed after a restart
+        """
+        self.write_spill()
+        if self.spill_file:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def stats(self) -> dict:
+        return dict(queued=len(self.items),
+                    spilled=self.spilled,
+                    dropped=self.dropped)
+
+
+msgqueue = LogQueue(settings.LOG_QUEUE_SIZE, settings.LOG_OVERFLOW_POLICY,
+                    spill_path=settings.LOG_SPILL_FILE,
+                    spill_max_bytes=settings.LOG_SPILL_MAX_SIZE * 1024 * 1024,
+                    sample_rate=settings.LOG_SAMPLE_RATE)
+
+Gauge('cykubed_log_queue_depth', 'Log messages waiting to be sent (including any spilled to disk)',
+      func=lambda: msgqueue.qsize())
+Counter('cykubed_log_messages_dropped_total', 'Log messages dropped because the queue was full',
+        func=lambda: msgqueue.dropped)
+
+# log encodings we can offer the server: it replies with the subset it accepts
+LOG_ENCODINGS = ('batch', 'gzip')
+
+
+class ShippingStats(object):
+    """
+    Totals and recent rates for the log frames sent over the websocket
+    """
+    def __init__(self, window: int = 60):
+        self.window = window
+        self.frames = 0
+        self.messages = 0
+        self.bytes = 0
+        self.recent = deque()
+
+    def record(self, messages: int, size: int):
+        now = time.monotonic()
+        self.frames += 1
+        self.messages += messages
+        self.bytes += size
+        self.recent.append((now, size))
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+
+    def as_dict(self) -> dict:
+        now = time.monotonic()
+        recent = [size for ts, size in self.recent if ts >= now - self.window]
+        return dict(frames=self.frames,
+                    messages=self.messages,
+                    bytes=self.bytes,
+                    frames_per_sec=round(len(recent) / self.window, 2),
+                    bytes_per_sec=round(sum(recent) / self.window, 1))
+
+
+shipping_stats = ShippingStats()
+
+
+def parse_log_encodings(header: str | None) -> set[str]:
+    """
+    Parse the encodings accepted by the server. Older servers don't send the header at all,
+    in which case we send one message per frame
+    """
+    if not header:
+        return set()
+    return {x.strip() for x in header.split(',')} & set(LOG_ENCODINGS)
+
+
+def encoded_size(item: str) -> int:
+    # len() counts characters, and anything outside ASCII is more than one byte on the wire
+    return len(item) if item.isascii() else len(item.encode())
+
+
+async def get_batch(max_bytes: int = None, max_delay: float = None) -> list[str]:
+    """
+    Wait for the next message, and then keep collecting more until we either have max_bytes
+    or max_delay seconds have passed
+    """
+    max_bytes = max_bytes or settings.LOG_BATCH_MAX_BYTES
+    max_delay = settings.LOG_BATCH_MAX_DELAY if max_delay is None else max_delay
+    item = await msgqueue.get()
+    while not item:
+        item = await msgqueue.get()
+    batch = [item]
+    size = encoded_size(item)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_delay
+    try:
+        while size < max_bytes:
+            try:
+                item = msgqueue.get_nowait()
+            except QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(msgqueue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if item:
+                batch.append(item)
+                size += encoded_size(item)
+    except asyncio.CancelledError:
+        # don't lose what we've collected so far
+        msgqueue.requeue(batch)
+        raise
+    return batch
+
+
+def encode_batch(batch: list[str], compress: bool) -> str | bytes:
+    """
+    The messages are already serialised, so just join them into a JSON array
+    """
+    frame = '[' + ','.join(batch) + ']'
+    if compress:
+        return gzip.compress(frame.encode(), compresslevel=settings.LOG_COMPRESSION_LEVEL)
+    return frame
+
+
+class IngestionStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.messages = 0
+        self.bytes = 0
+
+    def as_dict(self) -> dict:
+        return dict(requests=self.requests,
+                    messages=self.messages,
+                    bytes=self.bytes)
+
+
+ingestion_stats = IngestionStats()
+
+
+async def ingest_logs(lines: AsyncIterable[bytes]) -> dict:
+    """
+    Feed newline-delimited (already serialised) log messages from runners and builders into
+    the queue. The stream is consumed as it arrives, so clients can keep a chunked upload open
+    """
+    ingestion_stats.requests += 1
+    accepted = 0
+    dropped = msgqueue.dropped
+    async for line in lines:
+        ingestion_stats.bytes += len(line)
+        line = line.strip()
+        if line:
+            msgqueue.put_nowait(line.decode())
+            accepted += 1
+    ingestion_stats.messages += accepted
+    return dict(accepted=accepted,
+                dropped=msgqueue.dropped - dropped)
 
 
 def without_keys(d, keys):
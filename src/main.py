@@ -1,6 +1,8 @@
 import argparse
 import asyncio
+import hmac
 import sys
+import time
 
 import sentry_sdk
 from aiohttp import web
@@ -8,6 +10,7 @@ from loguru import logger
 from sentry_sdk.integrations.asyncio import AsyncioIntegration
 
 import logs
+import metrics
 import ws
 from app import app
 from cache import delete_all_jobs, \
@@ -15,9 +18,23 @@ from cache import delete_all_jobs, \
 from common import k8common
 from common.cloudlogging import configure_stackdriver_logging
 from common.k8common import close
+from dispatcher import TESTRUN_COMMANDS
+from gitcache import cache_key_index
+from informers import start_informers, INFORMERS
+from k8utils import load_templates
+from leader import elector
 from logs import configure_logging
+from nodecache import node_cache
+from pvcpool import pvc_pool
+from metrics import Histogram
 from settings import settings
-from watchers import watch_pod_events, watch_job_events
+from sharding import shard_router
+from state import build_state_cache, build_state_writer
+from tracing import configure_tracing, tracer
+from watchers import watch_pod_events, watch_job_events, pod_duration_reporter, WATCHES
+
+EVENT_LOOP_LAG_SECONDS = Histogram('cykubed_event_loop_lag_seconds',
+                                   'How late the event loop was in waking a sleeping task')
 
 
 async def handler(request):
@@ -26,11 +43,53 @@ async def handler(request):
             return web.Response(status=500)
         return web.Response(text="OK")
 
+    if request.method == 'GET' and request.path == '/stats':
+        return web.json_response(dict(commands=ws.dispatcher.stats(),
+                                      cache_keys=cache_key_index.stats(),
+                                      build_states=dict(build_state_cache.stats(),
+                                                        writes=build_state_writer.stats()),
+                                      informers={i.kind: i.stats() for i in INFORMERS},
+                                      watches={w.kind: w.stats() for w in WATCHES},
+                                      logs=dict(logs.shipping_stats.as_dict(), **logs.msgqueue.stats()),
+                                      ingestion=logs.ingestion_stats.as_dict(),
+                                      pod_durations=pod_duration_reporter.stats(),
+                                      http=app.transport.stats(),
+                                      leader=elector.stats(),
+                                      sharding=shard_router.stats(),
+                                      pvc_pool=pvc_pool.stats(),
+                                      node_cache=node_cache.stats()))
+
+    if request.method == 'GET' and request.path == '/metrics':
+        return web.Response(body=metrics.REGISTRY.expose().encode(),
+                            headers={'Content-Type': metrics.CONTENT_TYPE})
+
+    if request.method == 'POST' and request.path == '/command':
+        # forwarded from the replica that received it, as we own the testrun
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {settings.API_TOKEN}'):
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict) or data.get('command') not in TESTRUN_COMMANDS:
+            # only commands for a single testrun are ever forwarded
+            return web.Response(status=400)
+        ws.dispatcher.submit(dict(data, forwarded=True))
+        return web.Response(status=202)
+
     if request.method == 'POST' and request.path == '/log':
         logpayload = (await request.content.read()).decode()
         logs.msgqueue.put_nowait(logpayload)
         return web.Response()
 
+    if request.method == 'POST' and request.path == '/logs':
+        # newline-delimited messages, optionally as a long-lived chunked upload
+        try:
+            return web.json_response(await logs.ingest_logs(request.content))
+        except ValueError as ex:
+            # a single line was too long
+            return web.json_response(dict(error=str(ex)), status=413)
+
 
 async def hc_server():
     server = web.Server(handler)
@@ -42,27 +101,78 @@ async def hc_server():
         await asyncio.sleep(60)
 
 
+async def monitor_event_loop(interval: float = 1):
+    """
+    A busy (or blocked) event loop delays every task: measure how much
+    """
+    while app.is_running():
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, time.monotonic() - start - interval))
+
+
+async def lead():
+    """
+    Watch pods and jobs, and manage the node cache and PVC pools: on the leader, or on every replica
+    (for the testruns and pools it owns) if sharded
+    """
+    aws = [watch_pod_events(), pod_duration_reporter.run(), watch_job_events()]
+    if node_cache.enabled:
+        aws.append(node_cache.run())
+    if pvc_pool.enabled:
+        aws.append(pvc_pool.run())
+    # if any of them fails, cancel the rest: once the lease is given up another replica takes over,
+    # so nothing may carry on here
+    async with asyncio.TaskGroup() as tg:
+        for aw in aws:
+            tg.create_task(aw)
+
+
+async def lead_shard():
+    # until we know who the other replicas are, we'd handle the events for every testrun
+    await shard_router.wait_until_synced()
+    logger.info('Agent replicas are known: start watching')
+    await lead()
+
+
 async def run():
     if not settings.TEST:
         await k8common.init()
 
+    load_templates()
+    configure_tracing()
+
     tasks = [asyncio.create_task(hc_server()),
-             asyncio.create_task(ws.connect())]
-    if app.hostname == 'agent-0':
-        tasks += [asyncio.create_task(watch_pod_events()),
-                  asyncio.create_task(watch_job_events()),
-                  ]
-    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-    # cancel the others
-    for task in pending:
-        task.cancel()
+             asyncio.create_task(monitor_event_loop()),
+             asyncio.create_task(ws.connect())] + start_informers()
+    if settings.SHARDING:
+        # every replica watches, for the testruns it owns
+        tasks += [shard_router.start(), asyncio.create_task(lead_shard())]
+    elif settings.LEADER_ELECTION:
+        tasks.append(asyncio.create_task(elector.run(lead)))
+    elif app.hostname == 'agent-0':
+        tasks.append(asyncio.create_task(lead()))
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # on SIGTERM we're cancelled while waiting, so clean up either way
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        # give them a chance to clean up, e.g release the leader lease
+        if pending:
+            await asyncio.wait(pending, timeout=5)
+        await build_state_writer.flush_all()
+        logs.msgqueue.close()
+        await shard_router.close()
+        await asyncio.to_thread(tracer.close)
 
 
 async def cleanup_pending_delete():
     await k8common.init()
+    # jobs first, so nothing is still using the volumes
     await delete_all_jobs()
-    await delete_all_pvcs()
-    await delete_all_volume_snapshots()
+    await asyncio.gather(delete_all_pvcs(), delete_all_volume_snapshots())
     await app.shutdown()
 
 
@@ -0,0 +1,173 @@
+"""
+A minimal implementation of Prometheus metrics, exposed in the text format on /metrics.
+
+Metrics are defined in the modules that update them, apart from the few updated from several
+modules, which are at the end of this one. Values that are already tracked elsewhere (e.g queue
+depths) can be read at scrape time by passing a function instead.
+"""
+import math
+import time
+from typing import Awaitable, Callable, Iterator
+
+from tracing import tracer
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# for things that involve the cloud provider, like clones and snapshots
+SLOW_BUCKETS = (.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_help(value) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n')
+
+
+def escape(value) -> str:
+    return escape_help(value).replace('"', r'\"')
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+
+
+class Metric(object):
+    type = 'untyped'
+    # the value of a metric without labels before it's first updated
+    initial = None
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), func: Callable = None,
+                 registry: 'Registry' = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.values = {}
+        if not self.labelnames and func is None and self.initial is not None:
+            self.values[()] = self.initial
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def key(self, labels: dict) -> tuple:
+        try:
+            if len(labels) == len(self.labelnames):
+                return tuple([str(labels[k]) for k in self.labelnames])
+        except KeyError:
+            pass
+        raise ValueError(f'{self.name} expects labels {self.labelnames}, not {tuple(labels)}')
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        if self.func:
+            yield self.name, {}, self.func()
+        for key, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+    def expose(self) -> str:
+        lines = [f'# HELP {self.name} {escape_help(self.documentation)}',
+                 f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+    initial = 0
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    initial = 0
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS, registry: 'Registry' = None):
+        super().__init__(name, documentation, labelnames, registry=registry)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            # per-bucket counts (cumulated on exposition), then the sum
+            counts = self.values[key] = [0] * len(self.buckets) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        counts[-1] += value
+
+    def time(self, **labels) -> 'Timer':
+        return Timer(self, labels)
+
+    def samples(self) -> Iterator[tuple[str, dict, float]]:
+        for key, counts in self.values.items():
+            labels = dict(zip(self.labelnames, key))
+            total = 0
+            for bound, n in zip(self.buckets, counts):
+                total += n
+                yield f'{self.name}_bucket', dict(labels, le=format_value(float(bound))), total
+            yield f'{self.name}_sum', labels, counts[-1]
+            yield f'{self.name}_count', labels, total
+
+
+class Timer(object):
+    """
+    Observes the time spent in a with block (this is on some hot paths, so it's cheaper
+    than a generator-based context manager)
+    """
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Duplicate metric {metric.name}')
+        self.metrics[metric.name] = metric
+
+    def expose(self) -> str:
+        return '\n'.join(m.expose() for m in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+K8_API_SECONDS = Histogram('cykubed_k8s_api_seconds', 'Latency of Kubernetes API calls', ('call',))
+
+
+async def k8_call(call: str, aw: Awaitable):
+    """
+    Await a Kubernetes API call, timing it (and tracing it, if it's part of a testrun)
+    """
+    with tracer.span(f'k8s.{call}'), K8_API_SECONDS.time(call=call):
+        return await aw
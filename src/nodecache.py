@@ -0,0 +1,210 @@
+import asyncio
+import datetime
+import re
+
+import httpx
+from loguru import logger
+
+from app import app
+from common.exceptions import BuildFailedException
+from common.utils import utcnow
+from informers import snapshot_informer, pvc_informer, job_informer, get_name, is_snapshot_ready
+from k8utils import async_annotate_snapshot, async_delete_snapshot
+from metrics import Counter, Gauge
+from records import parse_time
+from settings import settings
+from sharding import shard_router
+from state import build_state_cache
+
+# node snapshots are named {org}-node-{cache key}
+NODE_SNAPSHOT_NAME = re.compile(r'^\d+-node-')
+LAST_USED_ANNOTATION = 'cykubed.io/last-used'
+
+QUANTITY = re.compile(r'^([0-9.]+)([a-zA-Z]*)$')
+QUANTITY_SUFFIXES = {'': 1, 'k': 10**3, 'M': 10**6, 'G': 10**9, 'T': 10**12, 'P': 10**15,
+                     'Ki': 2**10, 'Mi': 2**20, 'Gi': 2**30, 'Ti': 2**40, 'Pi': 2**50}
+
+NODE_CACHE_LOOKUPS = Counter('cykubed_node_cache_lookups_total', 'Node cache lookups for new builds', ('result',))
+NODE_CACHE_EVICTIONS = Counter('cykubed_node_cache_evictions_total',
+                               'Node cache snapshots evicted to keep within the storage budget')
+
+
+def parse_quantity(value: str | None) -> int:
+    """
+    Parse a K8 storage quantity e.g 10Gi into bytes
+    """
+    if not value:
+        return 0
+    m = QUANTITY.match(str(value))
+    if not m or m.group(2) not in QUANTITY_SUFFIXES:
+        raise ValueError(f'Invalid quantity {value}')
+    return int(float(m.group(1)) * QUANTITY_SUFFIXES[m.group(2)])
+
+
+def get_snapshot_source(pvc: dict) -> str | None:
+    """
+    The snapshot a PVC was restored from, if any
+    """
+    source = (pvc.get('spec') or {}).get('dataSource') or {}
+    return source.get('name') if source.get('kind') == 'VolumeSnapshot' else None
+
+
+def is_job_finished(job: dict) -> bool:
+    conditions = (job.get('status') or {}).get('conditions') or []
+    return any(c.get('type') in ('Complete', 'Failed') and c.get('status') == 'True' for c in conditions)
+
+
+def get_claim_names(job: dict) -> list[str]:
+    volumes = (((job.get('spec') or {}).get('template') or {}).get('spec') or {}).get('volumes') or []
+    return [v['persistentVolumeClaim']['claimName'] for v in volumes if v.get('persistentVolumeClaim')]
+
+
+def get_restore_size(snapshot: dict) -> int:
+    try:
+        return parse_quantity((snapshot.get('status') or {}).get('restoreSize'))
+    except ValueError:
+        return 0
+
+
+class NodeCache(object):
+    """
+    Keeps the node cache snapshots within a storage budget, by evicting the least recently used.
+    The last use of each is recorded in an annotation on the snapshot (so it survives restarts), and
+    sizes come from the snapshots' restore sizes, as seen by the snapshot informer.
+
+    Snapshots aren't evicted while anything could still need them: i.e they're not ready yet, an
+    in-flight build was based on them (a job that's still running uses a PVC restored from them, on
+    any replica), a PVC is still being restored from them, or they've just been used (covering the
+    gap between a cache hit and its PVC being created). An evicted snapshot is
+    removed from the server's cache first, so no build is given it in the meantime.
+    """
+    def __init__(self, budget: int, grace: int, period: int):
+        # in bytes
+        self.budget = budget
+        self.grace = grace
+        self.period = period
+        self.last_used: dict[str, datetime.datetime] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def record_lookup(self, name: str, hit: bool):
+        NODE_CACHE_LOOKUPS.inc(result='hit' if hit else 'miss')
+        if hit:
+            self.hits += 1
+            self.last_used[name] = utcnow()
+        else:
+            self.misses += 1
+
+    async def touch(self, name: str):
+        """
+        Record the last use of a snapshot on the snapshot itself
+        """
+        now = self.last_used.setdefault(name, utcnow())
+        try:
+            await async_annotate_snapshot(name, {LAST_USED_ANNOTATION: now.isoformat()})
+        except Exception as ex:
+            # we'll still remember it locally
+            logger.warning(f'Failed to record the last use of snapshot {name}: {ex}')
+
+    def get_last_used(self, snapshot: dict) -> datetime.datetime | None:
+        metadata = snapshot['metadata']
+        times = [self.last_used.get(metadata['name']),
+                 parse_time((metadata.get('annotations') or {}).get(LAST_USED_ANNOTATION)),
+                 parse_time(metadata.get('creationTimestamp'))]
+        times = [t for t in times if t]
+        return max(times) if times else None
+
+    def snapshots(self) -> list[dict]:
+        return [obj for obj in snapshot_informer.objects.values()
+                if NODE_SNAPSHOT_NAME.match(get_name(obj)) and not obj['metadata'].get('deletionTimestamp')]
+
+    def in_use(self) -> set[str]:
+        # our own testruns, which may not have created their jobs yet
+        names = build_state_cache.node_snapshot_names()
+        for pvc in pvc_informer.objects.values():
+            source = get_snapshot_source(pvc)
+            if source and (pvc.get('status') or {}).get('phase') != 'Bound':
+                # still being restored
+                names.add(source)
+        # the builds (and prepare cache jobs) in flight across the namespace, whichever replica started them
+        for job in job_informer.objects.values():
+            if is_job_finished(job) or job['metadata'].get('deletionTimestamp'):
+                continue
+            for claim_name in get_claim_names(job):
+                pvc = pvc_informer.get(claim_name)
+                source = get_snapshot_source(pvc) if pvc else None
+                if source:
+                    names.add(source)
+        return names
+
+    def used(self) -> int:
+        return sum(get_restore_size(obj) for obj in self.snapshots())
+
+    async def enforce_budget(self):
+        if not snapshot_informer.synced or not pvc_informer.synced or not job_informer.synced:
+            return
+        snapshots = self.snapshots()
+        used = sum(get_restore_size(obj) for obj in snapshots)
+        if used <= self.budget:
+            return
+        in_use = self.in_use()
+        cutoff = utcnow() - datetime.timedelta(seconds=self.grace)
+        epoch = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        for obj in sorted(snapshots, key=lambda obj: self.get_last_used(obj) or epoch):
+            if used <= self.budget:
+                break
+            name = get_name(obj)
+            last_used = self.get_last_used(obj)
+            if name in in_use or not is_snapshot_ready(obj) or (last_used and last_used > cutoff):
+                continue
+            try:
+                await self.evict(name)
+            except (BuildFailedException, httpx.HTTPError) as ex:
+                logger.error(f'Failed to evict node snapshot {name}: {ex}')
+                continue
+            used -= get_restore_size(obj)
+        if used > self.budget:
+            logger.warning(f'Node cache uses {used // 2**20}MiB, over its budget of {self.budget // 2**20}MiB, '
+                           f'but the remaining snapshots are in use')
+
+    async def evict(self, name: str):
+        logger.info(f'Evict node snapshot {name}')
+        # stop the server handing it out first
+        r = await app.httpclient.delete(f'/agent/cached-item/{name}')
+        if r.status_code not in (200, 404):
+            raise BuildFailedException(f'Failed to delete cached item {name}: {r.status_code}')
+        await async_delete_snapshot(name)
+        self.last_used.pop(name, None)
+        self.evictions += 1
+        NODE_CACHE_EVICTIONS.inc()
+
+    async def run(self):
+        while app.is_running():
+            try:
+                # the budget is for the whole namespace, so if we're sharded only one replica enforces it
+                if shard_router.owns('node-cache', default=False):
+                    await self.enforce_budget()
+            except Exception:
+                logger.exception('Unexpected error while evicting node snapshots')
+            await asyncio.sleep(self.period)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(budget=self.budget,
+                    used=self.used(),
+                    snapshots=len(self.snapshots()),
+                    hits=self.hits,
+                    misses=self.misses,
+                    hit_rate=round(self.hits / lookups, 3) if lookups else None,
+                    evictions=self.evictions)
+
+
+node_cache = NodeCache(settings.NODE_CACHE_BUDGET * 2**30, settings.NODE_CACHE_EVICTION_GRACE,
+                       settings.NODE_CACHE_EVICTION_PERIOD)
+
+Gauge('cykubed_node_cache_bytes', 'Total restore size of the node cache snapshots', func=node_cache.used)
@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import secrets
+import time
+from collections import defaultdict, deque
+
+from cachetools import TTLCache
+from kubernetes_asyncio.client import ApiException, V1DeleteOptions, V1Preconditions
+from loguru import logger
+
+from app import app
+from common import schemas
+from common.k8common import get_core_api
+from common.utils import utcnow
+from informers import pvc_informer, get_labels, get_name
+from k8utils import create_k8_objects, async_get_snapshot
+from metrics import Counter, Gauge, k8_call
+from nodecache import NODE_SNAPSHOT_NAME, get_snapshot_source
+from records import parse_time
+from settings import settings
+from sharding import shard_router
+
+POOL_LABEL = 'cykubed_pool'
+
+POOL_CLAIMS = Counter('cykubed_pvc_pool_claims_total',
+                      'Node cache hits, by whether a warm PVC was taken from the pool', ('result',))
+
+
+def pool_key(snapshot_name: str) -> str:
+    # snapshot names can be longer than a label value is allowed to be
+    return hashlib.blake2b(snapshot_name.encode(), digest_size=16).hexdigest()
+
+
+def is_bound(pvc: dict) -> bool:
+    return (pvc.get('status') or {}).get('phase') == 'Bound'
+
+
+def get_age(pvc: dict) -> float:
+    created = parse_time(pvc['metadata'].get('creationTimestamp'))
+    return (utcnow() - created).total_seconds() if created else 0
+
+
+def get_storage(pvc: dict) -> str | None:
+    return ((pvc.get('spec') or {}).get('resources') or {}).get('requests', {}).get('storage')
+
+
+def is_pooled(pvc: dict) -> bool:
+    return POOL_LABEL in get_labels(pvc)
+
+
+class PoolDemand(object):
+    """
+    The recent cache-hit builds for one node snapshot, and what we need to restore PVCs from it
+    """
+    def __init__(self, snapshot_name: str, project_id: int, storage: int):
+        self.snapshot_name = snapshot_name
+        self.project_id = project_id
+        self.storage = storage
+        self.claims: deque[float] = deque()
+
+    def add(self):
+        self.claims.append(time.monotonic())
+
+    def recent(self, window: int) -> int:
+        cutoff = time.monotonic() - window
+        while self.claims and self.claims[0] < cutoff:
+            self.claims.popleft()
+        return len(self.claims)
+
+
+class PVCPool(object):
+    """
+    Restoring a PVC from a node cache snapshot can take a minute or more, so keep a few restored
+    already from each project's latest node snapshot, and hand one to a cache-hit build instead of
+    creating a new one. Each pool is sized by the recent demand for its snapshot (up to the
+    maximum size), and is topped up in the background. A project's old pool is dropped as soon as
+    it moves on to a new snapshot (i.e its lock file changed).
+
+    Pooled PVCs are labelled with their pool, and are found via the PVC informer. Any replica can
+    claim one by relabelling it for the testrun: the update is conditional on the resourceVersion,
+    so only one can win. Each pool is managed by a single replica: the leader, or the owner of the
+    pool key if sharded. Demand is counted from the PVC informer too (every build PVC restored from
+    a node snapshot, whether claimed from a pool or not), so every replica sees the demand from all
+    of them, and a pool whose manager has gone is simply taken over by the next one.
+    """
+    def __init__(self, size: int, window: int, refill_period: int):
+        self.size = size
+        self.window = window
+        self.refill_period = refill_period
+        # by pool key
+        self.demand: dict[str, PoolDemand] = {}
+        # the pool key of each project's latest snapshot
+        self.projects: dict[int, str] = {}
+        self.retired: set[str] = set()
+        # PVCs we've claimed, which the informer may not have caught up with yet
+        self.claimed: set[str] = set()
+        # the build PVCs we've already counted towards the demand
+        self.counted = TTLCache(maxsize=10000, ttl=window)
+        self.wakeup = asyncio.Event()
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.deleted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def track(self, project_id: int, snapshot_name: str, storage: int) -> str:
+        key = pool_key(snapshot_name)
+        previous = self.projects.get(project_id)
+        self.projects[project_id] = key
+        if previous and previous != key and previous not in self.projects.values():
+            # a new lock file: the old snapshot is no use to this project any more
+            self.demand.pop(previous, None)
+            self.retired.add(previous)
+        self.retired.discard(key)
+        demand = self.demand.get(key)
+        if not demand:
+            demand = self.demand[key] = PoolDemand(snapshot_name, project_id, storage)
+        demand.storage = storage
+        demand.add()
+        return key
+
+    def on_pvc_event(self, event_type: str, pvc: dict):
+        """
+        Count each build PVC restored from a node snapshot (by any replica) as demand for its pool
+        """
+        if not self.enabled or event_type == 'DELETED':
+            return
+        name = get_name(pvc)
+        labels = get_labels(pvc)
+        snapshot_name = get_snapshot_source(pvc)
+        storage = get_storage(pvc) or ''
+        if ('testrun_id' not in labels or name in self.counted or not snapshot_name
+                or not NODE_SNAPSHOT_NAME.match(snapshot_name) or not storage.endswith('Gi')):
+            return
+        self.counted[name] = True
+        key = self.track(int(labels['project_id']), snapshot_name, int(storage[:-2]))
+        if self.manages(key):
+            self.wakeup.set()
+
+    def manages(self, key: str) -> bool:
+        return shard_router.owns(key, default=False)
+
+    async def acquire(self, testrun: schemas.NewTestRun, snapshot_name: str, storage: int) -> str | None:
+        """
+        Take a PVC restored from this snapshot from its pool, if there is one. Either way, the build's
+        PVC counts towards the demand for the pool once the informer sees it
+        :return: the name of the PVC (now labelled for the testrun), or None
+        """
+        if not self.enabled:
+            return None
+        key = pool_key(snapshot_name)
+        if pvc_informer.synced:
+            candidates = [pvc for pvc in pvc_informer.find(cykubed_pool=key)
+                          if get_storage(pvc) == f'{storage}Gi' and self.is_available(pvc)]
+            # prefer those that have finished restoring, then the oldest
+            candidates.sort(key=lambda pvc: (not is_bound(pvc), -get_age(pvc)))
+            for pvc in candidates:
+                if await self.claim(pvc, testrun):
+                    self.hits += 1
+                    POOL_CLAIMS.inc(result='hit')
+                    return get_name(pvc)
+        self.misses += 1
+        POOL_CLAIMS.inc(result='miss')
+        return None
+
+    def is_available(self, pvc: dict) -> bool:
+        return not pvc['metadata'].get('deletionTimestamp') and get_name(pvc) not in self.claimed
+
+    async def claim(self, pvc: dict, testrun: schemas.NewTestRun) -> bool:
+        metadata = pvc['metadata']
+        labels = {POOL_LABEL: None,
+                  'sha': testrun.sha,
+                  'project_id': str(testrun.project.id),
+                  'local_id': str(testrun.local_id),
+                  'testrun_id': str(testrun.id),
+                  'branch': testrun.branch}
+        try:
+            await k8_call('patch_pvc',
+                          get_core_api().patch_namespaced_persistent_volume_claim(
+                              metadata['name'], settings.NAMESPACE,
+                              dict(metadata=dict(resourceVersion=metadata['resourceVersion'], labels=labels))))
+        except ApiException as ex:
+            if ex.status in (404, 409):
+                # another replica got there first
+                return False
+            raise
+        self.claimed.add(metadata['name'])
+        logger.info(f'Claimed warm PVC {metadata["name"]}', trid=testrun.id)
+        return True
+
+    async def create(self, key: str, demand: PoolDemand):
+        context = dict(pvc_name=f'{demand.snapshot_name[:200]}-pool-{secrets.token_hex(4)}',
+                       namespace=settings.NAMESPACE,
+                       storage_class=settings.PVC_POOL_STORAGE_CLASS or settings.STORAGE_CLASS,
+                       storage=demand.storage,
+                       snapshot_name=demand.snapshot_name,
+                       project=dict(id=demand.project_id),
+                       pool=key,
+                       testrun_id=None)
+        await create_k8_objects('pvc', context)
+        self.created += 1
+
+    async def delete(self, pvc: dict):
+        metadata = pvc['metadata']
+        # it may have been claimed since we last saw it
+        options = V1DeleteOptions(preconditions=V1Preconditions(resource_version=metadata['resourceVersion']))
+        try:
+            await k8_call('delete_pvc',
+                          get_core_api().delete_namespaced_persistent_volume_claim(metadata['name'],
+                                                                                   settings.NAMESPACE,
+                                                                                   body=options))
+        except ApiException as ex:
+            if ex.status not in (404, 409):
+                raise
+            return
+        self.deleted += 1
+
+    def pools(self) -> dict[str, list[dict]]:
+        """
+        The available pooled PVCs, by pool key
+        """
+        pools = defaultdict(list)
+        names = set()
+        for pvc in pvc_informer.objects.values():
+            if is_pooled(pvc):
+                names.add(get_name(pvc))
+                if self.is_available(pvc):
+                    pools[get_labels(pvc)[POOL_LABEL]].append(pvc)
+        # forget the claimed PVCs once the informer has seen them relabelled
+        self.claimed &= names
+        return pools
+
+    async def refill(self):
+        if not pvc_informer.synced:
+            return
+        pools = self.pools()
+        creates = []
+        surplus = []
+        for key in set(pools.keys()) | set(self.demand.keys()):
+            if not self.manages(key):
+                continue
+            pvcs = pools.get(key, [])
+            demand = self.demand.get(key)
+            if demand:
+                target = min(self.size, demand.recent(self.window))
+                if target == 0:
+                    # no recent demand
+                    del self.demand[key]
+                elif len(pvcs) < target and not await async_get_snapshot(demand.snapshot_name):
+                    logger.info(f'Node snapshot {demand.snapshot_name} has gone: drop its PVC pool')
+                    del self.demand[key]
+                    self.retired.add(key)
+                    target = 0
+                # the project's build storage may have changed
+                surplus += [pvc for pvc in pvcs if get_storage(pvc) != f'{demand.storage}Gi']
+                pvcs = [pvc for pvc in pvcs if get_storage(pvc) == f'{demand.storage}Gi']
+                # keep those that have finished restoring, then the oldest
+                pvcs.sort(key=lambda pvc: (not is_bound(pvc), -get_age(pvc)))
+                surplus += pvcs[target:]
+                creates += [self.create(key, demand) for _ in range(target - len(pvcs))]
+            elif key in self.retired:
+                surplus += pvcs
+            else:
+                # we've no record of the demand, e.g from before a restart: let them go once they'd have expired
+                surplus += [pvc for pvc in pvcs if get_age(pvc) > self.window]
+        self.retired &= set(pools.keys())
+
+        if creates or surplus:
+            logger.info(f'Refill PVC pools: create {len(creates)}, delete {len(surplus)}')
+        results = await asyncio.gather(*creates, *[self.delete(pvc) for pvc in surplus], return_exceptions=True)
+        for ex in results:
+            if isinstance(ex, Exception):
+                logger.error(f'Failed to refill PVC pool: {ex}')
+
+    async def run(self):
+        while app.is_running():
+            self.wakeup.clear()
+            try:
+                await self.refill()
+            except Exception:
+                logger.exception('Unexpected error while refilling the PVC pools')
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.refill_period)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return dict(enabled=self.enabled,
+                    pools={demand.snapshot_name: dict(demand=demand.recent(self.window),
+                                                      size=len(pvc_informer.find(cykubed_pool=key)))
+                           for key, demand in self.demand.items()},
+                    hits=self.hits,
+                    misses=self.misses,
+                    created=self.created,
+                    deleted=self.deleted)
+
+
+pvc_pool = PVCPool(settings.PVC_POOL_SIZE, settings.PVC_POOL_DEMAND_WINDOW, settings.PVC_POOL_REFILL_PERIOD)
+pvc_informer.add_handler(pvc_pool.on_pvc_event)
+
+Gauge('cykubed_pvc_pool_size', 'Warm PVCs in the pools managed by this replica',
+      func=lambda: sum(len(pvcs) for key, pvcs in pvc_pool.pools().items() if pvc_pool.manages(key)))
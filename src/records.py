@@ -0,0 +1,53 @@
+import datetime
+from dataclasses import dataclass
+
+
+def parse_time(value: str | None) -> datetime.datetime | None:
+    """
+    Parse a K8 (RFC 3339) timestamp e.g 2023-06-10T10:00:00Z
+    """
+    if not value:
+        return None
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+@dataclass(slots=True)
+class PodRecord:
+    """
+    Just the parts of a pod the watchers need, decoded straight from the raw JSON: a full V1Pod
+    model (with the entire spec) is far larger
+    """
+    name: str
+    uid: str
+    labels: dict[str, str]
+    annotations: dict[str, str]
+    phase: str | None
+    start_time: datetime.datetime | None
+
+    @classmethod
+    def from_dict(cls, obj: dict) -> 'PodRecord':
+        metadata = obj['metadata']
+        status = obj.get('status') or {}
+        return cls(name=metadata['name'],
+                   uid=metadata.get('uid'),
+                   labels=metadata.get('labels') or {},
+                   annotations=metadata.get('annotations') or {},
+                   phase=status.get('phase'),
+                   start_time=parse_time(status.get('startTime')))
+
+
+@dataclass(slots=True)
+class JobRecord:
+    name: str
+    labels: dict[str, str]
+    active: int
+    completion_time: datetime.datetime | None
+
+    @classmethod
+    def from_dict(cls, obj: dict) -> 'JobRecord':
+        metadata = obj['metadata']
+        status = obj.get('status') or {}
+        return cls(name=metadata['name'],
+                   labels=metadata.get('labels') or {},
+                   active=status.get('active') or 0,
+                   completion_time=parse_time(status.get('completionTime')))
@@ -34,13 +34,75 @@ class AgentSettings(BaseSettings):
 
     MAX_HTTP_RETRIES = 10
     MAX_HTTP_BACKOFF = 60
+    # initial retry delay (in seconds): it doubles with each attempt, up to MAX_HTTP_BACKOFF
+    HTTP_BACKOFF: float = 0.5
+    # keep-alive connection pool for the server API
+    HTTP_MAX_CONNECTIONS: int = 100
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    HTTP_KEEPALIVE_EXPIRY: float = 30
+    # multiplex requests over HTTP/2 (if the h2 package is installed)
+    HTTP2: bool = True
+    # stop calling the server for HTTP_CIRCUIT_RESET seconds after this many consecutive failures
+    HTTP_CIRCUIT_THRESHOLD: int = 5
+    HTTP_CIRCUIT_RESET: int = 30
 
     MESSAGE_POLL_PERIOD = 1
+    # log messages are batched into frames of (roughly) this size, or sent after this delay
+    LOG_BATCH_MAX_BYTES: int = 64 * 1024
+    LOG_BATCH_MAX_DELAY: float = 0.25
+    LOG_COMPRESSION_LEVEL: int = 6
+    # maximum number of log messages held in memory, and what to do with any more:
+    # 'spill' (to LOG_SPILL_FILE, up to LOG_SPILL_MAX_SIZE MB), 'drop_oldest' or 'sample'
+    # (keep 1 in LOG_SAMPLE_RATE messages per testrun)
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_OVERFLOW_POLICY: str = 'spill'
+    # spilled messages are only replayed after a restart if this is on a volume that outlives the container
+    LOG_SPILL_FILE: str = '/tmp/cykubed-logs.spill'
+    LOG_SPILL_MAX_SIZE: int = 256
+    LOG_SAMPLE_RATE: int = 10
+    # maximum number of websocket commands handled concurrently (across all testruns)
+    MAX_CONCURRENT_COMMANDS: int = 10
+    # maximum number of K8 objects deleted concurrently when a bulk delete isn't possible
+    MAX_CONCURRENT_DELETES: int = 20
 
     MAIN_API_URL: str = 'https://api.cykubed.com'
     # clean up testrun state after this time period (after the runner deadline)
     TESTRUN_STATE_TTL: int = 30 * 3600 # reduce this when I go to production!
+    # maximum number of build states cached in memory (they expire after TESTRUN_STATE_TTL)
+    BUILD_STATE_CACHE_SIZE: int = 1000
+    # build state saves are coalesced and written after this delay (in seconds), unless flushed
+    BUILD_STATE_SAVE_DELAY: float = 1.0
     JOB_TRACKER_PERIOD: int = 30
+    # finished pods' durations are posted at this interval (in seconds). Up to POD_DURATION_BUFFER_SIZE
+    # are held for retries, and finished pods are remembered for POD_DURATION_DEDUPE_TTL seconds
+    POD_DURATION_FLUSH_INTERVAL: int = 10
+    POD_DURATION_BUFFER_SIZE: int = 10000
+    POD_DURATION_DEDUPE_TTL: int = 6 * 3600
+    # the pod and job watchers run on one replica, elected using a Lease. The leader renews it every
+    # LEADER_RETRY_PERIOD seconds, and gives up leading if it can't for LEADER_RENEW_DEADLINE. Another
+    # replica takes over once the lease hasn't been renewed for LEADER_LEASE_DURATION
+    LEADER_ELECTION: bool = True
+    LEADER_LEASE_NAME: str = 'cykubed-agent-leader'
+    LEADER_LEASE_DURATION: int = 15
+    LEADER_RENEW_DEADLINE: float = 10
+    LEADER_RETRY_PERIOD: float = 2
+    # spread testruns across the agent replicas by consistent hashing (each replica gets SHARD_VNODES
+    # points on the ring). Commands are forwarded to the owning replica at AGENT_HOST_URL, and each
+    # replica watches pods and jobs for its own testruns, so leader election isn't needed
+    SHARDING: bool = False
+    SHARD_VNODES: int = 64
+    SHARD_FORWARD_TIMEOUT: float = 10
+    AGENT_HOST_URL: str = 'http://{hostname}.agent:9001'
+    # server-side timeout for watches: they resume from the last resource version
+    WATCH_TIMEOUT: int = 300
+    # fail the build if a volume snapshot isn't ready to use within this time
+    SNAPSHOT_READY_TIMEOUT: int = 600
+
+    # per-testrun timelines are kept (for up to TESTRUN_STATE_TTL) until the run completes. Spans can
+    # also be written to a file as JSON lines, or to an exporter created by a factory (module:name)
+    TRACE_MAX_TESTRUNS: int = 1000
+    TRACE_FILE: str = None
+    TRACE_EXPORTER: str = None
 
     SENTRY_DSN: str = None
 
@@ -48,6 +110,31 @@ class AgentSettings(BaseSettings):
 
     STORAGE_CLASS = 'cykubed'
 
+    # local bare mirrors used to read lock files when calculating the node cache key.
+    # Set the size (in MB) to 0 to fall back to a throwaway sparse clone
+    GIT_MIRROR_DIR: str = '/tmp/git-mirrors'
+    GIT_MIRROR_CACHE_SIZE: int = 512
+    # keep up to PVC_POOL_SIZE PVCs already restored from each project's latest node cache snapshot, ready to
+    # hand to a cache-hit build. Each pool is sized by the number of cache-hit builds (on any replica) in the
+    # last PVC_POOL_DEMAND_WINDOW seconds, and topped up every PVC_POOL_REFILL_PERIOD by a single replica. Pooled PVCs need a storage
+    # class that binds immediately: with WaitForFirstConsumer nothing is restored until a pod uses the PVC
+    PVC_POOL_SIZE: int = 0
+    PVC_POOL_DEMAND_WINDOW: int = 3600
+    PVC_POOL_REFILL_PERIOD: int = 30
+    PVC_POOL_STORAGE_CLASS: str = None
+
+    # keep the node cache snapshots within NODE_CACHE_BUDGET GiB (checked every NODE_CACHE_EVICTION_PERIOD
+    # seconds) by evicting the least recently used. Snapshots that in-flight builds depend on, or that were used
+    # in the last NODE_CACHE_EVICTION_GRACE seconds, are never evicted. 0 means no budget: they only expire
+    # on the server (after NODE_DISTRIBUTION_CACHE_TTL)
+    NODE_CACHE_BUDGET: int = 0
+    NODE_CACHE_EVICTION_PERIOD: int = 60
+    NODE_CACHE_EVICTION_GRACE: int = 600
+
+    # memoized cache keys per commit
+    CACHE_KEY_INDEX_SIZE: int = 1000
+    CACHE_KEY_INDEX_TTL: int = 24 * 3600
+
     @property
     def use_read_only_many(self):
         return self.PLATFORM in ['minikube', 'gke'] and self.READ_ONLY_MANY
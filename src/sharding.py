@@ -0,0 +1,157 @@
+import asyncio
+import bisect
+import hashlib
+import json
+from typing import Iterable
+
+import httpx
+from loguru import logger
+
+from app import app
+from common.k8common import get_core_api
+from dispatcher import get_testrun_id
+from informers import Informer, get_name
+from metrics import Counter, Gauge
+from settings import settings
+
+FORWARDED_COMMANDS = Counter('cykubed_forwarded_commands_total',
+                             'Commands forwarded to the replica that owns the testrun', ('result',))
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing(object):
+    """
+    Consistent hashing: each member owns the keys that hash to just before its points on the ring.
+    When a member joins or leaves, only the keys it gains or loses move.
+    """
+    def __init__(self, members: Iterable[str], vnodes: int):
+        self.members = tuple(sorted(set(members)))
+        points = sorted((hash_key(f'{member}#{i}'), member) for member in self.members for i in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [member for _, member in points]
+
+    def owner(self, key) -> str | None:
+        if not self.hashes:
+            return None
+        i = bisect.bisect(self.hashes, hash_key(str(key))) % len(self.hashes)
+        return self.owners[i]
+
+
+def is_pod_ready(pod: dict) -> bool:
+    if pod['metadata'].get('deletionTimestamp'):
+        # terminating: hand its testruns over now rather than when it's gone
+        return False
+    conditions = (pod.get('status') or {}).get('conditions') or []
+    return any(c.get('type') == 'Ready' and c.get('status') == 'True' for c in conditions)
+
+
+class ShardRouter(object):
+    """
+    Spreads testruns across the agent replicas. Every replica works out the owner of a testrun
+    the same way, by consistent hashing over the replicas that are ready (as seen by an informer on
+    the agent pods), so ownership rebalances as replicas come and go.
+
+    Commands for a testrun we don't own are forwarded to its owner, and the watchers ignore
+    events for testruns we don't own. Until we know who the replicas are, we handle the commands
+    we receive ourselves, but the watchers ignore everything (and don't start until then). Once
+    we've seen the replicas we keep using the last ring we knew, even if the informer has to
+    resync, so replicas never all act as the owner of everything.
+    """
+    def __init__(self, identity: str, informer: Informer, vnodes: int, enabled: bool):
+        self.identity = identity
+        self.informer = informer
+        self.vnodes = vnodes
+        self.enabled = enabled
+        self.ring = HashRing([], vnodes)
+        # whether the informer has ever synced, i.e the ring is complete
+        self.known = False
+        self.rebalances = 0
+        self.client = None
+        informer.add_handler(self.on_event)
+
+    def on_event(self, event_type: str, obj: dict):
+        members = [get_name(pod) for pod in self.informer.objects.values() if is_pod_ready(pod)]
+        if not members and self.ring.members:
+            # e.g none of us are ready just now: better a stale ring than none at all
+            logger.warning('No agent replicas are ready: keep the last known ring')
+            return
+        if set(members) != set(self.ring.members):
+            logger.info(f'Agent replicas are now {", ".join(sorted(members)) or "none"}: rebalance testruns')
+            self.ring = HashRing(members, self.vnodes)
+            self.rebalances += 1
+
+    def owner(self, testrun_id) -> str | None:
+        """
+        :return: the replica that owns the testrun, or None if we don't know
+        """
+        if not self.enabled:
+            return None
+        if self.informer.synced:
+            self.known = True
+        if not self.known:
+            return None
+        return self.ring.owner(testrun_id)
+
+    def owns(self, testrun_id, default: bool = True) -> bool:
+        """
+        :param default: what to assume if we don't know who the owner is yet
+        """
+        if not self.enabled:
+            return True
+        owner = self.owner(testrun_id)
+        return default if owner is None else owner == self.identity
+
+    async def forward(self, data: dict) -> bool:
+        """
+        Forward a command to the replica that owns its testrun
+        :return: True if it was forwarded, False if we should handle it ourselves
+        """
+        testrun_id = get_testrun_id(data)
+        if testrun_id is None or self.owns(testrun_id):
+            return False
+        owner = self.owner(testrun_id)
+        if not self.client:
+            self.client = httpx.AsyncClient(timeout=settings.SHARD_FORWARD_TIMEOUT)
+        url = settings.AGENT_HOST_URL.format(hostname=owner) + '/command'
+        try:
+            r = await self.client.post(url, content=json.dumps(data),
+                                       headers={'Authorization': f'Bearer {settings.API_TOKEN}'})
+            if r.status_code == 202:
+                FORWARDED_COMMANDS.inc(result='success')
+                logger.debug(f'Forwarded {data["command"]} command for testrun {testrun_id} to {owner}')
+                return True
+            logger.warning(f'Failed to forward command to {owner}: {r.status_code}')
+        except httpx.HTTPError as ex:
+            logger.warning(f'Failed to forward command to {owner}: {ex}')
+        # better that we handle it than nobody does
+        FORWARDED_COMMANDS.inc(result='failure')
+        return False
+
+    def start(self):
+        if self.enabled:
+            return self.informer.start()
+
+    async def wait_until_synced(self, interval: float = 1):
+        """
+        Wait until we know who the replicas are (and so which testruns we own)
+        """
+        while self.enabled and not self.informer.synced:
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+
+    def stats(self) -> dict:
+        return dict(enabled=self.enabled,
+                    members=list(self.ring.members),
+                    rebalances=self.rebalances)
+
+
+agent_informer = Informer('agents', lambda: get_core_api().list_namespaced_pod, label_selector='app=agent')
+shard_router = ShardRouter(app.hostname, agent_informer, settings.SHARD_VNODES, settings.SHARDING)
+
+Gauge('cykubed_shard_members', 'Agent replicas sharing the testruns', func=lambda: len(shard_router.ring.members))
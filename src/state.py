@@ -1,31 +1,234 @@
+import asyncio
 import json
 
+import httpx
+from cachetools import TTLCache
 from loguru import logger
 
 from app import app
 from common import schemas
 from common.exceptions import BuildFailedException
 from common.schemas import TestRunBuildState
+from settings import settings
 
+# bounds for the delay before retrying a failed debounced save
+MIN_RETRY_DELAY = 0.1
+MAX_RETRY_DELAY = 60
 
-async def save_build_state(state: TestRunBuildState):
-    resp = await app.httpclient.put(f'/agent/testrun/{state.testrun_id}/build-state',
-                        content=state.json())
-    if resp.status_code != 200:
-        raise BuildFailedException("Failed to save build state - bailing out")
 
+def copy_state(state: TestRunBuildState) -> TestRunBuildState:
+    # the list of specs is the only mutable field, so this is much cheaper than a deep copy
+    return state.copy(update=dict(specs=list(state.specs)))
+
+
+class BuildStateCache(object):
+    """
+    Write-through cache of build states by testrun id. It's populated from the states the server
+    sends us with each command and from every save, so reads rarely need to go to the server.
+    States are copied in and out, so callers can't change the cached copy without saving it.
+    """
+    def __init__(self, maxsize: int, ttl: int):
+        self.states = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, trid: int | str) -> TestRunBuildState | None:
+        state = self.states.get(int(trid))
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy_state(state)
+
+    def put(self, state: TestRunBuildState):
+        self.states[int(state.testrun_id)] = copy_state(state)
+
+    def remove(self, trid: int | str):
+        self.states.pop(int(trid), None)
+
+    def node_snapshot_names(self) -> set[str]:
+        """
+        The node snapshots that testruns still in progress were built from
+        """
+        return {state.node_snapshot_name for state in self.states.values()
+                if state.node_snapshot_name and not state.completed}
+
+    def stats(self) -> dict:
+        return dict(size=len(self.states),
+                    hits=self.hits,
+                    misses=self.misses)
+
+
+build_state_cache = BuildStateCache(settings.BUILD_STATE_CACHE_SIZE, settings.TESTRUN_STATE_TTL)
+
+
+class BuildStateRejected(BuildFailedException):
+    """
+    The server refused a build state (e.g the testrun has been deleted), so there's no point retrying it
+    """
+    pass
+
+
+def is_retryable(status_code: int) -> bool:
+    return status_code >= 500 or status_code in (408, 429)
+
+
+class BuildStateWriter(object):
+    """
+    Write-behind persistence of build states. Saves are debounced per testrun, so several in quick
+    succession become a single request, and nothing is sent if the state hasn't changed from the
+    server's copy. Callers flush wherever the server must be up to date before we carry on.
+    """
+    def __init__(self, delay: float, maxsize: int, ttl: int):
+        self.delay = delay
+        # the server's copy of each build state, as JSON once we've compared against it
+        self.persisted = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.locks = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.pending: dict[int, TestRunBuildState] = {}
+        self.timers: dict[int, asyncio.Task] = {}
+        self.saves = 0
+        self.requests = 0
+
+    def set_persisted(self, state: TestRunBuildState):
+        """
+        Record the state the server has (i.e that it sent us)
+        """
+        # most of these are never written back, so don't serialise it until we need to
+        self.persisted[int(state.testrun_id)] = copy_state(state)
+
+    async def save(self, state: TestRunBuildState, flush: bool = False):
+        trid = int(state.testrun_id)
+        self.saves += 1
+        self.pending[trid] = copy_state(state)
+        build_state_cache.put(state)
+        if flush:
+            await self.flush(trid)
+        elif trid not in self.timers:
+            self.timers[trid] = asyncio.create_task(self.flush_later(trid))
+
+    async def flush_later(self, trid: int, delay: float = None):
+        delay = self.delay if delay is None else delay
+        await asyncio.sleep(delay)
+        # we're committed to writing now, so we mustn't be cancelled by an explicit flush
+        self.timers.pop(trid, None)
+        try:
+            await self.flush(trid)
+        except BuildStateRejected as ex:
+            logger.error(f'Failed to save build state for testrun {trid}: {ex.msg}: giving up')
+        except (BuildFailedException, httpx.HTTPError) as ex:
+            # it's still pending: try again later (backing off), unless something else is already due to flush it
+            logger.error(f'Failed to save build state for testrun {trid}: {ex}')
+            if trid in self.pending and trid not in self.timers and app.is_running():
+                retry = min(max(delay * 2, MIN_RETRY_DELAY), MAX_RETRY_DELAY)
+                self.timers[trid] = asyncio.create_task(self.flush_later(trid, retry))
+
+    async def flush(self, trid: int):
+        timer = self.timers.pop(trid, None)
+        if timer:
+            timer.cancel()
+        lock = self.locks.get(trid)
+        if not lock:
+            lock = self.locks[trid] = asyncio.Lock()
+        async with lock:
+            state = self.pending.pop(trid, None)
+            if not state:
+                return
+            try:
+                await self.write(state)
+            except BuildStateRejected:
+                raise
+            except Exception:
+                # keep it for next time, unless there's already a newer one
+                self.pending.setdefault(trid, state)
+                raise
+
+    async def flush_all(self):
+        for trid in list(self.pending.keys()):
+            try:
+                await self.flush(trid)
+            except (BuildFailedException, httpx.HTTPError) as ex:
+                logger.error(f'Failed to save build state for testrun {trid}: {ex}')
+
+    async def write(self, state: TestRunBuildState):
+        trid = int(state.testrun_id)
+        current = state.json()
+        persisted = self.persisted.get(trid)
+        if isinstance(persisted, TestRunBuildState):
+            persisted = persisted.json()
+        if persisted == current:
+            return
+        self.requests += 1
+        resp = await app.httpclient.put(f'/agent/testrun/{trid}/build-state', content=current)
+        if resp.status_code != 200:
+            if not is_retryable(resp.status_code):
+                raise BuildStateRejected(f"Failed to save build state: {resp.status_code}")
+            raise BuildFailedException("Failed to save build state - bailing out")
+        self.persisted[trid] = current
+
+    def forget(self, trid: int):
+        """
+        Drop everything we have for a deleted testrun, so nothing is written for it afterwards
+        """
+        trid = int(trid)
+        timer = self.timers.pop(trid, None)
+        if timer:
+            timer.cancel()
+        self.pending.pop(trid, None)
+        self.persisted.pop(trid, None)
+        self.locks.pop(trid, None)
+
+    def stats(self) -> dict:
+        return dict(saves=self.saves,
+                    requests=self.requests,
+                    pending=len(self.pending))
+
+
+build_state_writer = BuildStateWriter(settings.BUILD_STATE_SAVE_DELAY,
+                                      settings.BUILD_STATE_CACHE_SIZE,
+                                      settings.TESTRUN_STATE_TTL)
+
+
+def remember_build_state(state: TestRunBuildState):
+    """
+    Remember a build state the server has sent us
+    """
+    build_state_cache.put(state)
+    build_state_writer.set_persisted(state)
+
+
+async def save_build_state(state: TestRunBuildState, flush: bool = False):
+    """
+    Save the build state. Unless flushed, it's written in the background shortly afterwards,
+    along with any later changes
+    """
+    await build_state_writer.save(state, flush)
 
 
 async def get_build_state(trid: int, check=False) -> TestRunBuildState:
+    state = build_state_cache.get(trid)
+    if state:
+        return state
+
     resp = await app.httpclient.get(f'/agent/testrun/{trid}/build-state')
     if resp.status_code == 200:
-        return TestRunBuildState.parse_raw(resp.text)
+        state = TestRunBuildState.parse_raw(resp.text)
+        build_state_cache.put(state)
+        return state
 
     if check:
         raise BuildFailedException("Missing state")
 
 
+def forget_build_state(trid: int):
+    """
+    Forget a deleted testrun's build state, including any save that's still pending
+    """
+    build_state_cache.remove(trid)
+    build_state_writer.forget(trid)
+
+
 async def delete_build_state(trid: int):
+    forget_build_state(trid)
     resp = await app.httpclient.delete(f'/agent/testrun/{trid}/build-state')
     if resp.status_code != 200:
         logger.error(f'Failed to delete build state: {resp.status_code}: {resp.text}')
@@ -0,0 +1,115 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Iterable
+
+from loguru import logger
+
+from tracing import tracer
+
+
+class SkippedStep(Exception):
+    """
+    A step that didn't run because a step it depends on failed
+    """
+
+
+class Step(object):
+    def __init__(self, name: str, func: Callable[[], Awaitable], after: tuple[str, ...],
+                 rollback: Callable[[Any], Awaitable] | None):
+        self.name = name
+        self.func = func
+        self.after = after
+        self.rollback = rollback
+
+
+class TaskGraph(object):
+    """
+    A small dependency graph of async steps (typically K8 API calls). Each step starts as soon as
+    the steps it depends on have finished, so independent calls overlap rather than each waiting
+    for a round trip. Steps must be added after the steps they depend on.
+
+    If any step fails, or the graph itself is cancelled, the steps still running are cancelled, any
+    that completed are rolled back (in the reverse order that they completed), and the first error
+    is raised. Steps with a rollback create something, so they're never cancelled part way: the API
+    server may already have carried out a cancelled call, leaving an object we'd know nothing about.
+    Once started they run to completion, and are then rolled back with the rest.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.steps: dict[str, Step] = {}
+
+    def add(self, name: str, func: Callable[[], Awaitable], after: Iterable[str] = (),
+            rollback: Callable[[Any], Awaitable] = None):
+        """
+        :param func: the step
+        :param after: the names of the steps this one depends on
+        :param rollback: called with the result of the step, to undo it
+        """
+        after = tuple(after)
+        for dep in after:
+            if dep not in self.steps:
+                raise ValueError(f'Step {name} depends on unknown step {dep}')
+        self.steps[name] = Step(name, func, after, rollback)
+
+    async def run(self) -> dict[str, Any]:
+        """
+        :return: the result of each step
+        """
+        tasks: dict[str, asyncio.Task] = {}
+        results: dict[str, Any] = {}
+        started: set[str] = set()
+        completed: list[str] = []
+        errors: list[BaseException] = []
+
+        async def run_step(step: Step):
+            deps = [tasks[dep] for dep in step.after]
+            if deps:
+                await asyncio.wait(deps)
+                if any(t.cancelled() or t.exception() for t in deps):
+                    raise SkippedStep(step.name)
+            started.add(step.name)
+            try:
+                with tracer.span(step.name):
+                    results[step.name] = await step.func()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                errors.append(ex)
+                raise
+            completed.append(step.name)
+
+        for step in self.steps.values():
+            tasks[step.name] = asyncio.create_task(run_step(step))
+
+        try:
+            await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+        except asyncio.CancelledError:
+            logger.info(f'{self.name} cancelled')
+            await self.stop(tasks, started, completed, results)
+            raise
+        if not errors:
+            # everything has finished
+            return results
+
+        await self.stop(tasks, started, completed, results)
+        raise errors[0]
+
+    async def stop(self, tasks: dict[str, asyncio.Task], started: set[str], completed: list[str],
+                   results: dict[str, Any]):
+        """
+        Cancel the steps that can be cancelled, wait for the rest, and roll back whatever completed
+        """
+        for name, task in tasks.items():
+            if not (name in started and self.steps[name].rollback):
+                task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        await self.rollback(completed, results)
+
+    async def rollback(self, completed: list[str], results: dict[str, Any]):
+        for name in reversed(completed):
+            step = self.steps[name]
+            if step.rollback:
+                logger.info(f'Rolling back {name} after {self.name} failed')
+                try:
+                    await step.rollback(results[name])
+                except Exception as ex:
+                    logger.error(f'Failed to roll back {name}: {ex}')
@@ -0,0 +1,211 @@
+import itertools
+import re
+from collections.abc import Callable, Sequence, Iterator
+
+import yaml
+from cachetools import LRUCache
+from chevron.renderer import _get_key, _html_escape
+from chevron.tokenizer import tokenize
+from yaml.nodes import MappingNode, SequenceNode, ScalarNode
+
+# variables are replaced with these markers when compiling. Private-use characters are valid
+# anywhere in a YAML scalar and won't appear in our templates
+SENTINEL = re.compile('\ue000(\\d+)\ue001')
+
+# values that can be substituted into a plain (unquoted) scalar without changing how the
+# document parses: anything else is rendered the slow way. A leading = is YAML's value key
+SAFE_PLAIN = re.compile(r'(?:[A-Za-z0-9_./+][A-Za-z0-9_./+=:-]*)?')
+SAFE_FLOW_PLAIN = re.compile(r'(?:[A-Za-z0-9_./+][A-Za-z0-9_./+=-]*)?')
+
+_loader = yaml.SafeLoader('')
+
+
+class NotCompilable(Exception):
+    """
+    The template (or this particular context) can't be rendered from a compiled form
+    """
+    pass
+
+
+def sentinel(index: int) -> str:
+    return f'\ue000{index}\ue001'
+
+
+class Leaf(object):
+    """
+    A scalar containing one or more variables
+    """
+    __slots__ = ('parts', 'style', 'flow')
+
+    def __init__(self, node: ScalarNode, flow: bool):
+        self.style = node.style
+        self.flow = flow
+        self.parts = [int(x) if i % 2 else x for i, x in enumerate(SENTINEL.split(node.value))]
+
+    def is_safe(self, value: str) -> bool:
+        if self.style is None:
+            if value.endswith(':'):
+                return False
+            return bool((SAFE_FLOW_PLAIN if self.flow else SAFE_PLAIN).fullmatch(value))
+        if self.style == '"':
+            return '\\' not in value and value.isprintable()
+        if self.style == "'":
+            return "'" not in value and value.isprintable()
+        # block scalars
+        return False
+
+    def build(self, values: list[str]):
+        text = []
+        for i, part in enumerate(self.parts):
+            if i % 2:
+                value = values[part]
+                if not self.is_safe(value):
+                    raise NotCompilable()
+                text.append(value)
+            else:
+                text.append(part)
+        text = ''.join(text)
+        if self.style is not None:
+            return text
+        # plain scalars are typed by their content, exactly as the YAML loader would do it
+        tag = _loader.resolve(ScalarNode, text, (True, False))
+        if tag not in _loader.yaml_constructors:
+            raise NotCompilable()
+        return _loader.yaml_constructors[tag](_loader, ScalarNode(tag, text))
+
+
+def has_sentinel(node) -> bool:
+    if isinstance(node, ScalarNode):
+        return SENTINEL.search(node.value) is not None
+    if isinstance(node, SequenceNode):
+        return any(has_sentinel(x) for x in node.value)
+    return any(has_sentinel(k) or has_sentinel(v) for k, v in node.value)
+
+
+def compile_node(node, flow=False):
+    """
+    Convert a composed YAML node into a build plan: constant subtrees are constructed once
+    """
+    if not has_sentinel(node):
+        return 'const', _loader.construct_object(node, deep=True)
+    if isinstance(node, ScalarNode):
+        if node.tag != 'tag:yaml.org,2002:str' and node.style is not None:
+            raise NotCompilable()
+        return 'leaf', Leaf(node, flow)
+    if isinstance(node, SequenceNode):
+        return 'seq', [compile_node(x, node.flow_style) for x in node.value]
+    if isinstance(node, MappingNode):
+        items = []
+        for k, v in node.value:
+            if has_sentinel(k):
+                raise NotCompilable()
+            items.append((_loader.construct_object(k, deep=True), compile_node(v, node.flow_style)))
+        return 'map', items
+    raise NotCompilable()
+
+
+def copy_const(value):
+    if isinstance(value, dict):
+        return {k: copy_const(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_const(v) for v in value]
+    return value
+
+
+def build(plan, values: list[str]):
+    kind, spec = plan
+    if kind == 'const':
+        return copy_const(spec)
+    if kind == 'leaf':
+        return spec.build(values)
+    if kind == 'seq':
+        return [build(x, values) for x in spec]
+    return {k: build(v, values) for k, v in spec}
+
+
+class CompiledTemplate(object):
+    """
+    A mustache template that renders straight to Kubernetes object dicts.
+
+    Rendering walks the tokens exactly as chevron does, but only to decide which sections are
+    included (and the contents of any unescaped variables, which can change the structure) and
+    to collect the (escaped) variable values. The YAML for each distinct structure is parsed
+    just once, into a plan with the variables as leaves. Variables are then substituted straight
+    into the objects, typed as the YAML loader would type them. Anything that could parse
+    differently (e.g. a value containing YAML syntax) is rendered the slow way instead,
+    so the output is always identical to rendering and then loading the YAML.
+    """
+    def __init__(self, name: str, template: str, max_structures: int = 64):
+        self.name = name
+        self.tokens = list(tokenize(template))
+        self.compilable = not any(tag == 'partial' for tag, key in self.tokens)
+        self.plans = LRUCache(maxsize=max_structures)
+
+    def walk(self, data, emit_text=False) -> tuple[tuple, list[str], str]:
+        """
+        Evaluate the template against the data with chevron's scoping rules
+        :return: the structure signature, the escaped variable values and (optionally) the
+        text with sentinels in place of the variables
+        """
+        scopes = [data]
+        signature = []
+        values = []
+        text = []
+        for tag, key in self.tokens:
+            current_scope = scopes[0]
+            if tag == 'end':
+                del scopes[0]
+            elif not current_scope and len(scopes) != 1:
+                if tag in ['section', 'inverted section']:
+                    scopes.insert(0, False)
+            elif tag == 'literal':
+                if emit_text:
+                    text.append(key)
+            elif tag == 'variable':
+                thing = _get_key(key, scopes)
+                if thing is True and key == '.':
+                    thing = scopes[1]
+                if emit_text:
+                    text.append(sentinel(len(values)))
+                values.append(_html_escape(thing if isinstance(thing, str) else str(thing)))
+            elif tag == 'no escape':
+                thing = _get_key(key, scopes)
+                thing = thing if isinstance(thing, str) else str(thing)
+                signature.append(thing)
+                if emit_text:
+                    text.append(thing)
+            elif tag == 'section':
+                scope = _get_key(key, scopes)
+                if isinstance(scope, Callable) or \
+                        (isinstance(scope, (Sequence, Iterator)) and not isinstance(scope, str)):
+                    raise NotCompilable()
+                scopes.insert(0, scope)
+                signature.append(bool(scope))
+            elif tag == 'inverted section':
+                scope = _get_key(key, scopes)
+                scopes.insert(0, not scope)
+                signature.append(not scope)
+        return tuple(signature), values, ''.join(text)
+
+    def compile(self, data) -> list:
+        signature, values, text = self.walk(data, emit_text=True)
+        return [compile_node(node) for node in yaml.compose_all(text, Loader=yaml.SafeLoader)]
+
+    def render(self, data) -> list:
+        if not self.compilable:
+            raise NotCompilable()
+        signature, values, text = self.walk(data)
+        plans = self.plans.get(signature)
+        if plans is None:
+            plans = self.plans[signature] = self.compile(data)
+        return [build(plan, values) for plan in plans]
+
+    def validate(self):
+        """
+        Check that every combination of (top-level) sections produces valid YAML
+        """
+        if not self.compilable:
+            return
+        keys = sorted({key for tag, key in self.tokens if tag in ('section', 'inverted section')})
+        for flags in itertools.product([False, True], repeat=len(keys)):
+            self.compile(dict(zip(keys, flags)))
@@ -0,0 +1,206 @@
+import functools
+import importlib
+import json
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Protocol
+
+import httpx
+from cachetools import TTLCache
+from loguru import logger
+
+from app import app
+from settings import settings
+
+
+@dataclass(slots=True)
+class Span:
+    name: str
+    testrun_id: int | None
+    # wall clock start time (epoch seconds) and duration in seconds
+    start: float
+    duration: float = 0.0
+    parent: str | None = None
+    error: str | None = None
+    attributes: dict = field(default_factory=dict)
+
+    def as_dict(self) -> dict:
+        # much cheaper than dataclasses.asdict, which deep copies every field
+        return dict(name=self.name, testrun_id=self.testrun_id, start=self.start, duration=self.duration,
+                    parent=self.parent, error=self.error, attributes=dict(self.attributes))
+
+
+class Exporter(Protocol):
+    def export(self, span: Span): ...
+
+
+class FileExporter(object):
+    """
+    Appends spans to a file as JSON lines. The file is written by a background thread, so
+    exporting a span never blocks the event loop on disk I/O. The file is opened up front, so
+    a bad path fails at startup rather than in the thread
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'a')
+        self.queue: queue.SimpleQueue[Span | None] = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.write_spans, name='span-exporter', daemon=True)
+        self.thread.start()
+
+    def export(self, span: Span):
+        # if the writer has died there's nothing to drain the queue, so drop the span
+        if self.thread.is_alive():
+            self.queue.put(span)
+
+    def write_spans(self):
+        with self.file as f:
+            while True:
+                span = self.queue.get()
+                while span is not None:
+                    f.write(json.dumps(span.as_dict()) + '\n')
+                    try:
+                        span = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                # flush once we've caught up
+                f.flush()
+                if span is None:
+                    return
+
+    def close(self, timeout: float = 5):
+        """
+        Write out any queued spans and close the file
+        """
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+current_span: ContextVar[Span | None] = ContextVar('current_span', default=None)
+
+
+class Tracer(object):
+    """
+    Records a timeline of spans per testrun: one for each phase of a run, and (nested within them)
+    each K8 API call. Spans inherit the testrun from the enclosing span, so only the phases need
+    to be told which testrun they're for. Finished spans go to any exporters, and are kept until
+    the run completes, when a summary is sent to the server.
+    """
+    def __init__(self, maxsize: int, ttl: int):
+        self.spans: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.exporters: list[Exporter] = []
+
+    def add_exporter(self, exporter: Exporter):
+        self.exporters.append(exporter)
+
+    def close(self):
+        for exporter in self.exporters:
+            if hasattr(exporter, 'close'):
+                exporter.close()
+        self.exporters = []
+
+    @contextmanager
+    def span(self, name: str, testrun_id: int = None, **attributes):
+        parent = current_span.get()
+        if testrun_id is None and parent:
+            testrun_id = parent.testrun_id
+        span = Span(name=name, testrun_id=testrun_id, start=time.time(),
+                    parent=parent.name if parent else None, attributes=attributes)
+        token = current_span.set(span)
+        started = time.monotonic()
+        try:
+            yield span
+        except BaseException as ex:
+            span.error = f'{type(ex).__name__}: {ex}'
+            raise
+        finally:
+            span.duration = time.monotonic() - started
+            current_span.reset(token)
+            self.record(span)
+
+    def traced(self, name: str):
+        """
+        Decorator for the async functions that handle a phase of a testrun,
+        which take the testrun as their first argument
+        """
+        def decorator(func: Callable):
+            @functools.wraps(func)
+            async def wrapper(testrun, *args, **kwargs):
+                with self.span(name, testrun.id):
+                    return await func(testrun, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def mark(self, name: str, testrun_id: int, once: bool = False, **attributes):
+        """
+        Record an instant, e.g when the first runner pod starts
+        """
+        if once and any(s.name == name for s in self.spans.get(int(testrun_id), [])):
+            return
+        self.record(Span(name=name, testrun_id=testrun_id, start=time.time(), attributes=attributes))
+
+    def record(self, span: Span):
+        if span.testrun_id is None:
+            # not part of a testrun
+            return
+        trid = int(span.testrun_id)
+        spans = self.spans.get(trid)
+        if spans is None:
+            spans = self.spans[trid] = []
+        spans.append(span)
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as ex:
+                logger.warning(f'Failed to export span {span.name}: {ex}')
+
+    def summary(self, testrun_id: int) -> dict | None:
+        """
+        The total time spent in each phase, and the full timeline relative to the first span
+        """
+        spans = sorted(self.spans.get(int(testrun_id), []), key=lambda s: s.start)
+        if not spans:
+            return None
+        origin = spans[0].start
+        totals = {}
+        for s in spans:
+            totals[s.name] = round(totals.get(s.name, 0) + s.duration, 3)
+        return dict(testrun_id=int(testrun_id),
+                    started=origin,
+                    totals=totals,
+                    spans=[dict(s.as_dict(), start=round(s.start - origin, 3), duration=round(s.duration, 3))
+                           for s in spans])
+
+    async def send_summary(self, testrun_id: int):
+        summary = self.summary(testrun_id)
+        self.spans.pop(int(testrun_id), None)
+        if not summary:
+            return
+        try:
+            r = await app.httpclient.post(f'/agent/testrun/{testrun_id}/timeline', content=json.dumps(summary))
+        except httpx.HTTPError as ex:
+            logger.warning(f'Failed to post timeline for testrun {testrun_id}: {ex}')
+            return
+        if r.status_code != 200:
+            logger.debug(f'Failed to post timeline for testrun {testrun_id}: {r.status_code}')
+
+
+def load_exporter(path: str) -> Exporter:
+    """
+    Create an exporter from a factory given as module:name
+    """
+    module, name = path.split(':')
+    return getattr(importlib.import_module(module), name)()
+
+
+def configure_tracing():
+    if settings.TRACE_FILE:
+        tracer.add_exporter(FileExporter(settings.TRACE_FILE))
+    if settings.TRACE_EXPORTER:
+        tracer.add_exporter(load_exporter(settings.TRACE_EXPORTER))
+
+
+tracer = Tracer(settings.TRACE_MAX_TESTRUNS, settings.TESTRUN_STATE_TTL)
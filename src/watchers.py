@@ -1,91 +1,192 @@
 import asyncio
+from collections import defaultdict
+from typing import Callable, Awaitable
 
-from aiohttp import ServerDisconnectedError
-from kubernetes_asyncio import watch
-from kubernetes_asyncio.client import V1Job, V1JobStatus, V1ObjectMeta, V1Pod, V1PodStatus, ApiException
+import httpx
+from cachetools import TTLCache
 from loguru import logger
 
 from app import app
 from common import schemas
 from common.k8common import get_core_api, get_batch_api
 from common.utils import utcnow
+from informers import ResumableWatch
 from jobs import recreate_runner_job
+from records import PodRecord, JobRecord
 from settings import settings
+from sharding import shard_router
 from state import get_build_state, check_is_spot
+from tracing import tracer
 
-pod_duration_uploads = set()
 
+class PodDurationReporter(object):
+    """
+    Pod durations are buffered and posted periodically, rather than from the watch handler.
+    Pods are deduplicated by UID (the watch will send us each finished pod many times), for long
+    enough to cover the lifetime of the pod, so each is posted once. Transient failures are retried
+    on the next flush, up to a maximum number of buffered durations.
+    """
+    def __init__(self, max_buffered: int, dedupe_ttl: int, dedupe_size: int = 10000):
+        self.max_buffered = max_buffered
+        self.seen = TTLCache(maxsize=dedupe_size, ttl=dedupe_ttl)
+        self.pending: dict[str, list[schemas.PodDuration]] = defaultdict(list)
+        self.posted = 0
+        self.requests = 0
+        self.dropped = 0
 
-async def watch_pod_events():
-    v1 = get_core_api()
-    while app.is_running():
+    @property
+    def buffered(self) -> int:
+        return sum(len(x) for x in self.pending.values())
+
+    def add(self, uid: str, testrun_id: str, duration: schemas.PodDuration) -> bool:
+        if uid in self.seen:
+            return False
+        self.seen[uid] = True
+        self.pending[testrun_id].append(duration)
+        self.trim()
+        return True
+
+    def trim(self):
+        # drop the oldest durations across all testruns
+        excess = self.buffered - self.max_buffered
+        for testrun_id in list(self.pending.keys()):
+            if excess <= 0:
+                break
+            durations = self.pending[testrun_id]
+            n = min(excess, len(durations))
+            del durations[:n]
+            if not durations:
+                del self.pending[testrun_id]
+            excess -= n
+            self.dropped += n
+
+    async def flush(self):
+        pending, self.pending = self.pending, defaultdict(list)
+        for testrun_id, durations in pending.items():
+            try:
+                failed = await self.post(testrun_id, durations)
+            except httpx.HTTPError as ex:
+                logger.warning(f'Failed to post pod durations for testrun {testrun_id}: {ex}')
+                failed = durations
+            if failed:
+                # retry on the next flush
+                self.pending[testrun_id] = failed + self.pending[testrun_id]
+        self.trim()
+
+    async def post(self, testrun_id: str, durations: list[schemas.PodDuration]) -> list[schemas.PodDuration]:
+        """
+        :return: the durations that should be retried
+        """
+        retry = []
+        for d in durations:
+            self.requests += 1
+            r = await app.httpclient.post(f'/agent/testrun/{testrun_id}/pod-duration', content=d.json())
+            if r.status_code == 200:
+                self.posted += 1
+            else:
+                retry += self.failed(testrun_id, [d], r)
+        return retry
+
+    def failed(self, testrun_id: str, durations: list[schemas.PodDuration],
+               r: httpx.Response) -> list[schemas.PodDuration]:
+        if r.status_code == 429 or r.status_code >= 500:
+            return durations
+        logger.error(f'Failed to post pod durations for testrun {testrun_id}: {r.status_code}')
+        self.dropped += len(durations)
+        return []
+
+    async def run(self):
+        while app.is_running():
+            await asyncio.sleep(settings.POD_DURATION_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Unexpected error posting pod durations')
+
+    def stats(self) -> dict:
+        return dict(buffered=self.buffered,
+                    posted=self.posted,
+                    requests=self.requests,
+                    dropped=self.dropped)
+
+
+pod_duration_reporter = PodDurationReporter(settings.POD_DURATION_BUFFER_SIZE, settings.POD_DURATION_DEDUPE_TTL)
+
+
+class EventWatch(ResumableWatch):
+    """
+    Passes every object to an async handler: both those in the initial list and every change.
+    Objects are decoded into compact records first, so the raw dicts can be freed straight away
+    """
+    def __init__(self, kind: str, get_list_func: Callable[[], Callable],
+                 decode: Callable[[dict], object],
+                 handler: Callable[[object], Awaitable], **list_kwargs):
+        super().__init__(kind, get_list_func, **list_kwargs)
+        self.decode = decode
+        self.handler = handler
+
+    async def on_event(self, event_type: str, obj: dict):
         try:
-            async with watch.Watch().stream(v1.list_namespaced_pod,
-                                            namespace=settings.NAMESPACE,
-                                            label_selector=f"cykubed_job in (runner,builder)",
-                                            timeout_seconds=10) as stream:
-                while app.is_running():
-                    async for event in stream:
-                        await handle_pod_event(event['object'])
-        except Exception as ex:
-            logger.exception('Unexpected error during watch_pod_events loop')
+            await self.handler(self.decode(obj))
+        except Exception:
+            logger.exception(f'Unexpected error handling {self.kind} event')
+
+
+async def watch_pod_events():
+    await pod_watch.run()
 
 
 async def watch_job_events():
-    api = get_batch_api()
-    while app.is_running():
-        try:
-            async with watch.Watch().stream(api.list_namespaced_job,
-                                            namespace=settings.NAMESPACE,
-                                            label_selector=f"cykubed_job=runner",
-                                            timeout_seconds=10) as stream:
-                while app.is_running():
-                    try:
-                        async for event in stream:
-                            job: V1Job = event['object']
-                            status: V1JobStatus = job.status
-                            metadata: V1ObjectMeta = job.metadata
-                            labels = metadata.labels
-                            trid = labels["testrun_id"]
-                            if not status.active:
-                                st = await get_build_state(trid)
-                                if st and st.run_job and st.run_job == metadata.name and status.completion_time:
-                                    if utcnow() < st.runner_deadline:
-                                        # runner job completed under the deadline: inform the server
-                                        r = await app.httpclient.post('/runner-terminated')
-                                        if r.status_code != 200:
-                                            logger.error(f'Failed to post runner-terminated: {r.status_code}: {r.text}')
-                                        else:
-                                            if r.status_code == 200:
-                                                # we should recreate the job
-                                                await recreate_runner_job(schemas.NewTestRun.parse_raw(r.text))
-                    except ServerDisconnectedError as ex:
-                        logger.info(f'Server disconnected error: {ex.message}')
-                        await asyncio.sleep(5)
-        except ApiException:
-            logger.exception('Unexpected K8 error during watch_job_events loop')
-
-
-async def handle_pod_event(pod: V1Pod):
+    await job_watch.run()
+
+
+async def handle_job_event(job: JobRecord):
+    trid = job.labels["testrun_id"]
+    if not shard_router.owns(trid, default=False):
+        return
+    if not job.active:
+        st = await get_build_state(trid)
+        if st and st.run_job and st.run_job == job.name and job.completion_time:
+            if utcnow() < st.runner_deadline:
+                # runner job completed under the deadline: inform the server
+                r = await app.httpclient.post('/runner-terminated')
+                if r.status_code != 200:
+                    logger.error(f'Failed to post runner-terminated: {r.status_code}: {r.text}')
+                else:
+                    if r.status_code == 200:
+                        # we should recreate the job
+                        await recreate_runner_job(schemas.NewTestRun.parse_raw(r.text))
+
+
+async def handle_pod_event(pod: PodRecord):
     """
     Update the duration for a finished pod
     :param pod:
     :return:
     """
+    if not shard_router.owns(pod.labels['testrun_id'], default=False):
+        return
 
-    status: V1PodStatus = pod.status
-    metadata: V1ObjectMeta = pod.metadata
-    if status.phase in ['Succeeded', 'Failed'] and metadata.name not in pod_duration_uploads:
+    if pod.phase == 'Running' and pod.labels.get('cykubed_job') == 'runner':
+        # where the time goes until here is what matters most
+        tracer.mark('runner_pod_running', pod.labels['testrun_id'], once=True, pod=pod.name)
+
+    if pod.phase in ['Succeeded', 'Failed'] and pod.uid not in pod_duration_reporter.seen:
         # assume finished
-        testrun_id = metadata.labels['testrun_id']
-        annotations = metadata.annotations
-        # send the duration
-        st = schemas.PodDuration(pod_name=metadata.name,
-                                 job_type=metadata.labels['cykubed_job'],
-                                 is_spot=check_is_spot(annotations),
-                                 duration=int((utcnow() - status.start_time).seconds))
-        await app.httpclient.post(f'/agent/testrun/{testrun_id}/pod-duration',
-                                  content=st.json())
-
-        pod_duration_uploads.add(metadata.name)
+        testrun_id = pod.labels['testrun_id']
+        st = schemas.PodDuration(pod_name=pod.name,
+                                 job_type=pod.labels['cykubed_job'],
+                                 is_spot=check_is_spot(pod.annotations),
+                                 duration=int((utcnow() - pod.start_time).seconds))
+        # it'll be sent with the next batch
+        pod_duration_reporter.add(pod.uid, testrun_id, st)
+
+
+pod_watch = EventWatch('pods', lambda: get_core_api().list_namespaced_pod,
+                       PodRecord.from_dict, handle_pod_event,
+                       label_selector="cykubed_job in (runner,builder)")
+job_watch = EventWatch('jobs', lambda: get_batch_api().list_namespaced_job,
+                       JobRecord.from_dict, handle_job_event,
+                       label_selector="cykubed_job=runner")
 
+WATCHES = [pod_watch, job_watch]
@@ -14,9 +14,13 @@ from app import app
 from common import schemas
 from common.exceptions import InvalidTemplateException, BuildFailedException
 from common.schemas import NewTestRun, TestRunBuildState
+from dispatcher import CommandDispatcher
 from jobs import handle_delete_build_states
 from k8utils import async_delete_snapshot
+from metrics import Counter, Gauge
 from settings import settings
+from sharding import shard_router
+from state import forget_build_state, remember_build_state
 
 
 async def handle_start_run(tr: NewTestRun):
@@ -34,6 +38,16 @@ async def handle_start_run(tr: NewTestRun):
         await app.httpclient.post(f'/agent/testrun/{tr.id}/status/failed')
 
 
+def parse_testrun(payload: str) -> NewTestRun:
+    """
+    Parse a testrun payload, remembering the build state the server sent us with it
+    """
+    tr = NewTestRun.parse_raw(payload)
+    if tr.buildstate:
+        remember_build_state(tr.buildstate)
+    return tr
+
+
 async def handle_websocket_message(data: dict):
     """
     Handle a message from the websocket
@@ -41,25 +55,30 @@ async def handle_websocket_message(data: dict):
     :return:
     """
     try:
+        if not data.get('forwarded') and await shard_router.forward(data):
+            # another replica owns this testrun
+            return
         cmd = data['command']
         payload = data['payload']
         logger.debug(f'Received {cmd} command')
         if cmd == 'start':
-            await handle_start_run(NewTestRun.parse_raw(payload))
+            await handle_start_run(parse_testrun(payload))
         elif cmd == 'delete_testruns':
             bsmodels = [TestRunBuildState.parse_obj(x) for x in json.loads(payload)]
+            for state in bsmodels:
+                forget_build_state(state.testrun_id)
             await handle_delete_build_states(bsmodels)
         elif cmd == 'cancel':
-            await jobs.handle_run_completed(NewTestRun.parse_raw(payload))
+            await jobs.handle_run_completed(parse_testrun(payload))
         elif cmd == 'delete_snapshots':
             for name in payload['names']:
                 await async_delete_snapshot(name)
         elif cmd == 'build_completed':
-            await jobs.handle_build_completed(NewTestRun.parse_raw(payload))
+            await jobs.handle_build_completed(parse_testrun(payload))
         elif cmd == 'cache_prepared':
-            await jobs.handle_cache_prepared(NewTestRun.parse_raw(payload))
+            await jobs.handle_cache_prepared(parse_testrun(payload))
         elif cmd == 'run_completed':
-            await jobs.handle_run_completed(NewTestRun.parse_raw(payload))
+            await jobs.handle_run_completed(parse_testrun(payload))
         else:
             logger.error(f'Unexpected command {cmd} - ignoring')
     except BuildFailedException as ex:
@@ -90,23 +109,49 @@ async def handle_websocket_message(data: dict):
 #
 
 
+dispatcher = CommandDispatcher(handle_websocket_message, settings.MAX_CONCURRENT_COMMANDS)
+
+WS_RECONNECTS = Counter('cykubed_websocket_reconnects_total', 'Websocket reconnections to the server')
+Gauge('cykubed_websocket_connected', 'Whether the websocket is connected', func=lambda: int(app.ws_connected))
+Gauge('cykubed_command_queue_depth', 'Websocket commands waiting to be handled',
+      func=lambda: dispatcher.queue_depth)
+
+
 async def consumer_handler(websocket):
     while app.is_running():
         try:
             message = await websocket.recv()
         except ConnectionClosed:
             return
-        await handle_websocket_message(json.loads(message))
+        # don't block the socket: commands for different testruns are handled concurrently
+        dispatcher.submit(json.loads(message))
 
 
 async def producer_handler(websocket):
+    encodings = logs.parse_log_encodings(websocket.response_headers.get('Agent-Log-Encoding'))
+    batching = 'batch' in encodings
+    compress = batching and 'gzip' in encodings
+    logger.debug(f'Log encodings: {encodings or "none"}')
     while app.is_running():
+        batch = []
         try:
-            msgitem = await logs.msgqueue.get()
-            if msgitem:
-                await websocket.send(msgitem)
-        except ConnectionClosedError:
+            if batching:
+                batch = await logs.get_batch()
+                frame = logs.encode_batch(batch, compress)
+            else:
+                batch = [await logs.msgqueue.get()]
+                frame = batch[0]
+                if not frame:
+                    continue
+            await websocket.send(frame)
+            logs.shipping_stats.record(len(batch), len(frame))
+        except ConnectionClosed:
+            # we'll send these again once we've reconnected
+            logs.msgqueue.requeue(batch)
             return
+        except asyncio.CancelledError:
+            logs.msgqueue.requeue(batch)
+            raise
         except Exception as ex:
             logger.error(type(ex))
             logger.exception(f'Unexpected exception in producer_handler: {ex}')
@@ -120,7 +165,8 @@ async def connect():
     # fetch token
     headers = {'Authorization': f'Bearer {settings.API_TOKEN}',
                'Agent-Version': settings.AGENT_VERSION,
-               'Agent-Host': app.hostname}
+               'Agent-Host': app.hostname,
+               'Agent-Log-Encoding': ', '.join(logs.LOG_ENCODINGS)}
     if app.region:
         headers['Agent-Region'] = app.region
 
@@ -136,6 +182,7 @@ async def connect():
     loop = asyncio.get_event_loop()
     loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(handle_sigterm_runner()))
     app.wait_period = 2
+    connected = False
 
     while app.is_running():
         try:
@@ -146,6 +193,9 @@ async def connect():
 
             async with websockets.connect(url, extra_headers=headers) as ws:
                 logger.info("Connected")
+                if connected:
+                    WS_RECONNECTS.inc()
+                connected = True
                 app.wait_period = 2
                 app.ws_connected = True
 
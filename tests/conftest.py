@@ -7,6 +7,8 @@ from common.enums import PlatformEnum, AppFramework, TestFramework
 from common.schemas import Project, NewTestRun, TestRunBuildState
 from common.utils import utcnow
 from settings import settings
+from state import BuildStateCache, BuildStateWriter
+from tracing import tracer
 
 
 @pytest.fixture()
@@ -123,6 +125,26 @@ def post_building_status(respx_mock):
             .mock(return_value=Response(200))
 
 
+@pytest.fixture(autouse=True)
+def build_state_writer(mocker):
+    # don't share cached or pending build states between tests
+    mocker.patch('state.build_state_cache', BuildStateCache(100, 3600))
+    return mocker.patch('state.build_state_writer', BuildStateWriter(0, 100, 3600))
+
+
+@pytest.fixture(autouse=True)
+def clear_traces():
+    # the phases are traced by the module-level tracer, so don't leave timelines behind
+    yield
+    tracer.spans.clear()
+
+
+@pytest.fixture()
+def post_timeline_mock(respx_mock):
+    return respx_mock.post('https://api.cykubed.com/agent/testrun/20/timeline') \
+        .mock(return_value=Response(200))
+
+
 @pytest.fixture()
 def save_build_state_mock(respx_mock):
     return respx_mock.put('https://api.cykubed.com/agent/testrun/20/build-state') \
@@ -0,0 +1,58 @@
+from kubernetes_asyncio.client import ApiException
+
+from cache import delete_all_jobs, delete_all_pvcs, CLEANUP_JOB_SELECTOR
+
+
+def list_response(mocker, *names, deleting=()):
+    items = [dict(metadata=dict(name=name)) for name in names]
+    items += [dict(metadata=dict(name=name, deletionTimestamp='2023-12-03T14:10:00Z')) for name in deleting]
+    resp = mocker.Mock(status=200)
+    resp.json = mocker.AsyncMock(return_value=dict(items=items))
+    return resp
+
+
+async def test_delete_all_jobs_bulk(mocker):
+    api = mocker.AsyncMock()
+    mocker.patch('cache.get_batch_api', return_value=api)
+    api.list_namespaced_job.return_value = list_response(mocker)
+
+    await delete_all_jobs()
+
+    api.delete_collection_namespaced_job.assert_called_once_with(namespace='cykubed',
+                                                                 label_selector=CLEANUP_JOB_SELECTOR,
+                                                                 propagation_policy='Background')
+    # verified, with nothing left to delete
+    api.list_namespaced_job.assert_called_once()
+    api.delete_namespaced_job.assert_not_called()
+
+
+async def test_delete_all_pvcs_fallback(mocker):
+    mocker.patch('cache.wait_random_exponential', return_value=lambda state: 0)
+    api = mocker.AsyncMock()
+    mocker.patch('cache.get_core_api', return_value=api)
+    api.delete_collection_namespaced_persistent_volume_claim.side_effect = ApiException(status=403)
+    names = [f'pvc-{i}' for i in range(30)]
+    api.list_namespaced_persistent_volume_claim.side_effect = [
+        list_response(mocker, *names),
+        # one was missed, and the others are just waiting for their finalizers
+        list_response(mocker, 'pvc-late', deleting=names)
+    ]
+    deleted = []
+    attempts = 0
+
+    async def delete(name, namespace):
+        nonlocal attempts
+        if name == 'pvc-1':
+            attempts += 1
+            if attempts == 1:
+                raise ApiException(status=503)
+        if name == 'pvc-2':
+            raise ApiException(status=404)
+        deleted.append(name)
+
+    api.delete_namespaced_persistent_volume_claim.side_effect = delete
+
+    await delete_all_pvcs()
+
+    assert attempts == 2
+    assert sorted(deleted) == sorted(set(names) - {'pvc-2'}) + ['pvc-late']
@@ -0,0 +1,75 @@
+import asyncio
+import json
+
+from dispatcher import CommandDispatcher, get_ordering_key
+
+
+def command(cmd: str, trid: int) -> dict:
+    return dict(command=cmd, payload=json.dumps(dict(id=trid)))
+
+
+def test_ordering_key():
+    assert get_ordering_key(command('start', 20)) == 'testrun:20'
+    assert get_ordering_key(command('build_completed', 20)) == 'testrun:20'
+    assert get_ordering_key(dict(command='delete_snapshots', payload={'names': []})) == 'command:delete_snapshots'
+
+
+async def test_ordered_within_testrun_concurrent_across():
+    handled = []
+    release = asyncio.Event()
+
+    async def handler(data):
+        trid = json.loads(data['payload'])['id']
+        if trid == 1:
+            # testrun 1 blocks until testrun 2 has been handled
+            await release.wait()
+        else:
+            release.set()
+        handled.append((trid, data['command']))
+
+    dispatcher = CommandDispatcher(handler, 10)
+    dispatcher.submit(command('start', 1))
+    dispatcher.submit(command('build_completed', 1))
+    dispatcher.submit(command('start', 2))
+    await asyncio.wait_for(dispatcher.join(), 1)
+
+    assert handled == [(2, 'start'), (1, 'start'), (1, 'build_completed')]
+    stats = dispatcher.stats()
+    assert stats['queued'] == 0
+    assert stats['commands']['start']['count'] == 2
+    assert stats['commands']['build_completed']['count'] == 1
+
+
+async def test_concurrency_limit():
+    running = 0
+    max_running = 0
+
+    async def handler(data):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    dispatcher = CommandDispatcher(handler, 2)
+    for trid in range(6):
+        dispatcher.submit(command('start', trid))
+    assert dispatcher.queue_depth == 6
+    await asyncio.wait_for(dispatcher.join(), 1)
+    assert max_running == 2
+
+
+async def test_handler_errors_do_not_stop_lane():
+    handled = []
+
+    async def handler(data):
+        if data['command'] == 'start':
+            raise ValueError('boom')
+        handled.append(data['command'])
+
+    dispatcher = CommandDispatcher(handler, 2)
+    dispatcher.submit(command('start', 1))
+    dispatcher.submit(command('cancel', 1))
+    await asyncio.wait_for(dispatcher.join(), 1)
+    assert handled == ['cancel']
+    assert dispatcher.stats()['commands']['start']['errors'] == 1
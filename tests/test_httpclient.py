@@ -0,0 +1,54 @@
+import httpx
+import pytest
+from httpx import Response
+
+from httpclient import ResilientTransport, CircuitBreaker, CircuitOpenError
+
+
+@pytest.fixture()
+async def transport():
+    transport = ResilientTransport(httpx.AsyncHTTPTransport(), retries=3, backoff=0, max_backoff=0,
+                                   breaker=CircuitBreaker(3, 60))
+    yield transport
+    await transport.aclose()
+
+
+async def test_retry_idempotent(respx_mock, transport):
+    route = respx_mock.get('https://api.cykubed.com/agent/testrun/20/build-state')
+    route.side_effect = [Response(503), httpx.ConnectError('refused'), Response(200)]
+    post = respx_mock.post('https://api.cykubed.com/agent/testrun/20/status/failed').mock(return_value=Response(503))
+
+    async with httpx.AsyncClient(transport=transport, base_url='https://api.cykubed.com') as client:
+        assert (await client.get('/agent/testrun/20/build-state')).status_code == 200
+        # a POST isn't retried once it's reached the server
+        assert (await client.post('/agent/testrun/20/status/failed')).status_code == 503
+
+    assert route.call_count == 3
+    assert post.call_count == 1
+    stats = transport.stats()
+    assert stats['circuit'] == 'closed'
+    assert stats['endpoints']['GET /agent/testrun/{id}/build-state'] == \
+           dict(stats['endpoints']['GET /agent/testrun/{id}/build-state'], requests=3, errors=2, retries=2)
+
+
+async def test_circuit_breaker(respx_mock, transport, mocker):
+    route = respx_mock.get('https://api.cykubed.com/agent/cached-item/abc123').mock(return_value=Response(502))
+
+    async with httpx.AsyncClient(transport=transport, base_url='https://api.cykubed.com') as client:
+        # the circuit opens before we've used up the retries
+        assert (await client.get('/agent/cached-item/abc123')).status_code == 502
+        assert route.call_count == 3
+        assert transport.breaker.state == 'open'
+
+        # now we fail fast
+        with pytest.raises(CircuitOpenError):
+            await client.get('/agent/cached-item/abc123')
+        assert route.call_count == 3
+
+        # until a probe is allowed through, which closes it again
+        mocker.patch('httpclient.time.monotonic', return_value=transport.breaker.opened_at + 60)
+        route.mock(return_value=Response(200))
+        assert (await client.get('/agent/cached-item/abc123')).status_code == 200
+        assert transport.breaker.state == 'closed'
+
+    assert transport.stats()['rejected'] == 1
@@ -0,0 +1,168 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import ServerDisconnectedError
+from kubernetes_asyncio.client import ApiException
+
+from common.exceptions import BuildFailedException
+from informers import Informer, SnapshotWaiter, is_snapshot_ready, ResumableWatch
+from k8utils import async_get_snapshot
+
+
+def k8object(name: str, **labels) -> dict:
+    return dict(metadata=dict(name=name, labels=labels, resourceVersion='1', managedFields=[{}]))
+
+
+async def test_relist_and_index(mocker):
+    resp = mocker.Mock(status=200)
+    resp.json = mocker.AsyncMock(return_value=dict(metadata=dict(resourceVersion='100'),
+                                                   items=[k8object('job-1', testrun_id='20', project_id='10',
+                                                                   branch='master'),
+                                                          k8object('job-2', testrun_id='21', project_id='10',
+                                                                   branch='feature')]))
+    list_func = mocker.AsyncMock(return_value=resp)
+    informer = Informer('jobs', lambda: list_func)
+    events = []
+    informer.add_handler(lambda event_type, obj: events.append((event_type, obj['metadata']['name'])))
+
+    await informer.relist()
+
+    assert informer.synced
+    assert informer.resource_version == '100'
+    assert {x['metadata']['name'] for x in informer.find(project_id=10)} == {'job-1', 'job-2'}
+    assert [x['metadata']['name'] for x in informer.find(project_id=10, branch='master')] == ['job-1']
+    assert 'managedFields' not in informer.get('job-1')['metadata']
+    assert events == [('ADDED', 'job-1'), ('ADDED', 'job-2')]
+
+    # a relist removes objects that have gone
+    resp.json.return_value = dict(metadata=dict(resourceVersion='200'),
+                                  items=[k8object('job-2', testrun_id='21', project_id='10', branch='feature')])
+    await informer.relist()
+    assert informer.get('job-1') is None
+    assert informer.find(branch='master') == []
+    assert events[2] == ('DELETED', 'job-1')
+
+
+async def test_apply_events():
+    informer = Informer('persistentvolumeclaims', None)
+    informer.apply('ADDED', k8object('pvc-1', testrun_id='20', sha='deadbeef'))
+    informer.apply('MODIFIED', k8object('pvc-1', testrun_id='21', sha='deadbeef'))
+    assert informer.find(testrun_id=20) == []
+    assert len(informer.find(testrun_id=21, sha='deadbeef')) == 1
+    informer.apply('DELETED', k8object('pvc-1', testrun_id='21', sha='deadbeef'))
+    assert not informer.objects
+    assert not informer.index
+
+
+async def test_resume_watch(mocker):
+    """
+    Watches resume from the last version we saw (including bookmarks), and only relist on a 410
+    """
+    def event(event_type: str, name: str, version: str) -> dict:
+        return dict(type=event_type, object=dict(metadata=dict(name=name, resourceVersion=version)))
+
+    streams = [
+        [event('ADDED', 'job-1', '101'), event('BOOKMARK', None, '150')],
+        ServerDisconnectedError(),
+        [event('MODIFIED', 'job-1', '160')],
+        [dict(type='ERROR', object=dict(code=410, reason='Expired', message='too old resource version'))],
+        [],
+    ]
+    watched_from = []
+
+    async def list_func(resource_version=None, **kwargs):
+        assert kwargs['watch'] and kwargs['allow_watch_bookmarks']
+        watched_from.append(resource_version)
+        events = streams.pop(0)
+        if isinstance(events, Exception):
+            raise events
+        resp = mocker.Mock(status=200)
+        resp.content.readline = mocker.AsyncMock(side_effect=[json.dumps(e).encode() + b'\n' for e in events] + [b''])
+        return resp
+
+    mocker.patch('informers.asyncio.sleep')
+    mocker.patch('informers.app.is_running', side_effect=lambda: bool(streams))
+
+    received = []
+
+    class TestWatch(ResumableWatch):
+        async def list_objects(self):
+            return ['job-0'], str(100 * (self.relists + 1))
+
+        async def on_event(self, event_type, obj):
+            received.append((event_type, obj if isinstance(obj, str) else obj['metadata']['name']))
+
+    w = TestWatch('jobs', lambda: list_func)
+    await w.run()
+
+    assert watched_from == ['100', '150', '150', '160', '200']
+    assert w.relists == 2
+    assert received == [('ADDED', 'job-0'), ('ADDED', 'job-1'), ('MODIFIED', 'job-1'), ('ADDED', 'job-0')]
+
+
+async def test_get_snapshot_from_informer(mocker, k8_custom_api_mock):
+    informer = mocker.patch('k8utils.snapshot_informer', Informer('volumesnapshots', None))
+    informer.apply('ADDED', k8object('5-node-absd234weefw'))
+    informer.synced = True
+
+    assert await async_get_snapshot('5-node-absd234weefw')
+    assert not k8_custom_api_mock.get_namespaced_custom_object.called
+
+    # unknown snapshots are checked with the API, in case we haven't seen them yet
+    await async_get_snapshot('5-node-other')
+    assert k8_custom_api_mock.get_namespaced_custom_object.called
+
+
+def snapshot(name: str, ready: bool, error: str = None) -> dict:
+    obj = k8object(name)
+    obj['status'] = dict(readyToUse=ready)
+    if error:
+        obj['status']['error'] = dict(message=error)
+    return obj
+
+
+@pytest.fixture()
+def waiter(mocker):
+    informer = Informer('volumesnapshots', None)
+    mocker.patch.object(informer, 'start')
+    return SnapshotWaiter(informer)
+
+
+async def test_wait_for_snapshot(waiter):
+    waiters = [asyncio.create_task(waiter.wait('5-build-deadbeef0101', 10)),
+               asyncio.create_task(waiter.wait('5-build-deadbeef0101', 10))]
+    await asyncio.sleep(0)
+    waiter.informer.apply('ADDED', snapshot('5-build-deadbeef0101', False))
+    await asyncio.sleep(0)
+    assert not any(w.done() for w in waiters)
+
+    waiter.informer.apply('MODIFIED', snapshot('5-build-deadbeef0101', True))
+    results = await asyncio.wait_for(asyncio.gather(*waiters), 1)
+    assert all(is_snapshot_ready(x) for x in results)
+    assert not waiter.waiters
+
+
+async def test_wait_for_snapshot_already_ready(waiter):
+    waiter.informer.apply('ADDED', snapshot('5-build-deadbeef0101', True))
+    assert await asyncio.wait_for(waiter.wait('5-build-deadbeef0101', 10), 1)
+    assert not waiter.informer.start.called
+
+
+async def test_wait_for_snapshot_timeout(waiter):
+    task = asyncio.create_task(waiter.wait('5-build-deadbeef0101', 0.05, testrun_id=20))
+    await asyncio.sleep(0)
+    waiter.informer.apply('ADDED', snapshot('5-build-deadbeef0101', False, 'quota exceeded'))
+    with pytest.raises(BuildFailedException) as ex:
+        await task
+    assert ex.value.testrun_id == 20
+    assert 'quota exceeded' in ex.value.msg
+    assert not waiter.waiters
+
+
+async def test_wait_for_snapshot_deleted(waiter):
+    task = asyncio.create_task(waiter.wait('5-build-deadbeef0101', 10))
+    await asyncio.sleep(0)
+    waiter.informer.apply('DELETED', snapshot('5-build-deadbeef0101', False))
+    with pytest.raises(BuildFailedException):
+        await asyncio.wait_for(task, 1)
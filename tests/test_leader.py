@@ -0,0 +1,141 @@
+import asyncio
+import copy
+
+import pytest
+from kubernetes_asyncio.client import ApiException
+
+import main
+from leader import LeaderElector
+
+
+class FakeLeaseApi(object):
+    """
+    Just enough of the coordination API to hold one lease, with optimistic concurrency
+    """
+    def __init__(self):
+        self.lease = None
+        self.version = 0
+
+    def store(self, lease):
+        self.version += 1
+        self.lease = copy.deepcopy(lease)
+        self.lease.metadata.resource_version = str(self.version)
+        return copy.deepcopy(self.lease)
+
+    async def read_namespaced_lease(self, name, namespace):
+        if not self.lease:
+            raise ApiException(status=404)
+        return copy.deepcopy(self.lease)
+
+    async def create_namespaced_lease(self, namespace, body):
+        if self.lease:
+            raise ApiException(status=409)
+        return self.store(body)
+
+    async def replace_namespaced_lease(self, name, namespace, body):
+        if body.metadata.resource_version != self.lease.metadata.resource_version:
+            raise ApiException(status=409)
+        return self.store(body)
+
+
+def create_elector(api: FakeLeaseApi, identity: str) -> LeaderElector:
+    return LeaderElector('cykubed-agent-leader', identity, 15, 10, 2, get_api=lambda: api)
+
+
+async def test_election(mocker):
+    api = FakeLeaseApi()
+    now = 1000.0
+    mocker.patch('leader.time.monotonic', side_effect=lambda: now)
+    agent0 = create_elector(api, 'agent-0')
+    agent1 = create_elector(api, 'agent-1')
+
+    assert await agent0.try_acquire_or_renew()
+    assert not await agent1.try_acquire_or_renew()
+    assert agent1.holder == 'agent-0'
+
+    # renewing
+    now += 2
+    assert await agent0.try_acquire_or_renew()
+    assert api.lease.spec.lease_transitions == 0
+
+    # agent-0 goes away: once the lease expires agent-1 takes over
+    now += 10
+    assert not await agent1.try_acquire_or_renew()
+    now += 15
+    assert await agent1.try_acquire_or_renew()
+    assert api.lease.spec.holder_identity == 'agent-1'
+    assert api.lease.spec.lease_transitions == 1
+    assert not await agent0.try_acquire_or_renew()
+
+    # a clean handover
+    await agent1.release()
+    assert await agent0.try_acquire_or_renew()
+
+
+async def test_run_leads_until_released(mocker):
+    api = FakeLeaseApi()
+    elector = create_elector(api, 'agent-0')
+    elector.retry_period = 0
+    leading = asyncio.Event()
+
+    async def lead():
+        leading.set()
+        await asyncio.sleep(3600)
+
+    task = asyncio.create_task(elector.run(lead))
+    await asyncio.wait_for(leading.wait(), 1)
+    assert elector.is_leader
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    # the lease is released on the way out
+    assert not elector.is_leader
+    assert api.lease.spec.holder_identity is None
+
+
+async def test_run_backs_off_when_lead_fails(mocker):
+    api = FakeLeaseApi()
+    elector = create_elector(api, 'agent-0')
+    elector.retry_period = 0
+    lead = mocker.AsyncMock(side_effect=ValueError('boom'))
+
+    task = asyncio.create_task(elector.run(lead))
+    for _ in range(100):
+        if elector.failures:
+            break
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)
+    # the lease is given up, and we wait (for a lease duration) before leading again
+    assert lead.call_count == 1
+    assert elector.failures == 1
+    assert elector.get_backoff() == 15
+    assert not elector.is_leader
+    assert api.lease.spec.holder_identity is None
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def test_lead_stops_everything_when_one_fails(mocker):
+    cancelled = []
+
+    async def watch():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError('boom')
+
+    mocker.patch('main.watch_pod_events', fail)
+    mocker.patch('main.watch_job_events', watch)
+    mocker.patch.object(main.pod_duration_reporter, 'run', watch)
+
+    with pytest.raises(ExceptionGroup) as ex:
+        await asyncio.wait_for(main.lead(), 5)
+    assert [type(e) for e in ex.value.exceptions] == [ValueError]
+    # nothing is left handling events once we give up the lease
+    assert cancelled == [True, True]
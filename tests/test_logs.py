@@ -0,0 +1,165 @@
+import asyncio
+import gzip
+import json
+import os
+from asyncio import QueueEmpty
+
+import logs
+from logs import get_batch, encode_batch, parse_log_encodings, ShippingStats, LogQueue, ingest_logs
+
+
+def test_parse_log_encodings():
+    assert parse_log_encodings(None) == set()
+    assert parse_log_encodings('batch') == {'batch'}
+    assert parse_log_encodings('batch, gzip, brotli') == {'batch', 'gzip'}
+
+
+async def test_get_batch_by_size(mocker):
+    mocker.patch('logs.msgqueue', LogQueue(100, 'drop_oldest'))
+    for i in range(10):
+        logs.msgqueue.put_nowait(json.dumps(dict(msg=f'line {i}')))
+
+    batch = await get_batch(max_bytes=50, max_delay=1)
+    assert len(batch) == 3
+    assert logs.msgqueue.qsize() == 7
+
+
+async def test_get_batch_counts_bytes(mocker):
+    mocker.patch('logs.msgqueue', LogQueue(100, 'drop_oldest'))
+    for i in range(5):
+        # 20 characters, but 40 bytes once encoded
+        logs.msgqueue.put_nowait('é' * 20)
+
+    batch = await get_batch(max_bytes=50, max_delay=1)
+    assert len(batch) == 2
+
+
+async def test_get_batch_by_time(mocker):
+    mocker.patch('logs.msgqueue', LogQueue(100, 'drop_oldest'))
+    logs.msgqueue.put_nowait('')
+    logs.msgqueue.put_nowait('{"msg": "first"}')
+
+    async def later():
+        await asyncio.sleep(0.01)
+        logs.msgqueue.put_nowait('{"msg": "second"}')
+
+    asyncio.create_task(later())
+    batch = await asyncio.wait_for(get_batch(max_bytes=1024, max_delay=0.1), 1)
+    assert batch == ['{"msg": "first"}', '{"msg": "second"}']
+
+
+def test_encode_batch():
+    batch = ['{"msg": "first"}', '{"msg": "second"}']
+    assert json.loads(encode_batch(batch, False)) == [dict(msg='first'), dict(msg='second')]
+    assert json.loads(gzip.decompress(encode_batch(batch, True))) == [dict(msg='first'), dict(msg='second')]
+
+
+def test_shipping_stats():
+    stats = ShippingStats(window=10)
+    stats.record(5, 1000)
+    stats.record(3, 500)
+    assert stats.as_dict() == dict(frames=2, messages=8, bytes=1500, frames_per_sec=0.2, bytes_per_sec=150.0)
+
+
+def message(trid: int, i: int) -> str:
+    return json.dumps(dict(testrun_id=trid, msg=f'line {i}'))
+
+
+def drain(queue: LogQueue) -> list[str]:
+    items = []
+    while True:
+        try:
+            items.append(queue.get_nowait())
+        except QueueEmpty:
+            return items
+
+
+def test_spill_and_replay_in_order(tmp_path):
+    spill_path = str(tmp_path / 'logs.spill')
+    queue = LogQueue(3, 'spill', spill_path=spill_path, spill_max_bytes=1024)
+    messages = [message(20, i) for i in range(10)]
+    for msg in messages[:5]:
+        queue.put_nowait(msg)
+    assert queue.stats() == dict(queued=3, spilled=2, dropped=0)
+
+    # once we've started spilling everything goes to the spill file, even if there's room in memory
+    assert queue.get_nowait() == messages[0]
+    for msg in messages[5:]:
+        queue.put_nowait(msg)
+    assert queue.stats() == dict(queued=2, spilled=7, dropped=0)
+
+    assert [messages[0]] + drain(queue) == messages
+    assert os.path.getsize(spill_path) == 0
+    assert queue.stats() == dict(queued=0, spilled=0, dropped=0)
+
+
+def test_spill_survives_restart(tmp_path):
+    spill_path = str(tmp_path / 'logs.spill')
+    queue = LogQueue(1, 'spill', spill_path=spill_path, spill_max_bytes=1024)
+    for i in range(3):
+        queue.put_nowait(message(20, i))
+    # on shutdown
+    queue.close()
+
+    restarted = LogQueue(1, 'spill', spill_path=spill_path, spill_max_bytes=1024)
+    assert drain(restarted) == [message(20, 1), message(20, 2)]
+
+
+def test_spill_writes_are_batched(tmp_path):
+    spill_path = str(tmp_path / 'logs.spill')
+    queue = LogQueue(1, 'spill', spill_path=spill_path, spill_max_bytes=1024, spill_write_size=100)
+    messages = [message(20, i) for i in range(6)]
+    queue.put_nowait(messages[0])
+    queue.put_nowait(messages[1])
+    assert not os.path.exists(spill_path)
+    for msg in messages[2:]:
+        queue.put_nowait(msg)
+    assert 0 < os.path.getsize(spill_path) < queue.spill_size
+    # anything still buffered is replayed in order too
+    assert drain(queue) == messages
+
+
+def test_spill_limit(tmp_path):
+    queue = LogQueue(1, 'spill', spill_path=str(tmp_path / 'logs.spill'), spill_max_bytes=100)
+    for i in range(10):
+        queue.put_nowait(message(20, i))
+    assert queue.qsize() == 3
+    assert queue.dropped == 7
+
+
+def test_drop_oldest():
+    queue = LogQueue(3, 'drop_oldest')
+    for i in range(5):
+        queue.put_nowait(message(20, i))
+    assert drain(queue) == [message(20, i) for i in range(2, 5)]
+    assert queue.dropped == 2
+
+
+def test_sample_per_testrun():
+    queue = LogQueue(2, 'sample', sample_rate=3)
+    for i in range(8):
+        queue.put_nowait(message(20, i))
+        queue.put_nowait(message(21, i))
+    # the queue filled with the first message of each testrun, and after that we kept 1 in 3
+    assert drain(queue) == [message(20, 7), message(21, 7)]
+
+
+async def test_requeue():
+    queue = LogQueue(10, 'drop_oldest')
+    queue.put_nowait('3')
+    queue.requeue(['1', '2'])
+    assert drain(queue) == ['1', '2', '3']
+    queue.requeue(['4'])
+    assert await asyncio.wait_for(queue.get(), 1) == '4'
+
+
+async def test_ingest_ndjson(mocker):
+    mocker.patch('logs.msgqueue', LogQueue(2, 'drop_oldest'))
+
+    async def lines():
+        for i in range(3):
+            yield (message(20, i) + '\n').encode()
+        yield b'\n'
+
+    assert await ingest_logs(lines()) == dict(accepted=3, dropped=1)
+    assert drain(logs.msgqueue) == [message(20, 1), message(20, 2)]
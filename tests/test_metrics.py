@@ -0,0 +1,37 @@
+import pytest
+
+from metrics import Registry, Counter, Gauge, Histogram
+
+
+def test_exposition():
+    registry = Registry()
+    counter = Counter('test_requests_total', 'Requests', registry=registry)
+    counter.inc()
+    counter.inc(2)
+    Gauge('test_depth', 'Queue "depth"\nin items', func=lambda: 7, registry=registry)
+    hist = Histogram('test_seconds', 'Latency', ('call',), buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.5, 0.5, 5):
+        hist.observe(value, call='read_pvc')
+    assert registry.expose() == '''# HELP test_requests_total Requests
+# TYPE test_requests_total counter
+test_requests_total 3
+# HELP test_depth Queue "depth"\\nin items
+# TYPE test_depth gauge
+test_depth 7
+# HELP test_seconds Latency
+# TYPE test_seconds histogram
+test_seconds_bucket{call="read_pvc",le="0.1"} 1
+test_seconds_bucket{call="read_pvc",le="1"} 3
+test_seconds_bucket{call="read_pvc",le="+Inf"} 4
+test_seconds_sum{call="read_pvc"} 6.05
+test_seconds_count{call="read_pvc"} 4
+'''
+
+    with hist.time(call='delete_job'):
+        pass
+    assert 'test_seconds_count{call="delete_job"} 1' in registry.expose()
+
+    with pytest.raises(ValueError):
+        hist.observe(1)
+    with pytest.raises(ValueError):
+        Counter('test_requests_total', 'Duplicate', registry=registry)
@@ -0,0 +1,153 @@
+import datetime
+
+import pytest
+from httpx import Response
+from kubernetes_asyncio.client import ApiClient, Configuration, CustomObjectsApi
+
+from common.schemas import TestRunBuildState
+from common.utils import utcnow
+from informers import Informer
+from nodecache import NodeCache, parse_quantity, LAST_USED_ANNOTATION
+from state import BuildStateCache
+
+
+def timestamp(age: int) -> str:
+    return (utcnow() - datetime.timedelta(seconds=age)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def snapshot(name: str, age: int, last_used: int = None, size='10Gi', ready=True) -> dict:
+    metadata = dict(name=name, creationTimestamp=timestamp(age))
+    if last_used is not None:
+        metadata['annotations'] = {LAST_USED_ANNOTATION: timestamp(last_used)}
+    return dict(metadata=metadata, status=dict(readyToUse=ready, restoreSize=size))
+
+
+def synced_informer(mocker, target: str, *objects) -> Informer:
+    informer = Informer(target, None)
+    informer.synced = True
+    for obj in objects:
+        informer.apply('ADDED', obj)
+    mocker.patch(f'nodecache.{target}', informer)
+    return informer
+
+
+def job(name: str, pvc_name: str, finished=False) -> dict:
+    status = dict(conditions=[dict(type='Complete', status='True')]) if finished else dict(active=1)
+    return dict(metadata=dict(name=name, labels=dict(cykubed_job='builder')),
+                spec=dict(template=dict(spec=dict(volumes=[
+                    dict(name='build-volume', persistentVolumeClaim=dict(claimName=pvc_name))]))),
+                status=status)
+
+
+def restored_pvc(name: str, snapshot_name: str, phase='Bound') -> dict:
+    return dict(metadata=dict(name=name),
+                spec=dict(dataSource=dict(kind='VolumeSnapshot', name=snapshot_name)),
+                status=dict(phase=phase))
+
+
+@pytest.fixture()
+def node_cache() -> NodeCache:
+    return NodeCache(budget=30 * 2**30, grace=600, period=60)
+
+
+def test_parse_quantity():
+    assert parse_quantity('10Gi') == 10 * 2**30
+    assert parse_quantity('500M') == 500 * 10**6
+    assert parse_quantity('1024') == 1024
+    assert parse_quantity(None) == 0
+    with pytest.raises(ValueError):
+        parse_quantity('10Xi')
+
+
+async def test_evict_least_recently_used(mocker, node_cache, delete_cached_item_mock_factory):
+    synced_informer(mocker, 'snapshot_informer',
+                    # an in-flight build was based on this one
+                    snapshot('5-node-a', age=9000),
+                    snapshot('5-node-b', age=8000),
+                    # a PVC is still being restored from this one
+                    snapshot('5-node-c', age=9000, last_used=7000),
+                    snapshot('5-node-d', age=9000, last_used=6000),
+                    snapshot('5-node-e', age=7000, last_used=5000),
+                    # just used
+                    snapshot('5-node-f', age=9000, last_used=60),
+                    # another replica's build is using a PVC restored from this one
+                    snapshot('5-node-g', age=9500),
+                    # as was this, but it's finished
+                    snapshot('5-node-h', age=9500),
+                    # not ready yet
+                    snapshot('6-node-a', age=9000, size=None, ready=False),
+                    # not part of the node cache
+                    snapshot('5-build-deadbeef', age=9000, size='100Gi'))
+    synced_informer(mocker, 'pvc_informer',
+                    restored_pvc('5-project-2-rw', '5-node-c', phase='Pending'),
+                    restored_pvc('5-project-3-rw', '5-node-e'),
+                    restored_pvc('5-project-4-rw', '5-node-g'),
+                    restored_pvc('5-project-5-rw', '5-node-h'))
+    synced_informer(mocker, 'job_informer',
+                    job('5-builder-project-4', '5-project-4-rw'),
+                    job('5-builder-project-5', '5-project-5-rw', finished=True))
+    states = BuildStateCache(100, 3600)
+    states.put(TestRunBuildState(testrun_id=20, node_snapshot_name='5-node-a'))
+    states.put(TestRunBuildState(testrun_id=21, node_snapshot_name='5-node-b', completed=True))
+    mocker.patch('nodecache.build_state_cache', states)
+    delete_snapshot = mocker.patch('nodecache.async_delete_snapshot')
+    deleted_items = [delete_cached_item_mock_factory(f'5-node-{x}') for x in 'hbde']
+
+    assert node_cache.used() == 80 * 2**30
+    await node_cache.enforce_budget()
+
+    # least recently used first, skipping those still needed (which leaves us over budget)
+    assert [c.args[0] for c in delete_snapshot.call_args_list] == ['5-node-h', '5-node-b', '5-node-d', '5-node-e']
+    assert all(item.called for item in deleted_items)
+    assert node_cache.evictions == 4
+
+
+async def test_evict_within_budget(mocker, node_cache):
+    synced_informer(mocker, 'snapshot_informer', snapshot('5-node-a', age=9000), snapshot('5-node-b', age=9000))
+    synced_informer(mocker, 'pvc_informer')
+    synced_informer(mocker, 'job_informer')
+    delete_snapshot = mocker.patch('nodecache.async_delete_snapshot')
+    await node_cache.enforce_budget()
+    assert not delete_snapshot.called
+
+
+async def test_evict_server_failure(mocker, respx_mock):
+    synced_informer(mocker, 'snapshot_informer', snapshot('5-node-a', age=9000), snapshot('5-node-b', age=8000))
+    synced_informer(mocker, 'pvc_informer')
+    synced_informer(mocker, 'job_informer')
+    delete_snapshot = mocker.patch('nodecache.async_delete_snapshot')
+    respx_mock.delete('https://api.cykubed.com/agent/cached-item/5-node-a').mock(return_value=Response(500))
+    respx_mock.delete('https://api.cykubed.com/agent/cached-item/5-node-b').mock(return_value=Response(404))
+    node_cache = NodeCache(budget=10 * 2**30, grace=600, period=60)
+
+    await node_cache.enforce_budget()
+    # we mustn't delete a snapshot the server might still hand out
+    assert [c.args[0] for c in delete_snapshot.call_args_list] == ['5-node-b']
+
+
+async def test_hit_rate(mocker, node_cache):
+    synced_informer(mocker, 'snapshot_informer')
+    annotate = mocker.patch('nodecache.async_annotate_snapshot')
+    node_cache.record_lookup('5-node-a', False)
+    node_cache.record_lookup('5-node-a', True)
+    node_cache.record_lookup('5-node-a', True)
+    await node_cache.touch('5-node-a')
+    assert annotate.call_args.args[0] == '5-node-a'
+    assert LAST_USED_ANNOTATION in annotate.call_args.args[1]
+    stats = node_cache.stats()
+    assert stats['hits'] == 2
+    assert stats['hit_rate'] == 0.667
+
+
+async def test_touch_sends_merge_patch(mocker, node_cache):
+    api = CustomObjectsApi(ApiClient(Configuration(host='https://kubernetes')))
+    request = mocker.patch.object(api.api_client.rest_client, 'PATCH', return_value=mocker.Mock(status=200, data=b'{}'))
+    mocker.patch('k8utils.get_custom_api', return_value=api)
+
+    await node_cache.touch('5-node-a')
+
+    kwargs = request.call_args.kwargs
+    assert request.call_args.args[0].endswith('/namespaces/cykubed/volumesnapshots/5-node-a')
+    assert kwargs['headers']['Content-Type'] == 'application/merge-patch+json'
+    assert LAST_USED_ANNOTATION in kwargs['body']['metadata']['annotations']
+    await api.api_client.close()
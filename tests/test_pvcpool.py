@@ -0,0 +1,189 @@
+import datetime
+
+import pytest
+from kubernetes_asyncio.client import ApiException
+
+from common.utils import utcnow
+from informers import Informer
+from pvcpool import PVCPool, pool_key, pvc_pool
+from ws import handle_start_run
+
+SNAPSHOT = '5-node-absd234weefw'
+
+
+def pooled_pvc(name: str, snapshot: str = SNAPSHOT, bound=True, age=60, storage=10) -> dict:
+    created = utcnow() - datetime.timedelta(seconds=age)
+    return dict(metadata=dict(name=name,
+                              resourceVersion='1',
+                              creationTimestamp=created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                              labels=dict(cykubed_pool=pool_key(snapshot), project_id='10')),
+                spec=dict(resources=dict(requests=dict(storage=f'{storage}Gi'))),
+                status=dict(phase='Bound' if bound else 'Pending'))
+
+
+def build_pvc(name: str, snapshot: str = SNAPSHOT, testrun_id='20', project_id='10') -> dict:
+    """
+    A build's PVC, restored from a node snapshot by any replica
+    """
+    return dict(metadata=dict(name=name,
+                              resourceVersion='1',
+                              labels=dict(testrun_id=testrun_id, project_id=project_id)),
+                spec=dict(resources=dict(requests=dict(storage='10Gi')),
+                          dataSource=dict(apiGroup='snapshot.storage.k8s.io', kind='VolumeSnapshot',
+                                          name=snapshot)))
+
+
+@pytest.fixture()
+def informer(mocker):
+    informer = Informer('persistentvolumeclaims', None)
+    informer.synced = True
+    mocker.patch('pvcpool.pvc_informer', informer)
+    return informer
+
+
+@pytest.fixture()
+def core_api(mocker):
+    api = mocker.AsyncMock()
+    mocker.patch('pvcpool.get_core_api', return_value=api)
+    return api
+
+
+@pytest.fixture()
+def pool(mocker, informer) -> PVCPool:
+    mocker.patch('pvcpool.async_get_snapshot', return_value=True)
+    pool = PVCPool(size=2, window=3600, refill_period=30)
+    informer.add_handler(pool.on_pvc_event)
+    return pool
+
+
+async def test_pool_follows_demand(informer, core_api, pool, testrun, mock_create_from_dict):
+    # nothing in the pool yet
+    assert await pool.acquire(testrun, SNAPSHOT, 10) is None
+    assert pool.misses == 1
+
+    # one recent cache hit (on any replica), so one warm PVC
+    informer.apply('ADDED', build_pvc('5-project-rw-1'))
+    informer.apply('MODIFIED', build_pvc('5-project-rw-1'))
+    # (PVCs restored from anything else aren't node cache hits)
+    informer.apply('ADDED', build_pvc('5-project-ro-1', snapshot='5-build-deadbeef0101'))
+    await pool.refill()
+    assert mock_create_from_dict.call_count == 1
+    pvc = mock_create_from_dict.call_args.args[0]
+    assert pvc['metadata']['labels'] == dict(cykubed_pool=pool_key(SNAPSHOT), project_id='10')
+    assert pvc['metadata']['name'].startswith(f'{SNAPSHOT}-pool-')
+    assert pvc['spec']['dataSource']['name'] == SNAPSHOT
+    assert pvc['spec']['accessModes'] == ['ReadWriteOnce']
+    assert pvc['spec']['resources']['requests']['storage'] == '10Gi'
+
+    # more demand, but only up to the maximum size
+    for i in range(2, 5):
+        informer.apply('ADDED', build_pvc(f'5-project-rw-{i}', testrun_id=str(20 + i)))
+    informer.apply('ADDED', pooled_pvc(pvc['metadata']['name']))
+    await pool.refill()
+    assert mock_create_from_dict.call_count == 2
+
+    # once the demand has gone, so does the pool
+    pool.window = 0
+    await pool.refill()
+    core_api.delete_namespaced_persistent_volume_claim.assert_called_once()
+    assert pool.demand == {}
+
+
+async def test_claim_warm_pvc(informer, core_api, pool, testrun):
+    informer.apply('ADDED', pooled_pvc('5-project-pool-1', bound=False, age=10))
+    informer.apply('ADDED', pooled_pvc('5-project-pool-2', age=30))
+    informer.apply('ADDED', pooled_pvc('5-project-pool-3', age=120))
+    informer.apply('ADDED', pooled_pvc('5-project-pool-4', age=300, storage=20))
+    # another replica claims the oldest restored PVC first
+    core_api.patch_namespaced_persistent_volume_claim.side_effect = [ApiException(status=409), None]
+
+    assert await pool.acquire(testrun, SNAPSHOT, 10) == '5-project-pool-2'
+    assert pool.hits == 1
+
+    calls = core_api.patch_namespaced_persistent_volume_claim.call_args_list
+    assert [c.args[0] for c in calls] == ['5-project-pool-3', '5-project-pool-2']
+    assert calls[1].args[2] == dict(metadata=dict(resourceVersion='1',
+                                                  labels=dict(cykubed_pool=None,
+                                                              sha='deadbeef0101',
+                                                              project_id='10',
+                                                              local_id='1',
+                                                              testrun_id='20',
+                                                              branch='master')))
+    # we won't count it in the pool, even before we see it relabelled
+    assert {pvc['metadata']['name'] for pvc in pool.pools()[pool_key(SNAPSHOT)]} == \
+           {'5-project-pool-1', '5-project-pool-3', '5-project-pool-4'}
+
+
+async def test_retired_pools(informer, core_api, pool, testrun, mock_create_from_dict):
+    # a pool for a snapshot we don't know about (e.g from before a restart) is kept for now
+    informer.apply('ADDED', pooled_pvc('5-project-pool-1', snapshot='5-node-old', age=60))
+    informer.apply('ADDED', pooled_pvc('5-project-pool-2', snapshot='5-node-old', age=7200))
+    await pool.refill()
+    deleted = core_api.delete_namespaced_persistent_volume_claim.call_args_list
+    assert [c.args[0] for c in deleted] == ['5-project-pool-2']
+
+    # until the project moves on to a new snapshot
+    pool.track(10, '5-node-old', 10)
+    pool.track(10, SNAPSHOT, 10)
+    await pool.refill()
+    assert {c.args[0] for c in deleted[1:]} == {'5-project-pool-1', '5-project-pool-2'}
+    assert mock_create_from_dict.call_count == 1
+
+
+async def test_pools_managed_by_owner(mocker, informer, core_api, pool, mock_create_from_dict):
+    other = '5-node-other'
+    # each pool is managed by the replica that owns its key
+    owns = mocker.patch('pvcpool.shard_router.owns', side_effect=lambda key, default: key == pool_key(SNAPSHOT))
+    informer.apply('ADDED', build_pvc('5-project-rw-1'))
+    informer.apply('ADDED', build_pvc('5-project-rw-2', snapshot=other, testrun_id='21', project_id='11'))
+    # including those left behind by a replica that has gone
+    informer.apply('ADDED', pooled_pvc('5-project-pool-1', age=60))
+    informer.apply('ADDED', pooled_pvc('5-project-pool-2', age=120))
+    informer.apply('ADDED', pooled_pvc('5-project-pool-3', snapshot=other, age=120))
+
+    await pool.refill()
+    # the demand is the same everywhere, but only one replica acts on it
+    assert set(pool.demand.keys()) == {pool_key(SNAPSHOT), pool_key(other)}
+    assert not mock_create_from_dict.called
+    deleted = core_api.delete_namespaced_persistent_volume_claim.call_args_list
+    assert [c.args[0] for c in deleted] == ['5-project-pool-1']
+    owns.assert_any_call(pool_key(other), default=False)
+
+
+async def test_build_with_warm_pvc(mocker, testrun,
+                                   post_building_status,
+                                   post_started_status,
+                                   save_build_state_mock,
+                                   node_cache_hit_mock,
+                                   mock_create_from_dict):
+    mocker.patch('jobs.async_get_snapshot', return_value=True)
+    acquire = mocker.patch.object(pvc_pool, 'acquire', return_value='5-project-pool-1')
+
+    await handle_start_run(testrun)
+
+    acquire.assert_called_once_with(testrun, SNAPSHOT, 10)
+    # only the build job is created, using the warm PVC
+    assert mock_create_from_dict.call_count == 1
+    job = mock_create_from_dict.call_args.args[0]
+    assert job['kind'] == 'Job'
+    volumes = job['spec']['template']['spec']['volumes']
+    assert any(v.get('persistentVolumeClaim', {}).get('claimName') == '5-project-pool-1' for v in volumes)
+    assert testrun.buildstate.rw_build_pvc == '5-project-pool-1'
+
+
+async def test_warm_pvc_rolled_back(mocker, testrun, respx_mock,
+                                    post_started_status,
+                                    save_build_state_mock,
+                                    node_cache_hit_mock,
+                                    k8_delete_pvc_mock,
+                                    mock_create_from_dict):
+    mocker.patch('jobs.async_get_snapshot', return_value=True)
+    mocker.patch.object(pvc_pool, 'acquire', return_value='5-project-pool-1')
+    mock_create_from_dict.side_effect = ApiException(status=403, reason='Forbidden')
+
+    post_failed = respx_mock.post('https://api.cykubed.com/agent/testrun/20/status/failed')
+
+    await handle_start_run(testrun)
+    assert post_failed.called
+    # we claimed it, so we delete it
+    assert k8_delete_pvc_mock.call_args.args[0] == '5-project-pool-1'
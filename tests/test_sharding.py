@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+from aiohttp.test_utils import TestClient, RawTestServer
+from httpx import Response
+
+import ws
+from informers import Informer
+from main import handler
+from settings import settings
+from sharding import HashRing, ShardRouter
+
+
+def agent_pod(name: str, ready=True, deleting=False) -> dict:
+    metadata = dict(name=name, labels=dict(app='agent'))
+    if deleting:
+        metadata['deletionTimestamp'] = '2023-12-03T14:10:00Z'
+    return dict(metadata=metadata,
+                status=dict(conditions=[dict(type='Ready', status='True' if ready else 'False')]))
+
+
+def test_hash_ring_rebalance():
+    before = HashRing(['agent-0', 'agent-1', 'agent-2'], 64)
+    after = HashRing(['agent-0', 'agent-1', 'agent-2', 'agent-3'], 64)
+    owners = [before.owner(i) for i in range(1000)]
+    # reasonably even
+    assert all(200 < owners.count(m) < 470 for m in before.members)
+
+    moved = [i for i in range(1000) if after.owner(i) != owners[i]]
+    # only the new replica's share moves, and only to it
+    assert 150 < len(moved) < 350
+    assert {after.owner(i) for i in moved} == {'agent-3'}
+
+
+async def test_forward_to_owner(respx_mock):
+    informer = Informer('agents', None)
+    router = ShardRouter('agent-0', informer, 64, True)
+    data = dict(command='build_completed', payload=json.dumps(dict(id=20)))
+
+    # until we know who the replicas are, we handle commands ourselves, but not watch events
+    assert router.owns(20)
+    assert not router.owns(20, default=False)
+    assert not await router.forward(data)
+
+    await informer.on_list([agent_pod('agent-0'), agent_pod('agent-1'), agent_pod('agent-2', ready=False)])
+    informer.synced = True
+    assert router.ring.members == ('agent-0', 'agent-1')
+    trid = next(i for i in range(100) if router.owner(i) == 'agent-1')
+    assert not router.owns(trid)
+
+    forwarded = respx_mock.post('http://agent-1.agent:9001/command').mock(return_value=Response(202))
+    data['payload'] = json.dumps(dict(id=trid))
+    assert await router.forward(data)
+    assert json.loads(forwarded.calls[0].request.content) == data
+    assert forwarded.calls[0].request.headers['Authorization'] == f'Bearer {settings.API_TOKEN}'
+
+    # agent-1 is going away: agent-0 takes over its testruns
+    rebalances = router.rebalances
+    await informer.on_event('MODIFIED', agent_pod('agent-1', deleting=True))
+    assert router.owns(trid)
+    assert not await router.forward(data)
+    assert router.rebalances == rebalances + 1
+
+    # the informer has to resync: we carry on with the ring we knew
+    informer.synced = False
+    assert router.owner(trid) == 'agent-0'
+    await informer.on_list([agent_pod('agent-0', ready=False), agent_pod('agent-1', deleting=True)])
+    assert router.ring.members == ('agent-0',)
+
+    # commands that aren't for a testrun are always handled locally
+    assert not await router.forward(dict(command='delete_snapshots', payload={'names': []}))
+    await router.close()
+
+
+async def test_wait_until_synced():
+    informer = Informer('agents', None)
+    router = ShardRouter('agent-0', informer, 64, True)
+    waiter = asyncio.create_task(router.wait_until_synced(0.01))
+    await asyncio.sleep(0.05)
+    assert not waiter.done()
+    informer.synced = True
+    await asyncio.wait_for(waiter, 1)
+
+
+async def test_receive_forwarded_command(mocker):
+    submit = mocker.patch.object(ws.dispatcher, 'submit')
+    client = TestClient(RawTestServer(handler))
+    await client.start_server()
+    try:
+        auth = {'Authorization': f'Bearer {settings.API_TOKEN}'}
+        data = dict(command='build_completed', payload=json.dumps(dict(id=20)))
+        assert (await client.post('/command', data=json.dumps(data))).status == 401
+        assert (await client.post('/command', data=json.dumps(data),
+                                  headers={'Authorization': 'Bearer wrong'})).status == 401
+        assert (await client.post('/command', data='{', headers=auth)).status == 400
+        # only testrun commands are forwarded
+        assert (await client.post('/command', data=json.dumps(dict(command='delete_snapshots')),
+                                  headers=auth)).status == 400
+        assert not submit.called
+
+        assert (await client.post('/command', data=json.dumps(data), headers=auth)).status == 202
+        submit.assert_called_once_with(dict(data, forwarded=True))
+    finally:
+        await client.close()
@@ -2,6 +2,7 @@ import json
 import os.path
 from asyncio import QueueEmpty
 
+import pytest
 import yaml
 from freezegun import freeze_time
 from httpx import Response
@@ -10,6 +11,7 @@ from kubernetes_asyncio.client import ApiException
 import common.schemas
 import logs
 from common import schemas
+from common.exceptions import BuildFailedException
 from common.schemas import NewTestRun, Project, TestRunBuildState
 from jobs import create_runner_job, handle_delete_build_states
 from settings import settings
@@ -191,6 +193,28 @@ async def test_create_snapshot_failed(mocker,
                         expected_error_message]
 
 
+async def test_prepare_cache_failure_is_not_fatal(mocker,
+                                                testrun: NewTestRun,
+                                                mock_create_from_dict,
+                                                wait_for_snapshot_ready_mock,
+                                                save_build_state_mock,
+                                                k8_custom_api_mock,
+                                                k8_delete_pvc_mock,
+                                                k8_delete_job_mock):
+    mocker.patch('jobs.prepare_cache_wait', side_effect=BuildFailedException('no quota'))
+    state = testrun.buildstate
+    state.rw_build_pvc = '5-project-1-rw'
+    state.build_job = '5-builder-project-1'
+
+    await handle_websocket_message(dict(command='build_completed', payload=testrun.json()))
+
+    # the node cache just isn't updated: the runner and its PVC are kept
+    assert set(get_kind_and_names(mock_create_from_dict)) == {('PersistentVolumeClaim', '5-project-1-ro'),
+                                                              ('Job', '5-runner-project-1-0')}
+    assert not k8_delete_pvc_mock.called
+    assert not k8_delete_job_mock.called
+
+
 async def test_create_full_spot_runner(testrun: NewTestRun,
                                        save_build_state_mock,
                                        mock_create_from_dict):
@@ -247,6 +271,7 @@ async def test_full_run_gke_cache_miss(mock_create_from_dict,
                                        k8_custom_api_mock,
                                        get_cache_key_mock,
                                        node_cache_miss_mock,
+                                       post_timeline_mock,
                                        testrun_factory):
     """
     Full test run with node cache miss
@@ -260,7 +285,14 @@ async def test_full_run_gke_cache_miss(mock_create_from_dict,
 
     assert node_cache_miss_mock.called
 
+    # the RW PVC is saved (without a delay here) while the build job is being created, and then
+    # the build job once it has been
     assert save_build_state_mock.call_count == 2
+    first = json.loads(save_build_state_mock.calls[0].request.content.decode())
+    assert first['rw_build_pvc'] == '5-project-1-rw'
+    assert first['build_job'] is None
+    assert json.loads(save_build_state_mock.calls[1].request.content.decode())['build_job'] == \
+           '5-builder-project-1'
 
     # status is initial started, then building
     assert post_started_status.call_count == 1
@@ -326,6 +358,7 @@ async def test_full_run_gke_cache_miss(mock_create_from_dict,
                        "run_job_index": 0}
 
     testrun.buildstate = TestRunBuildState.parse_obj(payload)
+    assert testrun.buildstate.cache_key == 'absd234weefw'
 
     # this will create a RO PVC from the snapshot and kick off two jobs: one to prepare the node cache and
     # another to create the runner Job
@@ -358,6 +391,20 @@ async def test_full_run_gke_cache_miss(mock_create_from_dict,
     delete_pvcs = [x.args[0] for x in k8_delete_pvc_mock.call_args_list]
     assert delete_pvcs == ['5-project-1-rw', '5-project-1-ro']
 
+    # and the timeline is sent to the server
+    assert post_timeline_mock.call_count == 1
+    timeline = json.loads(post_timeline_mock.calls[0].request.content)
+    assert {'start', 'create_build_job', 'cache_key', 'build_completed', 'build_snapshot_wait',
+            'create_runner_job', 'prepare_cache', 'cache_prepared', 'node_snapshot_wait',
+            'k8s.create_snapshot', 'cleanup', 'build_snapshot', 'ro_pvc', 'runner_job',
+            'prepare_cache_job'} <= set(timeline['totals'])
+    # each step of the build completed graph has its own span within the phase
+    snapshot = next(s for s in timeline['spans'] if s['name'] == 'k8s.create_snapshot')
+    assert snapshot['testrun_id'] == 20
+    assert snapshot['parent'] == 'build_snapshot'
+    step = next(s for s in timeline['spans'] if s['name'] == 'build_snapshot')
+    assert step['parent'] == 'build_completed'
+
 
 @freeze_time('2023-12-03 14:10:00Z')
 async def test_full_run_aks_cache_miss(
@@ -459,3 +506,26 @@ async def test_delete_project(k8_delete_job_mock,
     assert delete_snapshot_mock.call_count == 3
     delete_snapshots = {x.kwargs['name'] for x in delete_snapshot_mock.call_args_list}
     assert delete_snapshots == {'build-snap-1', 'node-snap-1', 'build-snap-2'}
+
+
+async def test_delete_build_states_aggregates_errors(k8_delete_job_mock,
+                                                     k8_delete_pvc_mock,
+                                                     delete_snapshot_mock):
+    states = [TestRunBuildState(testrun_id=trid, build_job=f'build-{trid}', ro_build_pvc=f'ro-{trid}',
+                                build_snapshot_name=f'build-snap-{trid}')
+              for trid in range(10)]
+
+    async def delete_snapshot(name, **kwargs):
+        if name == 'build-snap-3':
+            raise ApiException(status=500, reason='Internal Server Error')
+
+    delete_snapshot_mock.side_effect = delete_snapshot
+
+    with pytest.raises(BuildFailedException) as ex:
+        await handle_delete_build_states(states)
+
+    assert ex.value.msg == 'Failed to delete 1 objects:\nsnapshot build-snap-3: 500 Internal Server Error'
+    # the failure didn't stop anything else being deleted
+    assert k8_delete_job_mock.call_count == 10
+    assert k8_delete_pvc_mock.call_count == 10
+    assert delete_snapshot_mock.call_count == 10
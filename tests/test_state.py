@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+import httpx
+from httpx import Response
+
+from common.schemas import TestRunBuildState
+from state import BuildStateCache, BuildStateWriter, save_build_state, get_build_state, delete_build_state
+
+
+async def test_build_state_cache(mocker, respx_mock):
+    mocker.patch('state.build_state_cache', BuildStateCache(10, 60))
+    respx_mock.put('https://api.cykubed.com/agent/testrun/20/build-state').mock(return_value=Response(200))
+    respx_mock.delete('https://api.cykubed.com/agent/testrun/20/build-state').mock(return_value=Response(200))
+    fetch = respx_mock.get('https://api.cykubed.com/agent/testrun/20/build-state') \
+        .mock(return_value=Response(200, content=TestRunBuildState(testrun_id=20, build_job='server').json()))
+
+    await save_build_state(TestRunBuildState(testrun_id=20, build_job='build-1'))
+
+    # watchers pass the testrun id from the labels
+    state = await get_build_state('20')
+    assert state.build_job == 'build-1'
+    assert not fetch.called
+    # we get a copy
+    state.build_job = 'changed'
+    assert (await get_build_state(20)).build_job == 'build-1'
+
+    await delete_build_state(20)
+    assert (await get_build_state(20)).build_job == 'server'
+    assert fetch.call_count == 1
+    # and it's now cached
+    await get_build_state(20)
+    assert fetch.call_count == 1
+
+
+async def test_build_state_writer(respx_mock):
+    writer = BuildStateWriter(60, 10, 60)
+    put = respx_mock.put('https://api.cykubed.com/agent/testrun/20/build-state').mock(return_value=Response(200))
+
+    state = TestRunBuildState(testrun_id=20, build_job='build-1')
+    writer.set_persisted(state)
+    state.rw_build_pvc = 'pvc-rw'
+    await writer.save(state)
+    state.run_job = 'runner-1'
+    await writer.save(state, flush=True)
+    # coalesced into one full update
+    assert put.call_count == 1
+    saved = TestRunBuildState.parse_raw(put.calls[0].request.content)
+    assert (saved.build_job, saved.rw_build_pvc, saved.run_job) == ('build-1', 'pvc-rw', 'runner-1')
+    assert not writer.timers
+
+    # nothing has changed
+    await writer.save(state, flush=True)
+    assert put.call_count == 1
+    assert writer.stats() == dict(saves=3, requests=1, pending=0)
+
+
+async def test_build_state_writer_retries(respx_mock):
+    writer = BuildStateWriter(0.01, 10, 60)
+    put = respx_mock.put('https://api.cykubed.com/agent/testrun/20/build-state')
+    put.side_effect = [httpx.ConnectError('refused'), Response(500), Response(200)]
+
+    await writer.save(TestRunBuildState(testrun_id=20, build_job='build-1'))
+    for _ in range(200):
+        if put.call_count == 3 and not writer.timers:
+            break
+        await asyncio.sleep(0.01)
+    # a failed debounced write is tried again later, backing off
+    assert put.call_count == 3
+    assert not writer.pending
+    assert not writer.timers
+
+
+async def test_build_state_writer_gives_up(respx_mock):
+    writer = BuildStateWriter(0.01, 10, 60)
+    put = respx_mock.put('https://api.cykubed.com/agent/testrun/20/build-state').mock(return_value=Response(404))
+
+    await writer.save(TestRunBuildState(testrun_id=20, build_job='build-1'))
+    await asyncio.sleep(0.2)
+    # the testrun has gone, so there's no point retrying
+    assert put.call_count == 1
+    assert not writer.pending
+    assert not writer.timers
+
+
+async def test_delete_cancels_pending_save(mocker, respx_mock):
+    writer = mocker.patch('state.build_state_writer', BuildStateWriter(0.05, 10, 60))
+    put = respx_mock.put('https://api.cykubed.com/agent/testrun/20/build-state').mock(return_value=Response(200))
+    respx_mock.delete('https://api.cykubed.com/agent/testrun/20/build-state').mock(return_value=Response(200))
+    state = TestRunBuildState(testrun_id=20, build_job='build-1')
+    writer.set_persisted(state)
+    state.run_job = 'runner-1'
+
+    await save_build_state(state)
+    await delete_build_state(20)
+    await asyncio.sleep(0.1)
+    # the deleted testrun isn't written back
+    assert not put.called
+    assert not writer.pending
+    assert not writer.timers
+    assert 20 not in writer.persisted
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from taskgraph import TaskGraph
+
+
+def make_step(events: list, name: str, delay: float = 0.01, fail: bool = False):
+    async def step():
+        events.append(f'start {name}')
+        await asyncio.sleep(delay)
+        if fail:
+            raise ValueError(f'{name} failed')
+        events.append(f'end {name}')
+        return name
+    return step
+
+
+def make_rollback(events: list):
+    async def rollback(result):
+        events.append(f'rollback {result}')
+    return rollback
+
+
+async def test_independent_steps_overlap():
+    events = []
+    graph = TaskGraph('test')
+    graph.add('a', make_step(events, 'a'))
+    graph.add('b', make_step(events, 'b'))
+    graph.add('c', make_step(events, 'c'), after=['a', 'b'])
+    assert await graph.run() == dict(a='a', b='b', c='c')
+    # a and b run together, and c waits for both
+    assert events[:2] == ['start a', 'start b']
+    assert events[-2:] == ['start c', 'end c']
+
+
+async def test_unknown_dependency():
+    graph = TaskGraph('test')
+    with pytest.raises(ValueError):
+        graph.add('a', make_step([], 'a'), after=['b'])
+
+
+async def test_rollback_on_failure():
+    events = []
+    rollback = make_rollback(events)
+    graph = TaskGraph('test')
+    graph.add('a', make_step(events, 'a', delay=0), rollback=rollback)
+    graph.add('b', make_step(events, 'b', delay=0.01), rollback=rollback)
+    graph.add('c', make_step(events, 'c', delay=0.02, fail=True), rollback=rollback)
+    graph.add('d', make_step(events, 'd', delay=1))
+    graph.add('e', make_step(events, 'e'), after=['c'], rollback=rollback)
+    graph.add('f', make_step(events, 'f', delay=0.05), rollback=rollback)
+    with pytest.raises(ValueError, match='c failed'):
+        await graph.run()
+    # d is cancelled and e never starts. f creates something, so it finishes: then the steps that
+    # completed are rolled back in reverse
+    assert 'end d' not in events
+    assert 'start e' not in events
+    assert events[-4:] == ['end f', 'rollback f', 'rollback b', 'rollback a']
+
+
+async def test_rollback_when_cancelled():
+    events = []
+    rollback = make_rollback(events)
+    graph = TaskGraph('test')
+    graph.add('a', make_step(events, 'a', delay=0), rollback=rollback)
+    graph.add('b', make_step(events, 'b', delay=0.05), rollback=rollback)
+    graph.add('c', make_step(events, 'c', delay=1))
+    graph.add('d', make_step(events, 'd'), after=['b'], rollback=rollback)
+    task = asyncio.create_task(graph.run())
+    await asyncio.sleep(0.02)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # b was in flight when we were cancelled (e.g on SIGTERM): it's left to finish, so nothing leaks
+    assert 'end c' not in events
+    assert 'start d' not in events
+    assert events[-3:] == ['end b', 'rollback b', 'rollback a']
@@ -0,0 +1,67 @@
+import chevron
+import pytest
+import yaml
+
+from k8utils import load_templates, get_job_template
+from templates import CompiledTemplate, NotCompilable
+
+TEMPLATE = '''apiVersion: v1
+kind: Pod
+metadata:
+  name: "{{name}}"
+  labels:
+    testrun_id: "{{testrun_id}}"
+spec:
+  activeDeadlineSeconds: {{deadline}}
+  args: [ "run", "{{testrun_id}}"]
+{{& extra }}
+  containers:
+  - image: {{image}}
+    {{#agent_url}}
+    env:
+    - name: AGENT_URL
+      value: "{{agent_url}}"
+    {{/agent_url}}
+'''
+
+
+def slow_render(template: str, context: dict) -> list:
+    return list(yaml.safe_load_all(chevron.render(template, context)))
+
+
+@pytest.mark.parametrize('context', [
+    dict(name='job-1', testrun_id=20, deadline=3600, extra='', image='cykube/runner:1.0'),
+    dict(name='job-2', testrun_id=21, deadline=60, extra='  priority: 10', image='cykube/runner:1.1',
+         agent_url='http://agent:9001'),
+    # plain values are typed as YAML would type them
+    dict(name='a "quoted" name', testrun_id=22, deadline='null', extra='', image='true'),
+])
+def test_compiled_render_matches_yaml(context):
+    compiled = CompiledTemplate('test', TEMPLATE)
+    assert compiled.render(context) == slow_render(TEMPLATE, context)
+
+
+def test_structures_are_cached():
+    compiled = CompiledTemplate('test', TEMPLATE)
+    [first] = compiled.render(dict(name='job-1', testrun_id=20, deadline=10, extra='', image='x'))
+    [second] = compiled.render(dict(name='job-2', testrun_id=21, deadline=20, extra='', image='y'))
+    assert len(compiled.plans) == 1
+    assert first['spec']['activeDeadlineSeconds'] == 10
+    assert second['spec']['activeDeadlineSeconds'] == 20
+    # constant subtrees are copied, so objects can be safely modified
+    first['kind'] = 'Job'
+    assert second['kind'] == 'Pod'
+
+
+def test_unsafe_plain_value_is_not_compilable():
+    # values that would change how the YAML parses have to be rendered the slow way
+    compiled = CompiledTemplate('test', TEMPLATE)
+    for image in ('[x]', 'image: x', '# comment', 'v\n', '=', '=x'):
+        with pytest.raises(NotCompilable):
+            compiled.render(dict(name='job', testrun_id=20, deadline=10, extra='', image=image))
+
+
+def test_all_templates_compile():
+    load_templates()
+    for name in ('build', 'runner', 'pvc'):
+        CompiledTemplate(name, get_job_template(name)).validate()
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from tracing import Tracer, FileExporter
+
+
+async def test_tracer(tmp_path):
+    tracer = Tracer(10, 60)
+    path = tmp_path / 'spans.jsonl'
+    exporter = FileExporter(str(path))
+    tracer.add_exporter(exporter)
+
+    with tracer.span('build_completed', 20):
+        with tracer.span('k8s.create_snapshot'):
+            pass
+        with pytest.raises(ValueError):
+            with tracer.span('build_snapshot_wait'):
+                raise ValueError('timed out')
+    # not part of a testrun
+    with tracer.span('k8s.list_jobs'):
+        pass
+    tracer.mark('runner_pod_running', '20', once=True)
+    tracer.mark('runner_pod_running', '20', once=True)
+
+    summary = tracer.summary(20)
+    assert [s['name'] for s in summary['spans']] == \
+           ['build_completed', 'k8s.create_snapshot', 'build_snapshot_wait', 'runner_pod_running']
+    assert summary['spans'][1]['parent'] == 'build_completed'
+    assert summary['spans'][2]['error'] == 'ValueError: timed out'
+    assert set(summary['totals']) == {'build_completed', 'k8s.create_snapshot', 'build_snapshot_wait',
+                                      'runner_pod_running'}
+
+    exporter.close()
+    exported = [json.loads(line) for line in path.read_text().splitlines()]
+    # in the order they finished
+    assert [s['name'] for s in exported] == \
+           ['k8s.create_snapshot', 'build_snapshot_wait', 'build_completed', 'runner_pod_running']
+
+
+def test_file_exporter_bad_path(tmp_path):
+    with pytest.raises(OSError):
+        FileExporter(str(tmp_path / 'missing' / 'spans.jsonl'))
@@ -1,32 +1,85 @@
 import datetime
+import json
 
+import pytest
 from freezegun import freeze_time
 from httpx import Response
 
 from common import schemas
-from watchers import handle_pod_event
+from records import PodRecord, JobRecord
+from watchers import handle_pod_event, PodDurationReporter
 
 
-async def test_handle_post_event(respx_mock, mocker):
+@pytest.fixture()
+def reporter(mocker) -> PodDurationReporter:
+    return mocker.patch('watchers.pod_duration_reporter', PodDurationReporter(100, 3600))
+
+
+def create_pod(name: str, testrun_id=20) -> PodRecord:
+    return PodRecord.from_dict(dict(metadata=dict(name=name,
+                                                  uid=f'uid-{name}',
+                                                  labels={'testrun_id': testrun_id,
+                                                          'cykubed_job': 'runner'},
+                                                  managedFields=[]),
+                                    spec=dict(containers=[]),
+                                    status=dict(phase='Succeeded',
+                                                startTime='2023-06-10T10:00:00Z')))
+
+
+async def test_handle_post_event(respx_mock, mocker, reporter):
     store_duration = \
         respx_mock.post('https://api.cykubed.com/agent/testrun/20/pod-duration') \
             .mock(return_value=Response(200))
 
-    pod = mocker.Mock()
-    pod.status.phase = 'Succeeded'
-    pod.status.start_time = datetime.datetime(2023, 6, 10, 10, 0, 0, tzinfo=datetime.timezone.utc)
-    pod.metadata = mocker.Mock()
-    pod.metadata.name = 'pod-deadbeef0101'
-    pod.metadata.annotations = {}
-    pod.metadata.labels = {'testrun_id': 20,
-                           'cykubed_job': 'runner'}
+    pod = create_pod('pod-deadbeef0101')
 
     with freeze_time("2023-06-10 10:02:30Z"):
         await handle_pod_event(pod)
+        # we'll see the same pod many times
+        await handle_pod_event(pod)
+        await reporter.flush()
 
-        assert store_duration.called
+        assert store_duration.call_count == 1
 
         st = schemas.PodDuration.parse_raw(store_duration.calls[0].request.content.decode())
         assert st.duration == 150
         assert not st.is_spot
         assert st.job_type == 'runner'
+
+
+async def test_buffered_pod_durations(respx_mock, mocker, reporter):
+    store_duration = respx_mock.post('https://api.cykubed.com/agent/testrun/20/pod-duration')
+    store_duration.side_effect = [Response(200), Response(503)] + [Response(200)] * 4
+
+    with freeze_time("2023-06-10 10:02:30Z"):
+        for i in range(5):
+            await handle_pod_event(create_pod(f'pod-{i}'))
+
+    # a transient error: that one is kept for the next flush
+    await reporter.flush()
+    assert reporter.buffered == 1
+    await reporter.flush()
+    assert reporter.buffered == 0
+
+    durations = [json.loads(c.request.content)['pod_name'] for c in store_duration.calls]
+    assert durations == ['pod-0', 'pod-1', 'pod-2', 'pod-3', 'pod-4', 'pod-1']
+    assert reporter.stats() == dict(buffered=0, posted=5, requests=6, dropped=0)
+
+
+def test_buffer_is_bounded():
+    reporter = PodDurationReporter(3, 3600)
+    for i in range(5):
+        reporter.add(f'uid-{i}', str(20 + i % 2),
+                     schemas.PodDuration(pod_name=f'pod-{i}', job_type='runner', is_spot=False, duration=10))
+    assert reporter.buffered == 3
+    assert reporter.dropped == 2
+
+
+def test_decode_records():
+    pod = create_pod('pod-1')
+    assert pod.start_time == datetime.datetime(2023, 6, 10, 10, 0, 0, tzinfo=datetime.timezone.utc)
+    assert pod.annotations == {}
+    job = JobRecord.from_dict(dict(metadata=dict(name='job-1', labels=dict(testrun_id='20')),
+                                   status=dict(completionTime='2023-06-10T10:02:30Z')))
+    assert job.active == 0
+    assert job.completion_time == datetime.datetime(2023, 6, 10, 10, 2, 30, tzinfo=datetime.timezone.utc)